@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+
+"""Compare k-mer distances with distances from cmalign and FastTree
+
+Usage:
+
+  bin/benchmark_kmer_dists.py [n_seqs]
+
+For each aligned test data set (deenurp/test/data/*.aln.fasta), distances
+are estimated from the k-mers of the unaligned sequences and compared with
+``distmat_cmalign`` (or, if cmalign and FastTree aren't installed, the
+saved output of ``FastTree -makematrix`` for the same alignment in the
+corresponding .distmat file). Agreement is reported as the correlation of
+distances, and as the number of sequences classified differently by
+``outliers.outliers`` with a radius of 0.015.
+
+Finally ``n_seqs`` (default 2,000) sequences mutated from a test sequence
+are used to time larger groups.
+
+"""
+
+import glob
+import os
+import sys
+import time
+
+import numpy as np
+from Bio import SeqIO
+from Bio.Seq import Seq
+from Bio.SeqRecord import SeqRecord
+
+from deenurp import kmer, outliers, util
+from deenurp.subcommands import filter_outliers
+
+RADIUS = 0.015
+
+
+def degapped(records):
+    return [SeqRecord(Seq(str(r.seq).replace('-', '').upper()), id=r.id,
+                      description='')
+            for r in records]
+
+
+def reference(aln_fasta, sequences):
+    """
+    Distances from cmalign and FastTree if available, else the saved
+    distances for ``aln_fasta``
+    """
+    if util.which('cmalign') and util.which('FastTree'):
+        with util.as_fasta(sequences) as fasta:
+            start = time.time()
+            taxa, distmat = filter_outliers.distmat_cmalign(fasta, 'bench_')
+            return 'distmat_cmalign', time.time() - start, taxa, distmat
+    path = aln_fasta.replace('.aln.fasta', '.distmat')
+    with open(path) as fp:
+        taxa, distmat = outliers.read_condensed(fp)
+    return os.path.basename(path), None, taxa, distmat
+
+
+def compare(aln_fasta):
+    sequences = degapped(SeqIO.parse(aln_fasta, 'fasta'))
+    label, seconds, taxa, expected = reference(aln_fasta, sequences)
+
+    start = time.time()
+    names, distmat = kmer.kmer_distances(sequences)
+    kmer_seconds = time.time() - start
+    assert names == taxa
+
+    _, _, expected_out = outliers.outliers(expected, RADIUS)
+    _, _, is_out = outliers.outliers(distmat, RADIUS)
+    print os.path.basename(aln_fasta)
+    print '  {0:30s}{1}'.format(
+        label, '{0:.3f}s'.format(seconds) if seconds else '(saved)')
+    print '  {0:30s}{1:.3f}s'.format('kmer_distances', kmer_seconds)
+    print '  correlation {0:.3f}, mean |difference| {1:.4f}'.format(
+        np.corrcoef(expected.data, distmat.data)[0, 1],
+        np.abs(expected.data - distmat.data).mean())
+    print '  outliers: {0} / {1}, {2} classified differently'.format(
+        is_out.sum(), expected_out.sum(), (is_out != expected_out).sum())
+
+
+def mutants(record, n, rate=0.02, seed=1):
+    rng = np.random.RandomState(seed)
+    seq = np.frombuffer(str(record.seq), dtype='S1')
+    for i in xrange(n):
+        s = seq.copy()
+        changed = rng.uniform(size=len(s)) < rate * rng.uniform()
+        s[changed] = rng.choice(list('ACGT'), changed.sum())
+        yield SeqRecord(Seq(s.tostring()), id='seq{0}'.format(i),
+                        description='')
+
+
+def main():
+    n_seqs = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    data = os.path.join(os.path.dirname(__file__), '..', 'deenurp', 'test',
+                        'data')
+    alignments = sorted(glob.glob(os.path.join(data, '*.aln.fasta')))
+    for path in alignments:
+        compare(path)
+
+    sequences = list(mutants(
+        degapped(SeqIO.parse(alignments[0], 'fasta'))[0], n_seqs))
+    start = time.time()
+    kmer.kmer_distances(sequences)
+    print '{0} sequences: kmer_distances {1:.3f}s'.format(
+        n_seqs, time.time() - start)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+
+"""Compare the line-based and block PHYLIP distance matrix readers
+
+Usage:
+
+  bin/benchmark_read_dists.py [n_taxa]
+
+Each distance matrix in deenurp/test/data is read with both readers,
+followed by a synthetic matrix resembling ``FastTree -makematrix`` output
+with ``n_taxa`` rows (default 2,000).
+
+"""
+
+import glob
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from deenurp import outliers
+
+
+def read_dists_lines(fobj):
+    """
+    The previous reader, parsing one row at a time
+    """
+    N = int(fobj.readline())
+    distmat = np.repeat(-1 * np.inf, N ** 2)
+    distmat.shape = (N, N)
+
+    taxa = []
+    for row, line in enumerate(fobj):
+        spl = line.split()
+        assert len(spl) == N + 1
+        taxa.append(spl.pop(0))
+        distmat[row, :] = map(float, spl)
+
+    return taxa, distmat
+
+
+def write_distmat(fp, n_taxa):
+    d = np.random.uniform(0, 0.1, (n_taxa, n_taxa))
+    d = (d + d.T) / 2
+    np.fill_diagonal(d, 0)
+    fp.write('   {0}\n'.format(n_taxa))
+    for i, row in enumerate(d):
+        fp.write('seq{0} {1}\n'.format(
+            i, ' '.join('{0:.6f}'.format(v) for v in row)))
+    fp.flush()
+
+
+def timed(label, path, fn):
+    start = time.time()
+    with open(path) as fp:
+        taxa, mat = fn(fp)
+    print '{0:30s}{1:30s}{2:8.3f}s {3:6d} taxa'.format(
+        os.path.basename(path), label, time.time() - start, len(taxa))
+    return mat
+
+
+def compare(path):
+    expected = timed('line reader', path, read_dists_lines)
+    mat = timed('read_dists', path, outliers.read_dists)
+    assert (mat == expected).all()
+    mat = timed('read_dists (float32)', path,
+                lambda fp: outliers.read_dists(fp, dtype=np.float32))
+    assert (mat == expected.astype(np.float32)).all()
+
+
+def main():
+    n_taxa = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    data = os.path.join(os.path.dirname(__file__), '..', 'deenurp', 'test',
+                        'data')
+    for path in sorted(glob.glob(os.path.join(data, '*.distmat'))):
+        compare(path)
+    with tempfile.NamedTemporaryFile(suffix='.distmat') as tf:
+        write_distmat(tf, n_taxa)
+        compare(tf.name)
+
+
+if __name__ == '__main__':
+    main()
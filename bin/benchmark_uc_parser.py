@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+
+"""Compare the row-based and batched .uc parsers in deenurp.uclust
+
+Usage:
+
+  bin/benchmark_uc_parser.py [n_rows]
+
+A synthetic file resembling ``vsearch --uc_allhits`` output with
+``n_rows`` records (default 1,000,000) is written to a temporary file.
+
+"""
+
+import random
+import sys
+import tempfile
+import time
+
+from deenurp import uclust
+
+
+def write_uc(fp, n_rows):
+    for i in xrange(n_rows):
+        if i % 20 == 0:
+            fp.write('S\t{0}\t1500\t*\t*\t*\t*\t*\tseq{1}\t*\n'.format(
+                i // 20, i))
+        else:
+            fp.write('H\t{0}\t1500\t{1:.1f}\t+\t0\t0\t1500M\tseq{2}\t'
+                     'ref{3}\n'.format(i // 20, random.uniform(90, 100),
+                                       i, i // 20))
+    fp.flush()
+
+
+def timed(label, fn):
+    start = time.time()
+    n = fn()
+    print '{0:40s}{1:8.2f}s {2:10d} hits'.format(
+        label, time.time() - start, n)
+
+
+def main():
+    n_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    with tempfile.NamedTemporaryFile(suffix='.uc') as tf:
+        write_uc(tf, n_rows)
+
+        timed('parse_uclust_out', lambda: sum(
+            1 for i in uclust.parse_uclust_out(tf.name)
+            if i.type == 'H' and i.pct_id >= 97.0))
+        timed('parse_uclust_batches', lambda: sum(
+            len(b) for b in uclust.parse_uclust_batches(
+                tf.name, types=('H',), min_pct_id=97.0)))
+        timed('parse_uclust_batches (query_label)', lambda: sum(
+            len(b) for b in uclust.parse_uclust_batches(
+                tf.name, types=('H',), min_pct_id=97.0,
+                usecols=['query_label'])))
+        timed('records_from_batches', lambda: sum(
+            1 for i in uclust.records_from_batches(
+                uclust.parse_uclust_batches(
+                    tf.name, types=('H',), min_pct_id=97.0))))
+
+
+if __name__ == '__main__':
+    main()
@@ -19,11 +19,15 @@ Assembles subcommands and provides top-level script.
 """
 
 import argparse
+import execution
 import importlib
 import logging
 import os
 import pkgutil
+import progress
+import scratch
 import sys
+import treecache
 import util
 import version
 
@@ -40,10 +44,28 @@ def main(argv=sys.argv[1:]):
     parser = parse_args(parser)
 
     # get logging namespace
+    all_argv = argv
     namespace, argv = parser.parse_known_args(argv)
 
     setup_logging(namespace)
 
+    if namespace.tree_cache:
+        treecache.configure(
+            namespace.tree_cache,
+            namespace.tree_cache_size * 1024 * 1024
+            if namespace.tree_cache_size is not None else None)
+
+    util.MEMO_MAXSIZE = namespace.memo_size
+
+    scratch.configure(
+        namespace.scratch_dir,
+        quota=(int(namespace.scratch_quota) * scratch.MB
+               if namespace.scratch_quota else None),
+        ram_quota=namespace.scratch_ram * scratch.MB)
+
+    if namespace.metrics:
+        progress.configure(namespace.metrics, version=version.version())
+
     # parse version after logging has been configured
     parse_version(parser)
 
@@ -56,6 +78,11 @@ def main(argv=sys.argv[1:]):
     # finish building namespace
     namespace = parser.parse_args(args=argv, namespace=namespace)
 
+    # global options, for queue workers started by this process
+    if namespace.subparser_name in all_argv:
+        execution.WORKER_OPTIONS = all_argv[
+            :all_argv.index(namespace.subparser_name)]
+
     # Determine which subcommand (action) is in play
     action = namespace.subparser_name
 
@@ -115,6 +142,60 @@ def parse_args(parser):
                         const=0,
                         help='Suppress output')
 
+    parser.add_argument('--tree-cache',
+                        metavar='DIR',
+                        default=os.environ.get(treecache.ENV_DIR),
+                        help='Cache FastTree results in %(metavar)s '
+                             '[default: $' + treecache.ENV_DIR + ']')
+
+    parser.add_argument('--tree-cache-size',
+                        metavar='MB',
+                        type=int,
+                        help='Maximum size of the FastTree cache '
+                             '[default: $' + treecache.ENV_MAX_BYTES +
+                             ' bytes, or ' +
+                             str(treecache.DEFAULT_MAX_BYTES / (1024 * 1024)) +
+                             ']')
+
+    parser.add_argument('--scratch-dir',
+                        metavar='DIR',
+                        default=os.environ.get(scratch.ENV_DIR),
+                        help='Directory for temporary files; must be '
+                             'visible to all workers with --executor=queue '
+                             '[default: $' + scratch.ENV_DIR + ', QUEUE_DIR/'
+                             'scratch with --executor=queue, or the system '
+                             'default]')
+
+    parser.add_argument('--scratch-quota',
+                        metavar='MB',
+                        type=int,
+                        default=os.environ.get(scratch.ENV_QUOTA),
+                        help='Wait for space when temporary files use more '
+                             'than %(metavar)s [default: $' +
+                             scratch.ENV_QUOTA + ' or no limit]')
+
+    parser.add_argument('--scratch-ram',
+                        metavar='MB',
+                        type=int,
+                        default=scratch.DEFAULT_RAM_QUOTA / scratch.MB,
+                        help='Space in ' + scratch.RAM_DIR + ' to use for '
+                             'small temporary files, except with '
+                             '--executor=queue; 0 to disable [default: %(default)s]')
+
+    parser.add_argument('--memo-size',
+                        metavar='N',
+                        type=int,
+                        default=util.MEMO_MAXSIZE,
+                        help='Maximum entries in each in-memory lookup '
+                             'cache [default: %(default)s]')
+
+    parser.add_argument('--metrics',
+                        metavar='FILE',
+                        default=os.environ.get(progress.ENV_METRICS),
+                        help='Append progress, throughput and timing '
+                             'metrics to %(metavar)s as JSON lines '
+                             '[default: $' + progress.ENV_METRICS + ']')
+
     return parser
 
 
@@ -0,0 +1,175 @@
+"""
+Persistent store of per-taxon distance matrices.
+
+``filter_outliers --distance-store DIR`` saves the distance matrix of each
+taxon it filters. When a taxon's membership has changed in a later run,
+distances among sequences that were already present are taken from the
+store, and only the rows for new sequences are computed (see ``update``);
+removed sequences are dropped.
+
+Each taxon is a subdirectory of the store::
+
+  <tax_id>/distances.npy  condensed float32 distances (memory-mapped)
+  <tax_id>/names.txt      sequence names, in matrix order
+  <tax_id>/aligned.fasta  aligned sequences, for aligners that need them
+  <tax_id>/params.json    aligner and options the distances came from
+
+Entries are only used with the same parameters. An entry is replaced by
+renaming, so readers never see a partial entry.
+"""
+
+import json
+import logging
+import os
+import os.path
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+from Bio import SeqIO
+
+from .outliers import DistanceMatrix
+
+log = logging.getLogger(__name__)
+
+DISTANCES = 'distances.npy'
+NAMES = 'names.txt'
+ALIGNED = 'aligned.fasta'
+PARAMS = 'params.json'
+
+"""Largest fraction of new sequences for which stored distances are
+updated; above this all distances are recomputed"""
+MAX_NEW_FRACTION = 0.5
+
+
+class Stored(object):
+
+    """
+    Distances for a taxon: ``names``, a ``DistanceMatrix`` and, if saved,
+    a dict of aligned sequences (``SeqRecord``) by name.
+    """
+
+    def __init__(self, names, distmat, aligned=None):
+        self.names = names
+        self.distmat = distmat
+        self.aligned = aligned
+
+
+class DistanceStore(object):
+
+    """
+    A directory of distance matrices, one per tax_id. Statistics are
+    available in ``hits``, ``misses`` and ``stores``.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory):
+                    raise
+
+    def _path(self, tax_id, *args):
+        return os.path.join(self.directory, tax_id, *args)
+
+    def get(self, tax_id, params):
+        """
+        Return ``Stored`` distances for ``tax_id``, or None if there is no
+        entry computed with ``params`` (a JSON-serializable dict).
+        """
+        try:
+            with open(self._path(tax_id, PARAMS)) as fp:
+                stored_params = json.load(fp)
+            if stored_params != json.loads(json.dumps(params)):
+                log.info('distances for tax_id %s were computed with %s; '
+                         'ignoring them', tax_id, stored_params)
+                self.misses += 1
+                return None
+            with open(self._path(tax_id, NAMES)) as fp:
+                names = [line.rstrip('\n') for line in fp]
+            data = np.load(self._path(tax_id, DISTANCES), mmap_mode='r')
+            aligned = None
+            if os.path.exists(self._path(tax_id, ALIGNED)):
+                aligned = SeqIO.to_dict(
+                    SeqIO.parse(self._path(tax_id, ALIGNED), 'fasta'))
+        except (IOError, OSError, ValueError):
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return Stored(names, DistanceMatrix(len(names), data), aligned)
+
+    def put(self, tax_id, params, names, distmat, aligned=None):
+        """
+        Save ``distmat`` (a ``DistanceMatrix``) among ``names`` for
+        ``tax_id``, with optional ``aligned`` sequences (SeqRecords),
+        replacing any previous entry.
+        """
+        tmp = tempfile.mkdtemp(dir=self.directory, prefix='.tmp-')
+        try:
+            np.save(os.path.join(tmp, DISTANCES),
+                    np.asarray(distmat.data, dtype=np.float32))
+            with open(os.path.join(tmp, NAMES), 'w') as fp:
+                for name in names:
+                    fp.write(name + '\n')
+            if aligned is not None:
+                SeqIO.write(aligned, os.path.join(tmp, ALIGNED), 'fasta')
+            with open(os.path.join(tmp, PARAMS), 'w') as fp:
+                json.dump(params, fp, indent=2, sort_keys=True)
+
+            path = self._path(tax_id)
+            if os.path.isdir(path):
+                old = tempfile.mkdtemp(dir=self.directory, prefix='.old-')
+                os.rename(path, os.path.join(old, tax_id))
+                os.rename(tmp, path)
+                shutil.rmtree(old, ignore_errors=True)
+            else:
+                os.rename(tmp, path)
+        except Exception:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+        self.stores += 1
+
+    def log_stats(self):
+        log.info('distance store %s: %d hits, %d misses, %d stores',
+                 self.directory, self.hits, self.misses, self.stores)
+
+
+def new_names(stored, names):
+    """
+    Return indices of the elements of ``names`` not in ``stored``
+    """
+    return np.flatnonzero(pd.Index(stored.names).get_indexer(names) < 0)
+
+
+def update(stored, names, distances):
+    """
+    Return a ``DistanceMatrix`` among ``names``. Distances between names
+    present in ``stored`` are copied from it; ``distances(rows, cols)``,
+    given arrays of indices into ``names``, must return the dense array
+    of distances from each new name (``rows``) to all names (``cols``).
+    At least one name must be present in ``stored``.
+    """
+    n = len(names)
+    positions = pd.Index(stored.names).get_indexer(names)
+    new = np.flatnonzero(positions < 0)
+    if len(new) == n:
+        raise ValueError('no stored distances for any of the sequences')
+
+    # rows and columns of new names are placeholders, overwritten below
+    result = stored.distmat.submatrix(np.maximum(positions, 0))
+    if len(new):
+        block = distances(new, np.arange(n))
+        for k, i in enumerate(new):
+            j = np.delete(np.arange(n), i)
+            result.data[result.index(np.minimum(i, j), np.maximum(i, j))] = \
+                block[k, j]
+
+    log.info('%d stored and %d new sequences', n - len(new), len(new))
+    return result
@@ -0,0 +1,490 @@
+"""
+Execution backends for per-taxon and per-cluster tasks.
+
+* ``threads`` runs tasks in a ``ThreadPoolExecutor`` in the current process.
+* ``queue`` places tasks in a work queue directory. Worker processes on any
+  host that can see the directory (``deenurp queue_worker DIR``) claim tasks,
+  run them, and write back the results, which are collected into ordinary
+  futures - so the ``futures.wait`` loops in the subcommands work unchanged.
+
+Queue layout, relative to the queue directory::
+
+  tasks/<id>.task      pickled (function, args, kwargs), waiting to run
+  claimed/<id>.task.*  claimed by a worker (tasks are claimed by renaming)
+  results/<id>.result  pickled (ok, value, traceback_text)
+
+Tasks and their arguments must be picklable, and any files named in the
+arguments must be visible to the workers at the same paths. A queue
+executor therefore stops the scratch manager from placing temporary files
+in RAM, and puts them in ``scratch/`` under the queue directory unless a
+scratch directory was chosen (see ``scratch.Scratch.share``); tasks naming
+a file in RAM are refused.
+
+While a worker runs a task it touches the claimed file every
+``HEARTBEAT_INTERVAL`` seconds. A claimed task without a heartbeat for
+``STALE_TIMEOUT`` seconds is taken to belong to a worker that died: it is
+returned to ``tasks/`` up to ``MAX_RETRIES`` times, after which its future
+fails. A result that can't be read also fails its future.
+
+Local workers are started through the ``deenurp`` command line with the
+global options of this process (``WORKER_OPTIONS``), so that they use the
+same scratch directory, tree cache, metrics file and logging.
+
+Tasks using several threads each can share a fixed number of cores through
+a ``CoreBudget``: ``budget.run(n, fn, ...)`` waits, in order of arrival,
+until ``n`` cores are free before calling ``fn``.
+"""
+
+import collections
+import contextlib
+import cPickle as pickle
+import itertools
+import logging
+import os
+import os.path
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import traceback
+import uuid
+
+from concurrent import futures
+
+from . import scratch
+
+log = logging.getLogger(__name__)
+
+THREADS = 'threads'
+QUEUE = 'queue'
+BACKENDS = (THREADS, QUEUE)
+
+POLL_INTERVAL = 0.5
+
+"""Seconds between touches of the claimed file of a running task"""
+HEARTBEAT_INTERVAL = 30
+
+"""Seconds without a heartbeat after which a claimed task is stale"""
+STALE_TIMEOUT = 300
+
+"""Times a stale task is returned to the queue before it fails"""
+MAX_RETRIES = 1
+
+"""Global options of the ``deenurp`` command passed to local workers; set
+by ``deenurp.main``"""
+WORKER_OPTIONS = []
+
+_WORKER_MAIN = 'import sys, deenurp; sys.exit(deenurp.main())'
+
+TASKS = 'tasks'
+CLAIMED = 'claimed'
+RESULTS = 'results'
+SCRATCH = 'scratch'
+
+TASK_SUFFIX = '.task'
+RESULT_SUFFIX = '.result'
+
+
+def add_arguments(parser):
+    """
+    Add options selecting an execution backend to ``parser``
+    """
+    group = parser.add_argument_group('execution backend')
+    group.add_argument(
+        '--executor', choices=BACKENDS, default=THREADS,
+        help="""Run tasks in threads of this process, or in worker processes
+        reading from a shared work queue (see 'deenurp queue_worker')
+        [default: %(default)s]""")
+    group.add_argument(
+        '--queue-dir', metavar='DIR',
+        help="""Work queue directory for --executor=queue. Must be visible
+        to all workers.""")
+    group.add_argument(
+        '--local-workers', type=int, default=0, metavar='N',
+        help="""Number of queue workers to start on this host for
+        --executor=queue [default: %(default)s]""")
+    return group
+
+
+def get_executor(backend=THREADS, max_workers=1, queue_dir=None,
+                 local_workers=0):
+    """
+    Return an executor for ``backend``. ``max_workers`` applies to the
+    ``threads`` backend; ``queue_dir`` and ``local_workers`` to ``queue``.
+    """
+    if backend == THREADS:
+        return futures.ThreadPoolExecutor(max_workers)
+    elif backend == QUEUE:
+        if not queue_dir:
+            raise ValueError('a queue directory is required for ' + QUEUE)
+        return QueueExecutor(queue_dir, local_workers=local_workers)
+    raise ValueError('invalid executor: ' + backend)
+
+
+def completed(fn, *args, **kwargs):
+    """
+    Call ``fn`` immediately, returning a finished Future holding the result.
+    Use for trivial tasks that aren't worth sending to an executor.
+    """
+    f = futures.Future()
+    try:
+        f.set_result(fn(*args, **kwargs))
+    except Exception as e:
+        f.set_exception(e)
+    return f
+
+
+def timed(fn, *args, **kwargs):
+    """
+    Call ``fn``, returning (result, seconds elapsed)
+    """
+    start = time.time()
+    result = fn(*args, **kwargs)
+    return result, time.time() - start
+
+
+class CoreBudget(object):
+
+    """
+    A pool of ``cores`` shared by tasks running in threads of this process.
+
+    Requests are granted strictly in order of arrival, so a task needing
+    many cores isn't starved by a stream of smaller ones. Requests for more
+    than ``cores`` are reduced to ``cores``. ``busy`` accumulates
+    core-seconds reserved.
+    """
+
+    def __init__(self, cores):
+        if cores < 1:
+            raise ValueError('at least one core is required')
+        self.cores = cores
+        self.free = cores
+        self.busy = 0.0
+        self._waiting = collections.deque()
+        self._cond = threading.Condition()
+
+    @contextlib.contextmanager
+    def reserve(self, n):
+        """
+        Hold ``n`` cores for the duration of the enclosed block, waiting
+        for them to be free. Yields the number of cores reserved.
+        """
+        n = max(1, min(n, self.cores))
+        ticket = object()
+        with self._cond:
+            self._waiting.append(ticket)
+            while self._waiting[0] is not ticket or self.free < n:
+                self._cond.wait()
+            self._waiting.popleft()
+            self.free -= n
+            # the next request may also fit
+            self._cond.notify_all()
+        start = time.time()
+        try:
+            yield n
+        finally:
+            with self._cond:
+                self.free += n
+                self.busy += n * (time.time() - start)
+                self._cond.notify_all()
+
+    def run(self, n, fn, *args, **kwargs):
+        """
+        Call ``fn`` with ``n`` cores reserved
+        """
+        with self.reserve(n):
+            return fn(*args, **kwargs)
+
+
+def _makedirs(path):
+    if not os.path.isdir(path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            if not os.path.isdir(path):
+                raise
+
+
+def _write_atomic(directory, name, data):
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    with os.fdopen(fd, 'wb') as fp:
+        fp.write(data)
+    os.rename(tmp, os.path.join(directory, name))
+
+
+class QueueExecutor(futures.Executor):
+
+    """
+    Executor submitting tasks to a directory-based work queue.
+
+    If ``local_workers`` is non-zero, that many worker processes are started
+    on this host, and stopped on shutdown. Tasks claimed by a worker which
+    stops sending heartbeats for ``stale_timeout`` seconds are retried up
+    to ``max_retries`` times.
+    """
+
+    def __init__(self, queue_dir, local_workers=0, poll_interval=POLL_INTERVAL,
+                 stale_timeout=STALE_TIMEOUT, max_retries=MAX_RETRIES):
+        self.queue_dir = queue_dir
+        self.poll_interval = poll_interval
+        self.stale_timeout = stale_timeout
+        self.max_retries = max_retries
+        for d in (TASKS, CLAIMED, RESULTS, SCRATCH):
+            _makedirs(self._path(d))
+        # temporary files named in tasks must be visible to the workers
+        self._scratch = scratch.default()
+        self._scratch.share(self._path(SCRATCH))
+
+        self._prefix = uuid.uuid4().hex
+        self._counter = itertools.count()
+        self._pending = {}
+        self._retries = {}
+        self._lock = threading.Lock()
+        self._shutdown = False
+        self._collector = None
+
+        cmd = ([sys.executable, '-c', _WORKER_MAIN] + list(WORKER_OPTIONS) +
+               ['queue_worker', queue_dir])
+        self._workers = [subprocess.Popen(cmd) for _ in range(local_workers)]
+
+    def _path(self, *args):
+        return os.path.join(self.queue_dir, *args)
+
+    def submit(self, fn, *args, **kwargs):
+        for arg in itertools.chain(args, kwargs.values()):
+            if isinstance(arg, basestring) and self._scratch.in_ram(arg):
+                raise ValueError(
+                    '{} is in RAM on this host, so queue workers can not '
+                    'read it'.format(arg))
+        data = pickle.dumps((fn, args, kwargs), pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError('cannot schedule new futures after shutdown')
+            # ids sort in submission order
+            task_id = '{}-{:09d}'.format(self._prefix, next(self._counter))
+            f = futures.Future()
+            self._pending[task_id] = f
+            _write_atomic(self._path(TASKS), task_id + TASK_SUFFIX, data)
+            if self._collector is None:
+                self._collector = threading.Thread(target=self._collect)
+                self._collector.daemon = True
+                self._collector.start()
+        return f
+
+    def _resolve(self, task_id, ok, value, tb=None):
+        with self._lock:
+            f = self._pending.pop(task_id, None)
+            self._retries.pop(task_id, None)
+        if f is None or not f.set_running_or_notify_cancel():
+            return
+        if ok:
+            f.set_result(value)
+        else:
+            log.debug('task %s failed:\n%s', task_id, tb)
+            f.set_exception(value)
+
+    def _collect_results(self, pending):
+        for name in os.listdir(self._path(RESULTS)):
+            if not name.endswith(RESULT_SUFFIX) or \
+                    not name.startswith(self._prefix):
+                continue
+            task_id = name[:-len(RESULT_SUFFIX)]
+            path = self._path(RESULTS, name)
+            if task_id not in pending:
+                with self._lock:
+                    resolved = task_id not in self._pending
+                if resolved:
+                    # a duplicate from a worker presumed dead
+                    os.remove(path)
+                continue
+            try:
+                with open(path, 'rb') as fp:
+                    ok, value, tb = pickle.load(fp)
+            except Exception as e:
+                tb = traceback.format_exc()
+                log.error('could not read the result of task %s:\n%s',
+                          task_id, tb)
+                ok, value = False, e
+            os.remove(path)
+            self._resolve(task_id, ok, value, tb)
+
+    def _check_claimed(self, pending):
+        """
+        Retry or fail pending tasks whose workers have stopped sending
+        heartbeats
+        """
+        now = time.time()
+        for name in os.listdir(self._path(CLAIMED)):
+            task_id = name.split(TASK_SUFFIX + '.', 1)[0]
+            if task_id not in pending:
+                continue
+            path = self._path(CLAIMED, name)
+            try:
+                if now - os.stat(path).st_mtime < self.stale_timeout:
+                    continue
+            except OSError:
+                continue  # finished
+            retries = self._retries.get(task_id, 0)
+            if retries < self.max_retries:
+                log.warning('no heartbeat from the worker running task %s '
+                            'for %ds; returning it to the queue', task_id,
+                            self.stale_timeout)
+                task = self._path(TASKS, task_id + TASK_SUFFIX)
+                try:
+                    os.rename(path, task)
+                    os.utime(task, None)
+                except OSError:
+                    continue
+                with self._lock:
+                    self._retries[task_id] = retries + 1
+            else:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                self._resolve(task_id, False, RuntimeError(
+                    'no heartbeat from the worker running task {} for {}s '
+                    'after {} retries'.format(task_id, self.stale_timeout,
+                                              retries)))
+
+    def _collect(self):
+        """
+        Poll for results, resolving the corresponding futures.
+        """
+        while True:
+            with self._lock:
+                if not self._pending:
+                    if self._shutdown:
+                        return
+                    pending = {}
+                else:
+                    pending = dict(self._pending)
+
+            try:
+                self._collect_results(pending)
+                self._check_claimed(pending)
+            except Exception:
+                # keep collecting, eg after a transient error listing a
+                # directory on a network filesystem
+                log.exception('error collecting results')
+
+            time.sleep(self.poll_interval)
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            self._shutdown = True
+            if not wait:
+                # withdraw tasks that haven't been claimed
+                for task_id, f in self._pending.items():
+                    try:
+                        os.remove(self._path(TASKS, task_id + TASK_SUFFIX))
+                    except OSError:
+                        pass
+                    f.cancel()
+                self._pending.clear()
+            collector = self._collector
+
+        if wait and collector is not None:
+            collector.join()
+
+        for p in self._workers:
+            if p.poll() is None:
+                p.terminate()
+            if wait:
+                p.wait()
+
+
+def _claim(queue_dir):
+    """
+    Claim the oldest available task, returning (task_id, path) or None.
+    """
+    tasks = sorted(i for i in os.listdir(os.path.join(queue_dir, TASKS))
+                   if i.endswith(TASK_SUFFIX))
+    owner = '{}.{}'.format(socket.gethostname(), os.getpid())
+    for name in tasks:
+        claimed = os.path.join(queue_dir, CLAIMED, name + '.' + owner)
+        try:
+            os.rename(os.path.join(queue_dir, TASKS, name), claimed)
+        except OSError:
+            continue  # claimed by another worker
+        try:
+            os.utime(claimed, None)  # the first heartbeat
+        except OSError:
+            pass
+        return name[:-len(TASK_SUFFIX)], claimed
+    return None
+
+
+def _heartbeat(path, done, interval):
+    while not done.wait(interval):
+        try:
+            os.utime(path, None)
+        except OSError:
+            return  # returned to the queue
+
+
+def run_task(queue_dir, task_id, path, heartbeat_interval=HEARTBEAT_INTERVAL):
+    """
+    Run the task stored in ``path``, writing the result to the queue.
+    ``path`` is touched every ``heartbeat_interval`` seconds meanwhile.
+    """
+    done = threading.Event()
+    heartbeat = threading.Thread(target=_heartbeat,
+                                 args=(path, done, heartbeat_interval))
+    heartbeat.daemon = True
+    heartbeat.start()
+    try:
+        with open(path, 'rb') as fp:
+            fn, args, kwargs = pickle.load(fp)
+        result = (True, fn(*args, **kwargs), None)
+    except Exception as e:
+        tb = traceback.format_exc()
+        log.error('Error in task %s:\n%s', task_id, tb)
+        result = (False, e, tb)
+    finally:
+        done.set()
+
+    try:
+        data = pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+    except Exception:
+        tb = result[2] or traceback.format_exc()
+        data = pickle.dumps((False, RuntimeError(tb), tb),
+                            pickle.HIGHEST_PROTOCOL)
+
+    _write_atomic(os.path.join(queue_dir, RESULTS), task_id + RESULT_SUFFIX,
+                  data)
+    try:
+        os.remove(path)
+    except OSError:
+        pass  # returned to the queue while running
+
+
+def run_worker(queue_dir, idle_timeout=None, max_tasks=None,
+               poll_interval=POLL_INTERVAL):
+    """
+    Run tasks from ``queue_dir`` until ``max_tasks`` have been run or no
+    task has been available for ``idle_timeout`` seconds (forever if
+    neither is given). Returns the number of tasks run.
+    """
+    for d in (TASKS, CLAIMED, RESULTS):
+        _makedirs(os.path.join(queue_dir, d))
+
+    count = 0
+    idle_since = time.time()
+    while max_tasks is None or count < max_tasks:
+        claimed = _claim(queue_dir)
+        if claimed is None:
+            if idle_timeout is not None and \
+                    time.time() - idle_since > idle_timeout:
+                break
+            time.sleep(poll_interval)
+            continue
+        task_id, path = claimed
+        log.info('Running task %s', task_id)
+        run_task(queue_dir, task_id, path)
+        count += 1
+        idle_since = time.time()
+
+    return count
@@ -0,0 +1,313 @@
+"""
+K-mer index of a reference sequence file, used to prefilter similarity
+searches.
+
+The index maps each k-mer to the references containing it (an inverted
+index in compressed sparse row form: ``postings[offsets[k]:offsets[k + 1]]``
+are the references containing k-mer ``k``). Candidate references for a
+query are those sharing the most distinct k-mers with it; only the
+candidates are then searched with vsearch, rather than the whole reference
+file.
+
+An index is saved to a directory of ``.npy`` files, which are
+memory-mapped when loaded, so it can be built once (``deenurp kmer_index``)
+and shared among runs and processes.
+
+``kmer_distances`` estimates distances between sequences from the k-mers
+they share, without aligning them (``filter_outliers --aligner kmer``).
+"""
+
+import json
+import logging
+import os
+import os.path
+
+import numpy as np
+from Bio import SeqIO
+
+from . import seqindex
+
+log = logging.getLogger(__name__)
+
+"""K-mer length, as used by vsearch"""
+KMER_SIZE = 8
+
+"""Longest supported k-mer (the index holds 4 ** k offsets)"""
+MAX_KMER_SIZE = 12
+
+"""Number of candidate references to keep for each query"""
+TOP_K = 32
+
+"""K-mer length for estimating distances (``kmer_distances``)"""
+DISTANCE_KMER_SIZE = 10
+
+"""Distance between sequences sharing no k-mers"""
+MAX_DISTANCE = 1.0
+
+_CODES = np.empty(256, dtype=np.uint8)
+_CODES.fill(255)
+for _i, _c in enumerate('ACGT'):
+    _CODES[ord(_c)] = _CODES[ord(_c.lower())] = _i
+_CODES[ord('U')] = _CODES[ord('u')] = 3
+
+_FILES = ('offsets', 'postings', 'counts')
+
+
+def kmers(sequence, k=KMER_SIZE):
+    """
+    Return the sorted, distinct k-mers in ``sequence`` as integers. K-mers
+    containing gaps or ambiguous bases are skipped.
+    """
+    codes = _CODES[np.frombuffer(str(sequence), dtype=np.uint8)]
+    n = len(codes) - k + 1
+    if n <= 0:
+        return np.empty(0, dtype=np.uint32)
+
+    # windows containing an invalid character
+    invalid = np.concatenate(([0], np.cumsum(codes == 255)))
+    valid = (invalid[k:] - invalid[:-k]) == 0
+
+    values = np.zeros(n, dtype=np.uint32)
+    for j in xrange(k):
+        values <<= 2
+        values |= codes[j:j + n] & 3
+    return np.unique(values[valid])
+
+
+def kmer_distance(shared, total_a, total_b, k=DISTANCE_KMER_SIZE):
+    """
+    Estimate the distance (1 - identity) between sequences with ``total_a``
+    and ``total_b`` distinct k-mers, ``shared`` of them in common. The
+    containment C = shared / min(total_a, total_b) is used rather than
+    the Jaccard index, so that sequences covering different lengths of the
+    gene aren't penalized, like gaps in an alignment; a substitution
+    changes up to k k-mers, so identity is estimated as C ** (1 / k).
+    """
+    shared = np.asarray(shared, dtype=np.float64)
+    smaller = np.minimum(total_a, total_b)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        containment = np.where(smaller > 0, shared / smaller, 0.0)
+    return np.minimum(1 - containment ** (1.0 / k), MAX_DISTANCE)
+
+
+class KmerProfiles(object):
+
+    """
+    The distinct k-mers of each of a list of sequences, for counting the
+    k-mers shared by pairs of sequences. Alignment gaps are removed.
+
+    K-mers found in more than ``common`` (a fraction) of the sequences are
+    held in a dense array, so that shared k-mers are mostly counted by
+    matrix multiplication; the rest are held in a sparse matrix.
+    ``counts`` is the number of distinct k-mers in each sequence.
+    """
+
+    def __init__(self, sequences, k=DISTANCE_KMER_SIZE, common=0.25):
+        import scipy.sparse
+        self.k = k
+        per_seq = [kmers(str(s.seq).replace('-', '').replace('.', ''), k)
+                   for s in sequences]
+        n = len(per_seq)
+        self.counts = np.array([len(i) for i in per_seq], dtype=np.int64)
+        if n and self.counts.sum():
+            values, columns = np.unique(np.concatenate(per_seq),
+                                        return_inverse=True)
+        else:
+            values, columns = [], np.empty(0, dtype=np.int64)
+        matrix = scipy.sparse.csr_matrix(
+            (np.ones(len(columns), dtype=np.float32), columns,
+             np.concatenate(([0], np.cumsum(self.counts)))),
+            shape=(n, len(values)))
+
+        frequency = np.bincount(columns, minlength=len(values))
+        is_common = frequency > common * n
+        self.common = matrix[:, np.flatnonzero(is_common)].toarray()
+        self.rare = matrix[:, np.flatnonzero(~is_common)].tocsr()
+
+    def __len__(self):
+        return len(self.counts)
+
+    def shared(self, rows, cols):
+        """
+        Dense (len(rows), len(cols)) array of the number of k-mers shared
+        by the sequences indexed by ``rows`` and ``cols``
+        """
+        rows, cols = np.asarray(rows), np.asarray(cols)
+        result = np.dot(self.common[rows], self.common[cols].T)
+        result += (self.rare[rows] * self.rare[cols].T).toarray()
+        return result
+
+    def distances(self, rows, cols):
+        """
+        Dense float32 array of ``kmer_distance`` between the sequences
+        indexed by ``rows`` and ``cols``
+        """
+        rows, cols = np.asarray(rows), np.asarray(cols)
+        return kmer_distance(
+            self.shared(rows, cols), self.counts[rows][:, None],
+            self.counts[cols][None, :], self.k).astype(np.float32)
+
+
+def kmer_distances(sequences, k=DISTANCE_KMER_SIZE, chunk=1 << 22):
+    """
+    Return (names, DistanceMatrix) of distances between ``sequences``
+    (SeqRecords) estimated from the k-mers they share (see
+    ``kmer_distance``). Distances are calculated in blocks of rows of
+    about ``chunk`` values.
+    """
+    from .outliers import DistanceMatrix
+    sequences = list(sequences)
+    n = len(sequences)
+    profiles = KmerProfiles(sequences, k)
+    result = DistanceMatrix.empty(n)
+    step = max(1, chunk // max(n, 1))
+    start = 0
+    for first in xrange(0, n, step):
+        rows = np.arange(first, min(first + step, n))
+        block = profiles.distances(rows, np.arange(first, n))
+        values = block[np.arange(first, n)[None, :] > rows[:, None]]
+        result.data[start:start + len(values)] = values
+        start += len(values)
+    return [s.id for s in sequences], result
+
+
+def _signature(sequence_file):
+    st = os.stat(sequence_file)
+    return {'size': st.st_size, 'mtime': st.st_mtime}
+
+
+class KmerIndex(object):
+
+    """
+    Inverted k-mer index of the sequences in a FASTA file.
+
+    ``names`` lists the reference names in file order, ``counts`` the number
+    of distinct k-mers in each reference.
+    """
+
+    def __init__(self, names, offsets, postings, counts, k=KMER_SIZE,
+                 source=None):
+        self.names = names
+        self.offsets = offsets
+        self.postings = postings
+        self.counts = counts
+        self.k = k
+        self.source = source
+
+    @classmethod
+    def build(cls, sequence_file, k=KMER_SIZE):
+        """
+        Index the sequences in ``sequence_file`` (FASTA)
+        """
+        if not 0 < k <= MAX_KMER_SIZE:
+            raise ValueError('k must be between 1 and {}'.format(MAX_KMER_SIZE))
+        names, per_ref = [], []
+        for seq in SeqIO.parse(sequence_file, 'fasta'):
+            names.append(seq.id)
+            per_ref.append(kmers(seq.seq, k))
+        log.info('Indexed %d sequences from %s', len(names), sequence_file)
+
+        counts = np.array([len(i) for i in per_ref], dtype=np.uint32)
+        all_kmers = np.concatenate(per_ref) if per_ref else \
+            np.empty(0, dtype=np.uint32)
+        refs = np.repeat(np.arange(len(names), dtype=np.uint32), counts)
+        del per_ref
+
+        # stable, so postings for each k-mer are in reference order
+        order = np.argsort(all_kmers, kind='mergesort')
+        postings = refs[order]
+        offsets = np.zeros(4 ** k + 1, dtype=np.int64)
+        np.cumsum(np.bincount(all_kmers, minlength=4 ** k),
+                  out=offsets[1:])
+
+        source = dict(_signature(sequence_file),
+                      path=os.path.abspath(sequence_file))
+        return cls(names, offsets, postings, counts, k=k, source=source)
+
+    def save(self, directory):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        for name in _FILES:
+            np.save(os.path.join(directory, name + '.npy'),
+                    getattr(self, name))
+        with open(os.path.join(directory, 'names.txt'), 'w') as fp:
+            for name in self.names:
+                fp.write(name + '\n')
+        with open(os.path.join(directory, 'index.json'), 'w') as fp:
+            json.dump({'k': self.k, 'source': self.source}, fp, indent=2)
+
+    @classmethod
+    def load(cls, directory, mmap=True):
+        """
+        Load an index saved with ``save``, memory-mapping the arrays unless
+        ``mmap`` is False.
+        """
+        with open(os.path.join(directory, 'index.json')) as fp:
+            meta = json.load(fp)
+        with open(os.path.join(directory, 'names.txt')) as fp:
+            names = [line.rstrip('\n') for line in fp]
+        arrays = [np.load(os.path.join(directory, name + '.npy'),
+                          mmap_mode='r' if mmap else None)
+                  for name in _FILES]
+        return cls(names, *arrays, k=meta['k'], source=meta['source'])
+
+    def is_current(self, sequence_file):
+        """
+        Returns whether the index describes the current contents of
+        ``sequence_file``
+        """
+        if not self.source:
+            return False
+        sig = _signature(sequence_file)
+        return (self.source['size'], self.source['mtime']) == \
+            (sig['size'], sig['mtime'])
+
+    def query(self, sequence, top_k=TOP_K):
+        """
+        Return (reference_index, shared_kmers) arrays for the ``top_k``
+        references sharing the most distinct k-mers with ``sequence``, best
+        first.
+        """
+        q = kmers(sequence, self.k)
+        hits = np.concatenate(
+            [self.postings[self.offsets[i]:self.offsets[i + 1]] for i in q] or
+            [np.empty(0, dtype=np.uint32)])
+        refs, shared = np.unique(hits, return_counts=True)
+        if len(refs) > top_k:
+            keep = np.argpartition(-shared, top_k - 1)[:top_k]
+            refs, shared = refs[keep], shared[keep]
+        order = np.lexsort((refs, -shared))
+        return refs[order], shared[order]
+
+    def candidates(self, sequences, top_k=TOP_K):
+        """
+        Return the names of the union of the ``top_k`` candidate references
+        for each of ``sequences``, in reference file order.
+        """
+        refs = set()
+        for seq in sequences:
+            refs.update(self.query(seq.seq, top_k)[0].tolist())
+        return [self.names[i] for i in sorted(refs)]
+
+
+def open_index(directory, sequence_file):
+    """
+    Load the index in ``directory``, which must describe ``sequence_file``
+    """
+    index = KmerIndex.load(directory)
+    if not index.is_current(sequence_file):
+        raise ValueError('k-mer index {} is out of date for {}; '
+                         'rebuild it with "deenurp kmer_index"'.format(
+                             directory, sequence_file))
+    return index
+
+
+def write_candidates(index, queries, sequence_file, output_fp, top_k=TOP_K):
+    """
+    Write the candidate references from ``sequence_file`` for ``queries``
+    (SeqRecords) to ``output_fp`` in FASTA format, returning the number of
+    candidates.
+    """
+    names = index.candidates(queries, top_k=top_k)
+    log.info('%d candidate references from %s', len(names), sequence_file)
+    return seqindex.open_index(sequence_file).write_fasta(names, output_fp)
@@ -2,6 +2,7 @@
 Identify mislabeled sequence records.
 """
 
+import itertools
 import os
 import logging
 import subprocess
@@ -10,61 +11,475 @@ import tempfile
 import numpy as np
 import pandas as pd
 
+from concurrent import futures
+
 import scipy
 import scipy.cluster
 
 import hdbscan
 
+from . import scratch
+
 log = logging
 
+"""Number of distances parsed or expanded at a time"""
+READ_CHUNK = 1 << 22
+
+"""Condensed distance matrices larger than this are memory-mapped"""
+MMAP_BYTES = 1 << 30
+
+"""Largest Jukes-Cantor distance, as reported by FastTree"""
+MAX_JC_DISTANCE = 3.0
+
+"""Distance models for ``AlignmentProfiles``"""
+P_DISTANCE = 'p'
+JUKES_CANTOR = 'jc'
+
+"""Size of the random subsample used by ``sampled_medoid``"""
+MEDOID_SAMPLE_SIZE = 200
+
+"""Number of medoid candidates compared with all elements"""
+MEDOID_CANDIDATES = 5
+
+"""Methods of embedding a distance matrix in two dimensions (see ``embed``)"""
+EMBEDDINGS = ('none', 'classical', 'smacof', 'landmark')
+
+"""Number of landmarks used by landmark MDS"""
+LANDMARKS = 500
+
+"""Largest matrix embedded using a dense eigendecomposition"""
+DENSE_EIGH = 500
+
+# nucleotide codes 0-3; gaps, ambiguity codes and anything else are 4
+_NT_CODES = np.empty(256, dtype=np.uint8)
+_NT_CODES.fill(4)
+for _i, _c in enumerate('ACGT'):
+    _NT_CODES[ord(_c)] = _NT_CODES[ord(_c.lower())] = _i
+_NT_CODES[ord('U')] = _NT_CODES[ord('u')] = 3
+
+_WHITESPACE = np.zeros(256, dtype=bool)
+_WHITESPACE[[ord(c) for c in ' \t\r\n']] = True
+
 
-def read_dists(fobj):
+def _parse_fixed(text, count, dtype):
+    """
+    Parse ``count`` values from ``text`` if each is written as ``%f`` with
+    a single integer digit (as FastTree writes distances below 10) followed
+    by one whitespace character; otherwise return None.
+
+    The digits are combined as integers, then divided by 10 ** 6, which
+    gives the same, correctly rounded, result as ``float()``.
+    """
+    width = 9  # d.dddddd plus separator
+    if len(text) != count * width:
+        return None
+    cells = np.frombuffer(text, dtype=np.uint8).reshape(count, width)
+    if (cells[:, 1] != ord('.')).any() or \
+            not _WHITESPACE[cells[:, width - 1]].all():
+        return None
+
+    micros = np.zeros(count, dtype=np.int32)
+    for col, place in zip([0, 2, 3, 4, 5, 6, 7], [10 ** 6, 10 ** 5, 10 ** 4,
+                                                  1000, 100, 10, 1]):
+        digit = cells[:, col] - np.uint8(ord('0'))
+        if digit.max() > 9:
+            return None
+        micros += digit.astype(np.int32) * place
+    return (micros / 1e6).astype(dtype, copy=False)
+
+
+def _read_rows(fobj, N, dtype):
+    """
+    Parse the rows of a phylip distance matrix with ``N`` taxa from
+    ``fobj`` in blocks of about ``READ_CHUNK`` values, yielding (first row,
+    taxon names, block of rows).
+    """
+    block = max(1, READ_CHUNK // max(N, 1))
+    row = 0
+    while row < N:
+        lines = list(itertools.islice(fobj, min(block, N - row)))
+        if not lines:
+            break
+        names, values = zip(*(line.split(None, 1) for line in lines))
+        values = ''.join(values)
+        parsed = _parse_fixed(values, len(lines) * N, dtype)
+        if parsed is None:
+            parsed = np.fromstring(values, dtype=dtype, sep=' ')
+        values = parsed
+        if values.size != len(lines) * N:
+            raise ValueError('expected {} distances in each of rows {}-{}'
+                             .format(N, row + 1, row + len(lines)))
+        yield row, names, values.reshape(len(lines), N)
+        row += len(lines)
+
+    if row != N:
+        raise ValueError('expected {} rows, found {}'.format(N, row))
+
+
+def read_dists(fobj, dtype=np.float64):
     """
     Read interleaved phylip distance matrix from file-like object fobj
-    into a numpy matrix. Return (taxon_names, matrix).
+    into a numpy matrix of ``dtype``. Return (taxon_names, matrix).
+
+    Rows are parsed in blocks of about ``READ_CHUNK`` values, so ``fobj``
+    may be a pipe.
     """
 
     N = int(fobj.readline())
-    distmat = np.repeat(-1 * np.inf, N ** 2)
-    distmat.shape = (N, N)
+    distmat = np.empty((N, N), dtype=dtype)
 
     taxa = []
-    for row, line in enumerate(fobj):
-        spl = line.split()
-        assert len(spl) == N + 1
-        taxa.append(spl.pop(0))
-        distmat[row, :] = map(float, spl)
+    for row, names, values in _read_rows(fobj, N, dtype):
+        distmat[row:row + len(names)] = values
+        taxa.extend(names)
 
     return taxa, distmat
 
 
-def fasttree_dists(fasta):
+def read_condensed(fobj, dtype=np.float32, mmap=None):
+    """
+    Read a phylip distance matrix like ``read_dists``, keeping only the
+    upper triangle. Return (taxon_names, DistanceMatrix).
+    """
+
+    N = int(fobj.readline())
+    distmat = DistanceMatrix.empty(N, dtype=dtype, mmap=mmap)
+
+    taxa = []
+    for row, names, values in _read_rows(fobj, N, dtype):
+        # the upper triangle of consecutive rows is contiguous
+        upper = np.arange(N) > np.arange(row, row + len(names))[:, None]
+        start = distmat.index(row, row + 1) if row + 1 < N else 0
+        distmat.data[start:start + upper.sum()] = values[upper]
+        taxa.extend(names)
+
+    return taxa, distmat
+
+
+def fasttree_dists(fasta, dtype=np.float32, condensed=False):
     """
     Calculate pairwise distances among DNA multiple alignment in
-    `fasta` using FastTree and return (taxon_names, matrix).
+    `fasta` using FastTree and return (taxon_names, matrix), with the
+    matrix as ``dtype``: a square array, or a ``DistanceMatrix`` if
+    ``condensed`` is True.
     """
 
     # TODO: need a more informative error if FastTree is not installed.
 
     cmd = ['FastTree', '-nt', '-makematrix', fasta]
-
-    with tempfile.TemporaryFile('rw') as stdout, open(os.devnull) as devnull:
-        proc = subprocess.Popen(cmd, stdout=stdout, stderr=devnull)
-        proc.communicate()
-        stdout.flush()
-        stdout.seek(0)
-        taxa, distmat = read_dists(stdout)
+    read = read_condensed if condensed else read_dists
+
+    with open(os.devnull, 'w') as devnull:
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=devnull,
+                                bufsize=1 << 20)
+        try:
+            taxa, distmat = read(proc.stdout, dtype=dtype)
+        except ValueError:
+            proc.stdout.close()
+            if proc.wait():  # report the failure of FastTree instead
+                raise subprocess.CalledProcessError(proc.returncode, cmd)
+            raise
+        proc.stdout.close()
+        if proc.wait():
+            raise subprocess.CalledProcessError(proc.returncode, cmd)
 
     return taxa, distmat
 
 
+def _unique_columns(X):
+    """
+    Return (unique columns of 2d array ``X``, number of copies of each)
+    """
+    if not X.shape[1]:
+        return X, np.empty(0, dtype=np.int64)
+    if not X.shape[0]:
+        return X[:, :1], np.array([X.shape[1]], dtype=np.int64)
+    # view each column as a single opaque value (np.unique only gained
+    # ``axis`` in numpy 1.13); byte order matches lexicographic order
+    columns = np.ascontiguousarray(X.T)
+    rows = columns.view(
+        np.dtype((np.void, columns.dtype.itemsize * columns.shape[1])))
+    _, index, counts = np.unique(rows.ravel(), return_index=True,
+                                 return_counts=True)
+    return columns[index].T, counts
+
+
+class AlignmentProfiles(object):
+
+    """
+    Aligned nucleotide sequences encoded as a uint8 matrix, for counting
+    for each pair of sequences the ``overlap`` (positions where both have
+    a nucleotide) and the ``differences`` among them. Gaps and ambiguity
+    codes are ignored, and case and U/T differences are not counted,
+    which matches ``FastTree -nt``.
+
+    Identical alignment columns are counted once, with a weight, and
+    columns without variation among the sequences only contribute to the
+    overlap, so the counts are mostly products of small matrices.
+    """
+
+    def __init__(self, records):
+        records = list(records)
+        self.names = [r.id for r in records]
+        lengths = set(len(r.seq) for r in records)
+        if len(lengths) > 1:
+            raise ValueError('sequences are not aligned')
+        length = lengths.pop() if lengths else 0
+        codes = np.empty((len(records), length), dtype=np.uint8)
+        for i, r in enumerate(records):
+            codes[i] = _NT_CODES[np.frombuffer(str(r.seq), dtype=np.uint8)]
+        self.codes = codes
+
+        valid = codes < 4
+        patterns, weights = _unique_columns(valid)
+        self._valid = patterns.astype(np.float32)
+        self._valid_weights = weights.astype(np.float32)
+
+        with np.errstate(invalid='ignore'):
+            lo = np.where(valid, codes, 4).min(axis=0)
+            hi = np.where(valid, codes, 0).max(axis=0)
+        variable, weights = _unique_columns(codes[:, lo < hi])
+        # one-hot nucleotides (H), and the other nucleotides at valid
+        # positions (G): differences are H * G'
+        onehot = variable[:, :, None] == np.arange(4, dtype=np.uint8)
+        self._onehot = onehot.reshape(len(codes), -1).astype(np.float32)
+        other = (variable < 4)[:, :, None] & ~onehot
+        self._other = other.reshape(len(codes), -1).astype(np.float32)
+        self._other *= np.repeat(weights, 4).astype(np.float32)
+
+    def __len__(self):
+        return len(self.names)
+
+    def counts(self, rows, cols):
+        """
+        Return (overlap, differences) arrays of shape (len(rows),
+        len(cols)) for the sequences indexed by ``rows`` and ``cols``
+        """
+        rows, cols = np.asarray(rows), np.asarray(cols)
+        overlap = np.dot(self._valid[rows] * self._valid_weights,
+                         self._valid[cols].T)
+        differences = np.dot(self._onehot[rows], self._other[cols].T)
+        return overlap, differences
+
+    def distances(self, rows, cols, model=JUKES_CANTOR):
+        """
+        Dense float32 array of distances between the sequences indexed by
+        ``rows`` and ``cols``: the proportion of differences (``model='p'``)
+        or the Jukes-Cantor distance (``'jc'``), at most
+        ``MAX_JC_DISTANCE``. Pairs without overlap are at the maximum
+        distance (1 for p-distances).
+        """
+        assert model in {P_DISTANCE, JUKES_CANTOR}, 'invalid model: ' + model
+        overlap, differences = self.counts(rows, cols)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            p = np.where(overlap > 0, differences / overlap, 1.0)
+            if model == P_DISTANCE:
+                return p.astype(np.float32)
+            d = -0.75 * np.log(1 - p * (4.0 / 3))
+        d[~(p < 0.75)] = MAX_JC_DISTANCE
+        return np.minimum(d, MAX_JC_DISTANCE).astype(np.float32)
+
+
+def alignment_dists(records, model=JUKES_CANTOR, threads=1, mmap=None):
+    """
+    Calculate pairwise distances among aligned nucleotide sequences
+    ``records`` (SeqRecords) in-process with ``AlignmentProfiles``,
+    returning (taxon_names, DistanceMatrix). With the default Jukes-Cantor
+    model the distances are the same as those of ``fasttree_dists``.
+
+    Blocks of about ``READ_CHUNK`` distances are calculated by ``threads``
+    threads.
+    """
+    profiles = AlignmentProfiles(records)
+    n = len(profiles)
+    distmat = DistanceMatrix.empty(n, mmap=mmap)
+    step = max(1, READ_CHUNK // max(n, 1))
+
+    def fill(first):
+        rows = np.arange(first, min(first + step, n))
+        cols = np.arange(first + 1, n)
+        block = profiles.distances(rows, cols, model)
+        start = distmat.index(first, first + 1) if first + 1 < n else 0
+        # rows are consecutive, so their upper triangles are contiguous
+        upper = cols[None, :] > rows[:, None]
+        values = block[upper]
+        distmat.data[start:start + len(values)] = values
+
+    starts = xrange(0, n, step)
+    if threads > 1:
+        with futures.ThreadPoolExecutor(threads) as executor:
+            list(executor.map(fill, starts))
+    else:
+        for first in starts:
+            fill(first)
+
+    return profiles.names, distmat
+
+
+class DistanceMatrix(object):
+
+    """
+    Symmetric distance matrix among ``n`` elements with a zero diagonal,
+    stored as its condensed upper triangle (the ordering used by
+    ``scipy.spatial.distance``): ``data`` holds n * (n - 1) / 2 values,
+    and may be a memory-mapped array.
+
+    ``X[i, j]`` is a single distance and ``X[i, :]`` a row. Medoids,
+    submatrices and hierarchical clustering are computed from the
+    condensed form; ``square`` expands to a dense array for methods that
+    require one.
+    """
+
+    def __init__(self, n, data):
+        if len(data) != n * (n - 1) // 2:
+            raise ValueError('{} values for a condensed matrix of size {}'
+                             .format(len(data), n))
+        self.n = n
+        self.data = data
+
+    @classmethod
+    def empty(cls, n, dtype=np.float32, mmap=None):
+        """
+        A matrix of size ``n`` filled with zeros. If ``mmap`` is True, or
+        None and the matrix is larger than ``MMAP_BYTES``, the values are
+        stored in a memory-mapped temporary file.
+        """
+        size = n * (n - 1) // 2
+        nbytes = size * np.dtype(dtype).itemsize
+        if mmap is None:
+            mmap = nbytes > MMAP_BYTES
+        if mmap and size:
+            directory = scratch.default().acquire(nbytes)
+            # removed when closed; the mapping remains valid
+            with tempfile.TemporaryFile(dir=directory,
+                                        prefix='distmat-') as fp:
+                data = np.memmap(fp, dtype=dtype, mode='w+', shape=(size,))
+        else:
+            data = np.zeros(size, dtype=dtype)
+        return cls(n, data)
+
+    @classmethod
+    def from_square(cls, X, dtype=np.float32):
+        """
+        Condense square matrix ``X``, using values above the diagonal.
+        """
+        n, m = X.shape
+        assert n == m, 'X must be a square matrix'
+        return cls(n, X[np.triu_indices(n, 1)].astype(dtype))
+
+    @property
+    def shape(self):
+        return (self.n, self.n)
+
+    def __len__(self):
+        return self.n
+
+    def index(self, i, j):
+        """
+        Position of element (i, j), i < j, in ``data``; i and j may be
+        arrays.
+        """
+        i = np.asarray(i, dtype=np.int64)
+        j = np.asarray(j, dtype=np.int64)
+        return self.n * i - i * (i + 1) // 2 + j - i - 1
+
+    def block(self, rows, cols):
+        """
+        Dense (len(rows), len(cols)) array of distances between elements
+        ``rows`` and ``cols`` (arrays of indices)
+        """
+        rows = np.asarray(rows, dtype=np.int64)[:, None]
+        cols = np.asarray(cols, dtype=np.int64)[None, :]
+        lo, hi = np.minimum(rows, cols), np.maximum(rows, cols)
+        diagonal = lo == hi
+        # a copy (indexing a read-only memmap gives a read-only memmap)
+        values = np.asarray(self.data)[
+            np.where(diagonal, 0, self.index(lo, hi))]
+        values[diagonal] = 0
+        return values
+
+    def row(self, i):
+        return self.block([i], np.arange(self.n))[0]
+
+    def __getitem__(self, key):
+        i, j = key
+        if isinstance(j, slice) and j == slice(None):
+            return self.row(i)
+        if i == j:
+            return self.data.dtype.type(0)
+        return self.data[self.index(min(i, j), max(i, j))]
+
+    def _row_blocks(self, indices):
+        """
+        Yield (rows, dense block) for the rows and columns ``indices``, in
+        blocks of about ``READ_CHUNK`` values
+        """
+        step = max(1, READ_CHUNK // max(len(indices), 1))
+        for start in xrange(0, len(indices), step):
+            rows = indices[start:start + step]
+            yield rows, self.block(rows, indices)
+
+    def medoid(self, ii=None):
+        """
+        Index of the element with the smallest median distance to the
+        others, ignoring NaN, among the elements selected by boolean
+        vector ``ii`` (all if None).
+        """
+        if ii is None:
+            indices = np.arange(self.n)
+        else:
+            assert ii.shape[0] == self.n, \
+                'ii must be the length of the margin of X'
+            indices = np.flatnonzero(ii)
+
+        median = np.nanmedian if np.isnan(self.data).any() else np.median
+        medians = np.concatenate(
+            [median(block, axis=1) for _, block in self._row_blocks(indices)])
+        return indices[np.argmin(medians)]
+
+    def submatrix(self, ii):
+        """
+        Matrix among the elements selected by ``ii``, a boolean vector or
+        an array of indices
+        """
+        ii = np.asarray(ii)
+        indices = np.flatnonzero(ii) if ii.dtype == bool else ii
+        k = len(indices)
+        sub = DistanceMatrix.empty(k, dtype=self.data.dtype)
+        # rows of the submatrix are consecutive, so their upper triangles
+        # are contiguous in ``sub.data``
+        start = 0
+        first = 0
+        for rows, block in self._row_blocks(indices):
+            upper = np.arange(k) > np.arange(first, first + len(rows))[:, None]
+            count = upper.sum()
+            sub.data[start:start + count] = block[upper]
+            start += count
+            first += len(rows)
+        return sub
+
+    def square(self, dtype=None):
+        """
+        Dense square array of distances
+        """
+        return scipy.spatial.distance.squareform(
+            self.data.astype(dtype or self.data.dtype, copy=False),
+            checks=False)
+
+    def condensed(self):
+        return self.data
+
+
 def find_medoid(X, ii=None):
-    """Return the index of the medoid of square numpy matrix ``X`` of
-    shape (n, n). ``ii`` is an optional boolean vector of length n
-    defining a submatrix of ``X``.
+    """Return the index of the medoid of square numpy matrix (or
+    ``DistanceMatrix``) ``X`` of shape (n, n). ``ii`` is an optional
+    boolean vector of length n defining a submatrix of ``X``.
 
     """
 
+    if isinstance(X, DistanceMatrix):
+        return X.medoid(ii)
+
     n, m = X.shape
     assert n == m, 'X must be a square matrix'
 
@@ -78,6 +493,43 @@ def find_medoid(X, ii=None):
     return medoid
 
 
+def sampled_medoid(distances, n, sample_size=MEDOID_SAMPLE_SIZE,
+                   n_candidates=MEDOID_CANDIDATES, random_state=None):
+    """Approximate the medoid of ``n`` elements without computing all
+    pairwise distances. ``distances(rows, cols)`` must return a dense
+    array of the distances between the elements indexed by arrays
+    ``rows`` and ``cols``.
+
+    The ``n_candidates`` elements with the smallest median distance
+    within a random subsample of ``sample_size`` elements are compared
+    with every element, and the candidate with the smallest median
+    distance is chosen, using O(sample_size ** 2 + n * n_candidates)
+    distances. NaN distances are ignored.
+
+    Returns (medoid, dists), where ``dists`` is the vector of distances
+    from the medoid to each element.
+
+    """
+
+    rng = np.random.RandomState(random_state)
+    if n <= sample_size:
+        sample = np.arange(n)
+    else:
+        sample = np.sort(rng.choice(n, sample_size, replace=False))
+
+    within = distances(sample, sample)
+    medians = np.nanmedian(within, axis=1)
+    if len(sample) == n:
+        # the sample is everything: this is the exact medoid
+        best = np.argmin(medians)
+        return sample[best], within[best]
+
+    candidates = sample[np.argsort(medians, kind='mergesort')[:n_candidates]]
+    rows = distances(candidates, np.arange(n))
+    best = np.argmin(np.nanmedian(rows, axis=1))
+    return candidates[best], rows[best]
+
+
 def all_ok(distmat):
     medoid = np.nan
     dists = np.repeat(np.nan, distmat.shape[0])
@@ -98,6 +550,14 @@ def outliers(distmat, radius):
 
     """
 
+    if isinstance(distmat, DistanceMatrix):
+        # nan are ignored when finding the medoid
+        medoid = distmat.medoid()
+        dists = distmat.row(medoid)
+        with np.errstate(invalid='ignore'):
+            to_prune = dists > radius
+        return medoid, dists, to_prune
+
     # use a masked array in case there are any nan
     ma = np.ma.masked_array(distmat, np.isnan(distmat))
 
@@ -113,7 +573,8 @@ def outliers(distmat, radius):
 
 def outliers_by_cluster(distmat, t, D, min_size=1, cluster_type='single', **kwargs):
     """Detect outliers by 1) performing hierarchical clustering based on
-    distances in ``distmat`` (a square numpy matrix) with distance
+    distances in ``distmat`` (a square numpy matrix or
+    ``DistanceMatrix``) with distance
     threshold ``t`` and discarding clusters with fewer than
     ``min_size`` members; then 2) discarding clusters whose medoids
     have a distance greater than ``t * D`` from the medoid of the
@@ -188,7 +649,10 @@ def scipy_cluster(X, module, t, **kwargs):
 
     # requires 'import scipy.cluster'
     fun = getattr(scipy.cluster.hierarchy, module)
-    y = scipy.spatial.distance.squareform(X)
+    if isinstance(X, DistanceMatrix):
+        y = X.condensed()
+    else:
+        y = scipy.spatial.distance.squareform(X)
     Z = fun(y)
     clusters = scipy.cluster.hierarchy.fcluster(Z, t, **args)
     title = 'scipy.cluster.hierarchy.{} {}'.format(
@@ -207,13 +671,16 @@ def hdbscan_cluster(X, module, **kwargs):
     clusterer = fun(metric='precomputed', **kwargs)
 
     title = ' '.join(str(clusterer).split())
+    if isinstance(X, DistanceMatrix):
+        X = X.square(np.float64)
     clusters = clusterer.fit_predict(X)
 
     return clusters, title
 
 
 def find_cluster_medoids(X, clusters):
-    """Inputs are ``X``, a square distance matrix, and ``clusters``, a
+    """Inputs are ``X``, a square distance matrix (or
+    ``DistanceMatrix``), and ``clusters``, a
     1-dimensional array assigning each element in ``X`` to a
     cluster. Returns a pandas DataFrame with rows corresponding to
     clusters (sorted by size, descending) with columns 'cluster',
@@ -223,7 +690,7 @@ def find_cluster_medoids(X, clusters):
 
     """
 
-    assert isinstance(X, np.ndarray)
+    assert isinstance(X, (np.ndarray, DistanceMatrix))
     n, m = X.shape
     assert n == m, '`X` must be a square matrix'
     assert isinstance(clusters, np.ndarray), '`clusters` must be a numpy ndarray'
@@ -287,7 +754,17 @@ def scaled_radius(X, percentile, min_radius=0.0, max_radius=None):
 
     """
 
-    radius = np.percentile(X[find_medoid(X), :], percentile)
+    return bounded_percentile(
+        X[find_medoid(X), :], percentile, min_radius, max_radius)
+
+
+def bounded_percentile(dists, percentile, min_radius=0.0, max_radius=None):
+    """Return the value at ``percentile`` of distances ``dists``, within
+    the bounds ``min_radius`` and ``max_radius``.
+
+    """
+
+    radius = np.nanpercentile(dists, percentile)
     log.info('calculated cutoff: {}'.format(radius))
     if radius < min_radius:
         radius = min_radius
@@ -301,9 +778,9 @@ def scaled_radius(X, percentile, min_radius=0.0, max_radius=None):
 
 def mds(X, taxa, n_jobs=1):
     """Perform multidimensional scaling using ``sklearn.manifold`` given
-    square distance matrix ``X``. Return a DataFrame with columns
-    'seqname', 'x', 'y' in which 'seqname' contains the names provided
-    in `taxa`.
+    square distance matrix (or ``DistanceMatrix``) ``X``. Return a
+    DataFrame with columns 'seqname', 'x', 'y' in which 'seqname'
+    contains the names provided in `taxa`.
 
     """
 
@@ -316,6 +793,9 @@ def mds(X, taxa, n_jobs=1):
         random_state=12345,
         n_jobs=n_jobs)
 
+    if isinstance(X, DistanceMatrix):
+        X = X.square(np.float64)
+
     if np.all(X == 0):
         df = pd.DataFrame.from_items([
             ('seqname', taxa),
@@ -330,3 +810,129 @@ def mds(X, taxa, n_jobs=1):
 
     assert X.shape[0] == df.shape[0]
     return df
+
+
+def _double_center(D2):
+    """Return -0.5 * J * D2 * J, where J is the centering matrix"""
+    B = D2 - D2.mean(axis=0)[None, :]
+    B -= B.mean(axis=1)[:, None]
+    B *= -0.5
+    return B
+
+
+def _top_eigenvectors(B, k):
+    """Return (eigenvalues, eigenvectors) for the ``k`` largest eigenvalues
+    of symmetric matrix ``B``, largest first. Negative eigenvalues are set
+    to zero, and the sign of each eigenvector is fixed so that its largest
+    component is positive.
+
+    """
+
+    n = B.shape[0]
+    k = min(k, n)
+    if n > DENSE_EIGH:
+        # Lanczos iteration, much faster than a dense decomposition
+        from scipy.sparse.linalg import eigsh
+        v0 = np.random.RandomState(12345).uniform(size=n)
+        w, v = eigsh(B, k=k, which='LA', v0=v0)
+    else:
+        import scipy.linalg
+        w, v = scipy.linalg.eigh(B, eigvals=(n - k, n - 1))
+    order = np.argsort(w)[::-1]
+    w, v = np.maximum(w[order], 0), v[:, order]
+    signs = np.sign(v[np.argmax(np.abs(v), axis=0), np.arange(k)])
+    signs[signs == 0] = 1
+    return w, v * signs
+
+
+def classical_mds(X, k=2):
+    """Classical (Torgerson) MDS of square distance matrix (or
+    ``DistanceMatrix``) ``X`` into ``k`` dimensions, from the top ``k``
+    eigenvectors of the double-centered squared distances. Returns an
+    array of shape (n, k).
+
+    """
+
+    if isinstance(X, DistanceMatrix):
+        X = X.square(np.float64)
+    w, v = _top_eigenvectors(_double_center(np.square(X, dtype=np.float64)), k)
+    return v * np.sqrt(w)
+
+
+def maxmin_landmarks(X, n_landmarks, random_state=12345):
+    """Choose ``n_landmarks`` elements of distance matrix (or
+    ``DistanceMatrix``) ``X`` by MaxMin selection: starting from a random
+    element, repeatedly add the element farthest from all those chosen,
+    so that outlying elements are represented. Returns (landmarks,
+    distances), where ``distances`` has shape (n, n_landmarks).
+
+    """
+
+    n = X.shape[0]
+    rng = np.random.RandomState(random_state)
+    landmarks = np.empty(n_landmarks, dtype=np.int64)
+    distances = np.empty((n, n_landmarks), dtype=np.float64)
+    nearest = np.full(n, np.inf)
+    landmarks[0] = rng.randint(n)
+    for i in xrange(n_landmarks):
+        if i:
+            landmarks[i] = np.argmax(nearest)
+        distances[:, i] = X[landmarks[i], :]
+        # nan distances don't make an element look distant
+        np.fmin(nearest, distances[:, i], out=nearest)
+        nearest[landmarks[:i + 1]] = -np.inf
+    return landmarks, distances
+
+
+def landmark_mds(X, k=2, n_landmarks=LANDMARKS, random_state=12345):
+    """Landmark MDS (de Silva and Tenenbaum, 2004) of distance matrix (or
+    ``DistanceMatrix``) ``X``: classical MDS of ``n_landmarks`` elements
+    chosen with ``maxmin_landmarks``, with every element then placed by
+    its distances to the landmarks. Uses O(n * n_landmarks) distances and
+    memory. Returns an array of shape (n, k).
+
+    """
+
+    n = X.shape[0]
+    if n <= n_landmarks:
+        return classical_mds(X, k)
+
+    landmarks, to_landmarks = maxmin_landmarks(X, n_landmarks, random_state)
+    to_landmarks = np.square(to_landmarks)
+
+    D2 = to_landmarks[landmarks]
+    w, v = _top_eigenvectors(_double_center(D2), k)
+    with np.errstate(divide='ignore'):
+        scale = np.where(w > 0, 1 / np.sqrt(w), 0)
+    return -0.5 * np.dot(to_landmarks - D2.mean(axis=0), v * scale)
+
+
+def embed(X, taxa, method='smacof', n_landmarks=LANDMARKS, n_jobs=1):
+    """Embed distance matrix (or ``DistanceMatrix``) ``X`` in two
+    dimensions using ``method`` (one of ``EMBEDDINGS``), returning a
+    DataFrame with columns 'seqname', 'x', 'y' like ``mds``. With
+    ``method='none'`` x and y are NaN.
+
+    """
+
+    assert method in EMBEDDINGS, 'invalid embedding: ' + method
+
+    n = len(taxa)
+    if method == 'smacof':
+        return mds(X, taxa, n_jobs=n_jobs)
+    elif method == 'none':
+        coords = np.full((n, 2), np.nan)
+    elif method == 'classical':
+        coords = classical_mds(X)
+    elif method == 'landmark':
+        coords = landmark_mds(X, n_landmarks=n_landmarks)
+
+    if coords.shape[1] < 2:
+        # a single element
+        coords = np.hstack([coords, np.zeros((n, 2 - coords.shape[1]))])
+
+    return pd.DataFrame.from_items([
+        ('seqname', taxa),
+        ('x', coords[:, 0]),
+        ('y', coords[:, 1])
+    ])
@@ -0,0 +1,288 @@
+"""
+Progress, throughput and timing metrics.
+
+* ``Progress`` counts items processed by a long-running loop, reporting the
+  count, rate (items and bytes per second) and estimated time remaining to
+  stderr.
+* ``stage`` times a named step; the total time and number of calls for each
+  stage name are accumulated.
+* ``increment`` updates named counters.
+
+If a metrics file is configured (global ``--metrics`` option or
+``$DEENURP_METRICS``), each of these is also written to it as a JSON object
+per line, with a final ``summary`` record of all counters, stage timers and
+lookup cache statistics, so that throughput can be compared between runs
+and releases.
+"""
+
+import atexit
+import collections
+import contextlib
+import json
+import logging
+import os
+import stat
+import sys
+import threading
+import time
+
+from . import util
+
+log = logging.getLogger(__name__)
+
+ENV_METRICS = 'DEENURP_METRICS'
+
+"""Seconds between progress lines written to stderr"""
+REPORT_EVERY = 0.3
+
+"""Seconds between progress records written to the metrics file"""
+METRICS_EVERY = 10.0
+
+_lock = threading.Lock()
+_metrics_fp = None
+_counters = collections.OrderedDict()
+_stages = collections.OrderedDict()  # name -> [calls, seconds]
+
+
+def configure(path, **fields):
+    """
+    Write metrics to ``path`` (appending), starting with a ``start`` record
+    including ``fields``. A ``summary`` record is written at exit.
+    """
+    global _metrics_fp
+    with _lock:
+        _metrics_fp = util.file_opener('a', buffering=1)(path)
+    emit('start', argv=sys.argv[1:], pid=os.getpid(), **fields)
+    atexit.register(emit_summary)
+
+
+def emit(event, **fields):
+    """
+    Write a record for ``event`` to the metrics file, if one is configured
+    """
+    if _metrics_fp is None:
+        return
+    record = collections.OrderedDict([('time', round(time.time(), 3)),
+                                      ('event', event)])
+    record.update(sorted(fields.items()))
+    line = json.dumps(record) + '\n'
+    with _lock:
+        _metrics_fp.write(line)
+        _metrics_fp.flush()
+
+
+def increment(name, n=1):
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+
+
+def counters():
+    with _lock:
+        return dict(_counters)
+
+
+@contextlib.contextmanager
+def stage(name, **fields):
+    """
+    Time the enclosed block as stage ``name``. ``fields`` are included in
+    the metrics record.
+    """
+    start = time.time()
+    try:
+        yield
+    finally:
+        elapsed = time.time() - start
+        with _lock:
+            calls, total = _stages.get(name, (0, 0.0))
+            _stages[name] = [calls + 1, total + elapsed]
+        log.debug('%s: %.2fs', name, elapsed)
+        emit('stage', name=name, seconds=round(elapsed, 3), **fields)
+
+
+def stage_times():
+    """
+    Return {name: (calls, seconds)} for each stage
+    """
+    with _lock:
+        return dict((k, tuple(v)) for k, v in _stages.items())
+
+
+def emit_summary():
+    emit('summary',
+         counters=counters(),
+         stages=dict((k, {'calls': c, 'seconds': round(s, 3)})
+                     for k, (c, s) in stage_times().items()),
+         caches=util.memo_stats())
+
+
+def log_stage_times():
+    for name, (calls, seconds) in sorted(stage_times().items()):
+        log.info('stage %s: %d calls, %.2fs', name, calls, seconds)
+
+
+def _format_seconds(seconds):
+    seconds = int(seconds)
+    return '{}:{:02d}:{:02d}'.format(
+        seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+def _file_size(fileobj):
+    """
+    Size of ``fileobj`` if it is a regular, uncompressed file, else None
+    """
+    if not isinstance(fileobj, file):
+        return None
+    try:
+        st = os.fstat(fileobj.fileno())
+    except (AttributeError, IOError, OSError, ValueError):
+        return None
+    return st.st_size if stat.S_ISREG(st.st_mode) else None
+
+
+class Progress(object):
+
+    """
+    Progress of a loop over ``total`` items (if known), measured in wall
+    time.
+
+    Call ``update`` as items are processed, or wrap an iterable with
+    ``track``. If ``fileobj`` is given, its position is used to report bytes
+    read per second, and to estimate time remaining when ``total`` is
+    unknown. Use as a context manager, or call ``finish`` when done.
+    """
+
+    def __init__(self, name, total=None, unit='records', fileobj=None,
+                 stream=sys.stderr, report_every=REPORT_EVERY):
+        self.name = name
+        self.total = total
+        self.unit = unit
+        self.fileobj = fileobj
+        self.total_bytes = _file_size(fileobj)
+        self.stream = stream
+        self.report_every = report_every
+        self.count = 0
+        self.start = time.time()
+        self.finished = False
+        self._last_report = 0
+        self._last_emit = self.start
+        self._lock = threading.Lock()
+
+    def elapsed(self):
+        return time.time() - self.start
+
+    def rate(self):
+        """
+        Items per second
+        """
+        elapsed = self.elapsed()
+        return self.count / elapsed if elapsed > 0 else 0.0
+
+    def position(self):
+        """
+        Bytes read from ``fileobj``, or None if unavailable
+        """
+        if self.fileobj is None:
+            return None
+        try:
+            return self.fileobj.tell()
+        except (AttributeError, IOError, OSError, ValueError):
+            self.fileobj = None  # a pipe, or closed
+            return None
+
+    def byte_rate(self):
+        """
+        Bytes per second read from ``fileobj``, or None
+        """
+        position, elapsed = self.position(), self.elapsed()
+        if position is None or elapsed <= 0:
+            return None
+        return position / elapsed
+
+    def eta(self):
+        """
+        Estimated seconds remaining, or None if unknown
+        """
+        if self.total is not None:
+            rate = self.rate()
+            if rate > 0:
+                return max(self.total - self.count, 0) / rate
+        elif self.total_bytes:
+            byte_rate = self.byte_rate()
+            if byte_rate:
+                return max(self.total_bytes - self.position(), 0) / byte_rate
+        return None
+
+    def metrics(self):
+        result = {'name': self.name, 'unit': self.unit, 'count': self.count,
+                  'total': self.total, 'seconds': round(self.elapsed(), 3),
+                  'rate': round(self.rate(), 3)}
+        position = self.position()
+        if position is not None:
+            result['bytes'] = position
+            result['byte_rate'] = round(self.byte_rate() or 0.0, 3)
+        return result
+
+    def _line(self):
+        if self.total is not None:
+            count = '{0:d}/{1:d}'.format(self.count, self.total)
+        else:
+            count = '{0:d}'.format(self.count)
+        line = '{0}: {1} {2} [{3}, {4:.1f}/s'.format(
+            self.name, count, self.unit, _format_seconds(self.elapsed()),
+            self.rate())
+        byte_rate = self.byte_rate()
+        if byte_rate is not None:
+            line += ', {0:.1f} MB/s'.format(byte_rate / (1 << 20))
+        eta = self.eta()
+        if eta is not None and not self.finished:
+            line += ', ETA ' + _format_seconds(eta)
+        return line + ']'
+
+    def report(self, end='\r'):
+        if self.stream:
+            self.stream.write(self._line() + end)
+
+    def update(self, n=1):
+        with self._lock:
+            self.count += n
+            now = time.time()
+            if now - self._last_report > self.report_every:
+                self._last_report = now
+                self.report()
+            if now - self._last_emit > METRICS_EVERY:
+                self._last_emit = now
+                emit('progress', **self.metrics())
+
+    def track(self, iterable):
+        """
+        Yield from ``iterable``, counting items; finishes when it is
+        exhausted.
+        """
+        for i in iterable:
+            yield i
+            self.update()
+        self.finish()
+
+    def finish(self):
+        with self._lock:
+            if self.finished:
+                return
+            self.finished = True
+            self.report(end='\n')
+            metrics = self.metrics()
+        log.info('%(name)s: %(count)d %(unit)s in %(seconds).2fs '
+                 '(%(rate).1f/s)', metrics)
+        emit('progress_done', **metrics)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.finish()
+
+
+def track(iterable, name, **kwargs):
+    """
+    Shortcut for ``Progress(name, **kwargs).track(iterable)``
+    """
+    return Progress(name, **kwargs).track(iterable)
@@ -0,0 +1,298 @@
+"""
+Placement and accounting of temporary files.
+
+Temporary files created through ``util.ntf``, ``util.tempdir`` and
+``util.as_fasta`` are placed by the scratch manager:
+
+* files expected to be small (``size_hint`` below ``small_file``) are put in
+  RAM-backed storage (``/dev/shm``) while the space used there is below
+  ``ram_quota``, spilling to disk otherwise;
+* everything else goes in the scratch directory - set with the global
+  ``--scratch-dir`` option or ``$DEENURP_SCRATCH_DIR``, or the system
+  temporary directory by default.
+
+Bytes in use by live temporary files are tracked against an optional quota
+(``--scratch-quota`` or ``$DEENURP_SCRATCH_QUOTA``, in MB). A file counts
+for the larger of its ``size_hint`` and its size when last measured. Live
+files are measured again before each new temporary file is placed when a
+quota is set, and otherwise at most every ``measure_interval`` seconds;
+each is measured a final time when it is released. New temporary files
+wait for other threads to release space while the quota is exceeded, up
+to ``block_timeout`` seconds, after which they proceed with a warning.
+Peak usage is logged at exit.
+
+Files in RAM are only visible on this host. Once work is sent to other
+hosts (``--executor=queue``), ``share`` turns RAM placement off and, unless
+a scratch directory was chosen, places temporary files in a directory the
+workers can see.
+"""
+
+import atexit
+import logging
+import os
+import os.path
+import shutil
+import tempfile
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+ENV_DIR = 'DEENURP_SCRATCH_DIR'
+ENV_QUOTA = 'DEENURP_SCRATCH_QUOTA'
+
+RAM_DIR = '/dev/shm'
+
+"""Files expected to be smaller than this are placed in RAM"""
+SMALL_FILE = 4 << 20
+
+"""Maximum bytes of temporary files in RAM"""
+DEFAULT_RAM_QUOTA = 256 << 20
+
+"""Seconds to wait for space when the quota is exceeded"""
+BLOCK_TIMEOUT = 300
+
+"""Seconds between measurements of live files without a quota"""
+MEASURE_INTERVAL = 10
+
+MB = 1 << 20
+
+
+def _size(path):
+    """
+    Bytes used by the file or directory tree at ``path``; 0 if it no longer
+    exists.
+    """
+    try:
+        if not os.path.isdir(path):
+            return os.path.getsize(path)
+        total = 0
+        for root, _, files in os.walk(path):
+            for f in files:
+                try:
+                    total += os.path.getsize(os.path.join(root, f))
+                except OSError:
+                    pass
+        return total
+    except OSError:
+        return 0
+
+
+class Scratch(object):
+
+    """
+    Chooses directories for temporary files and tracks the space they use.
+    """
+
+    def __init__(self, directory=None, quota=None, ram_dir=RAM_DIR,
+                 ram_quota=DEFAULT_RAM_QUOTA, small_file=SMALL_FILE,
+                 block_timeout=BLOCK_TIMEOUT,
+                 measure_interval=MEASURE_INTERVAL):
+        self.directory = directory
+        self.quota = quota
+        self.ram_quota = ram_quota
+        self.small_file = small_file
+        self.block_timeout = block_timeout
+        self.measure_interval = measure_interval
+        self.peak = 0
+        self.peak_ram = 0
+
+        self._ram_dir = ram_dir
+        self._ram_tmp = None
+        # path -> (in RAM, owning thread, size hint, bytes counted)
+        self._live = {}
+        self._total = 0
+        self._ram = 0
+        self._measured = 0
+        self._cond = threading.Condition()
+
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _ram_directory(self):
+        """
+        A private directory under ``ram_dir``, or None if RAM-backed storage
+        is unavailable.
+        """
+        if not self.ram_quota or not self._ram_dir:
+            return None
+        if self._ram_tmp is None:
+            try:
+                self._ram_tmp = tempfile.mkdtemp(prefix='deenurp-',
+                                                 dir=self._ram_dir)
+            except OSError:
+                self._ram_dir = None
+                return None
+            atexit.register(shutil.rmtree, self._ram_tmp, True)
+        return self._ram_tmp
+
+    def _usage(self):
+        return self._total, self._ram
+
+    def _add(self, in_ram, size):
+        self._total += size
+        if in_ram:
+            self._ram += size
+        self.peak = max(self.peak, self._total)
+        self.peak_ram = max(self.peak_ram, self._ram)
+
+    def _others_live(self):
+        """
+        Whether other threads hold temporary files, which they may release
+        """
+        me = threading.current_thread().ident
+        return any(i[1] != me for i in self._live.values())
+
+    def _measure(self):
+        """
+        Measure all live files again (without the lock held)
+        """
+        with self._cond:
+            paths = list(self._live)
+            self._measured = time.time()
+        sizes = [(path, _size(path)) for path in paths]
+        with self._cond:
+            for path, size in sizes:
+                if path not in self._live:
+                    continue  # released meanwhile
+                in_ram, owner, hint, counted = self._live[path]
+                size = max(size, hint)
+                self._live[path] = (in_ram, owner, hint, size)
+                self._add(in_ram, size - counted)
+
+    def _measure_due(self):
+        return self.quota is not None or \
+            time.time() - self._measured >= self.measure_interval
+
+    def usage(self):
+        """
+        Returns (total, ram) bytes used by live temporary files
+        """
+        with self._cond:
+            return self._usage()
+
+    def acquire(self, size_hint=None):
+        """
+        Choose a directory for a new temporary file of about ``size_hint``
+        bytes (unknown if None), waiting while the quota is exceeded.
+        Returns None to use the system temporary directory.
+        """
+        if self._measure_due():
+            self._measure()
+        with self._cond:
+            total, ram = self._usage()
+            if self.quota is not None and total >= self.quota:
+                log.debug('scratch quota reached (%d MB); waiting',
+                          total / MB)
+                deadline = time.time() + self.block_timeout
+                while total >= self.quota and self._others_live() and \
+                        time.time() < deadline:
+                    self._cond.wait(min(1.0, deadline - time.time()))
+                    # files of other threads may have grown or shrunk
+                    self._cond.release()
+                    try:
+                        self._measure()
+                    finally:
+                        self._cond.acquire()
+                    total, ram = self._usage()
+                if total >= self.quota:
+                    log.warning('scratch quota exceeded (%d MB in use)',
+                                total / MB)
+
+            if size_hint is not None and size_hint < self.small_file and \
+                    ram + size_hint <= self.ram_quota:
+                ram_dir = self._ram_directory()
+                if ram_dir:
+                    return ram_dir
+            return self.directory
+
+    def in_ram(self, path):
+        """
+        Whether ``path`` is in this manager's RAM-backed directory
+        """
+        return bool(self._ram_tmp) and \
+            os.path.abspath(path).startswith(self._ram_tmp + os.sep)
+
+    def track(self, path, size_hint=None):
+        """
+        Start tracking ``path``, counting at least ``size_hint`` bytes for
+        it until it is released
+        """
+        hint = size_hint or 0
+        size = max(_size(path), hint)
+        in_ram = self.in_ram(path)
+        with self._cond:
+            self._release(path)
+            self._live[path] = (in_ram, threading.current_thread().ident,
+                                hint, size)
+            self._add(in_ram, size)
+
+    def _release(self, path, size=None):
+        # with the lock held
+        if path not in self._live:
+            return
+        in_ram, _, _, counted = self._live.pop(path)
+        if size is not None and size > counted:
+            # count the final size towards the peak
+            self._add(in_ram, size - counted)
+            counted = size
+        self._add(in_ram, -counted)
+
+    def release(self, path):
+        """
+        Stop tracking ``path``, which is about to be removed
+        """
+        if self.quota is None and self._measure_due():
+            # the other live files, for the peak
+            self._measure()
+        size = _size(path)
+        with self._cond:
+            self._release(path, size)
+            self._cond.notify_all()
+
+    def share(self, directory):
+        """
+        Place new temporary files where other hosts can see them: nothing
+        is put in RAM, and files go in ``directory`` unless a scratch
+        directory was set.
+        """
+        with self._cond:
+            self._ram_dir = None
+            if self.directory is None:
+                self.directory = directory
+                log.info('placing temporary files in %s', directory)
+
+    def report(self):
+        log.info('peak scratch usage: %.1f MB (%.1f MB in RAM)',
+                 float(self.peak) / MB, float(self.peak_ram) / MB)
+
+
+_default = None
+_default_lock = threading.Lock()
+
+
+def configure(directory=None, quota=None, ram_quota=DEFAULT_RAM_QUOTA):
+    """
+    Set the scratch manager used for temporary files. ``quota`` and
+    ``ram_quota`` are in bytes.
+    """
+    global _default
+    manager = Scratch(directory, quota=quota, ram_quota=ram_quota)
+    atexit.register(manager.report)
+    with _default_lock:
+        _default = manager
+    return manager
+
+
+def default():
+    """
+    Return the configured scratch manager, configuring it from the
+    environment on first use.
+    """
+    with _default_lock:
+        manager = _default
+    if manager is None:
+        quota = os.environ.get(ENV_QUOTA)
+        manager = configure(os.environ.get(ENV_DIR) or None,
+                            quota=int(quota) * MB if quota else None)
+    return manager
@@ -8,14 +8,11 @@ import logging
 import operator
 import os
 import sqlite3
-import tempfile
 
 from deenurp import uclust
 from Bio import SeqIO
 
-from .util import SingletonDefaultDict, memoize
-
-_ntf = tempfile.NamedTemporaryFile
+from .util import SingletonDefaultDict, lru_memoize
 
 SELECT_THRESHOLD = 0.05
 SEARCH_THRESHOLD = 0.90
@@ -126,65 +123,64 @@ def _search(con, quiet=True, select_threshold=SELECT_THRESHOLD,
     with open(p['ref_meta']) as fp:
         cluster_info = _load_cluster_info(fp, p['group_field'])
 
-    @memoize
-    def add_hit(hit_name, clusterj):
+    @lru_memoize()
+    def add_hit(hit_name, cluster):
+        # the cache is bounded: the hit may have been added already
+        sql = 'SELECT ref_id FROM ref_seqs WHERE name = ?'
+        cursor.execute(sql, [hit_name])
+        result = cursor.fetchone()
+        if result:
+            return result[0]
         ins = 'INSERT INTO ref_seqs(name, cluster_name) VALUES (?, ?)'
         logging.debug(ins.replace('?', '{}').format(hit_name, cluster))
         cursor.execute(ins, [hit_name, cluster])
         return cursor.lastrowid
 
-    @memoize
+    @lru_memoize()
     def get_seq_id(name):
         sql = 'SELECT sequence_id FROM sequences WHERE name = ?'
         logging.debug(sql.replace('?', '{}').format(name))
         cursor.execute(sql, [name])
         return cursor.fetchone()[0]
 
-    with _ntf(prefix='usearch') as uc_fp:
-        uclust.search(
-            ref_name,
-            p['fasta_file'],
-            uc_fp.name,
-            pct_id=search_threshold,
-            maxaccepts=p['maxaccepts'],
-            maxrejects=p['maxrejects'],
-            quiet=quiet)
-
-        # import shutil
-        # shutil.copy(uc_fp.name, '.')
-
-        records = uclust.parse_uclust_out(uc_fp)
-        records = (i for i in records if i.type ==
-                   'H' and i.pct_id >= p['search_identity'] * 100.0)
-        by_seq = uclust.hits_by_sequence(records)
-        by_seq = select_hits(by_seq, select_threshold)
-
-        sql = """
+    records = uclust.search_iter(
+        ref_name,
+        p['fasta_file'],
+        pct_id=search_threshold,
+        maxaccepts=p['maxaccepts'],
+        maxrejects=p['maxrejects'],
+        quiet=quiet,
+        types=('H',))
+    records = (i for i in records if i.pct_id >= p['search_identity'] * 100.0)
+    by_seq = uclust.hits_by_sequence(records)
+    by_seq = select_hits(by_seq, select_threshold)
+
+    sql = """
 INSERT INTO best_hits (sequence_id, hit_idx, ref_id, pct_id)
 VALUES (?, ?, ?, ?)
 """
-        for _, hits in by_seq:
-            # Drop clusters from blacklist
-            hits = (
-                h for h in hits if not cluster_info[
-                    h.target_label] in blacklist)
-            seen_clusters = set()
-            for i, h in enumerate(hits):
-                cluster = cluster_info[h.target_label]
-
-                # Only keep one sequence per cluster
-                if cluster in seen_clusters:
-                    continue
-                else:
-                    seen_clusters.add(cluster)
-
-                # Hit id
-                hit_id = add_hit(h.target_label, cluster)
-                seq_id = get_seq_id(h.query_label)
-                logging.debug(sql.replace('?', '{}').format(
-                    seq_id, i, hit_id, h.pct_id))
-                cursor.execute(sql, [seq_id, i, hit_id, h.pct_id])
-                count += 1
+    for _, hits in by_seq:
+        # Drop clusters from blacklist
+        hits = (
+            h for h in hits if not cluster_info[
+                h.target_label] in blacklist)
+        seen_clusters = set()
+        for i, h in enumerate(hits):
+            cluster = cluster_info[h.target_label]
+
+            # Only keep one sequence per cluster
+            if cluster in seen_clusters:
+                continue
+            else:
+                seen_clusters.add(cluster)
+
+            # Hit id
+            hit_id = add_hit(h.target_label, cluster)
+            seq_id = get_seq_id(h.query_label)
+            logging.debug(sql.replace('?', '{}').format(
+                seq_id, i, hit_id, h.pct_id))
+            cursor.execute(sql, [seq_id, i, hit_id, h.pct_id])
+            count += 1
 
     return count
 
@@ -197,7 +193,7 @@ def _load_sequences(con, sequence_file, weights=None):
         weights = SingletonDefaultDict({'default': 1.0})
     seq_count = 0
 
-    @memoize
+    @lru_memoize()
     def get_sample_id(sample_name):
         cursor = con.cursor()
         sql = 'SELECT sample_id FROM samples WHERE name = ?'
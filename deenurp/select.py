@@ -16,7 +16,7 @@ from Bio.SeqRecord import SeqRecord
 from . import search, uclust
 from concurrent import futures
 
-from . import util, wrap
+from . import progress, util, wrap
 from .config import DEFAULT_THREADS
 from .util import as_fasta, tempdir
 from .wrap import (cmalign, as_refpkg, redupfile_of_seqs,
@@ -63,11 +63,13 @@ def _cluster(sequences, threshold=CLUSTER_THRESHOLD):
     """
     sequences = list(sequences)
     assert sequences
-    with as_fasta(sequences) as fasta_name, \
-            tempfile.NamedTemporaryFile(prefix='uc-') as ntf:
-        uclust.cluster(fasta_name, ntf.name, pct_id=threshold, quiet=True)
-        ntf.seek(0)
-        r = list(uclust.cluster_seeds(fasta_name, ntf))
+    with as_fasta(sequences) as fasta_name:
+        seeds = uclust.cluster(
+            fasta_name, pct_id=threshold, quiet=True, centroids=True)
+
+    # keep the original records, in input order
+    seed_ids = frozenset(i.id for i in seeds)
+    r = [s for s in sequences if s.id in seed_ids]
 
     logging.debug("Clustered %d to %d", len(sequences), len(r))
     return r
@@ -82,10 +84,14 @@ def select_sequences_for_cluster(
         max_sample,
         max_weight,
         norm_sw,
-        keep_leaves=5):
+        keep_leaves=5,
+        pplacer_mmap_dir=None,
+        pplacer_mmap_threshold=wrap.PPLACER_MMAP_THRESHOLD):
     """
     Given a set of reference sequences and query sequences, select
     keep_leaves appropriate references.
+
+    pplacer_mmap_{dir,threshold} - see ``wrap.pplacer``
     """
     logging.info('Cluster %s: Max sample abundance: %.3f%% of %s, %d hits',
                  cluster_name, max_weight * 100, max_sample, len(query_seqs))
@@ -113,13 +119,19 @@ def select_sequences_for_cluster(
     c = itertools.chain(ref_seqs, query_seqs)
 
     ref_ids = frozenset(i.id for i in ref_seqs)
-    aligned = list(cmalign(c))
+    with progress.stage('cmalign', cluster=cluster_name):
+        aligned = list(cmalign(c))
     with as_refpkg((i for i in aligned if i.id in ref_ids)) as rp, \
             as_fasta(aligned) as fasta, \
             tempdir(prefix='jplace') as placedir, \
             redupfile_of_seqs(query_seqs) as redup_path:
 
-        jplace = pplacer(rp.path, fasta, out_dir=placedir(), threads=1)
+        footprint = len(aligned[0]) * len(ref_ids) * len(query_seqs)
+        with progress.stage('pplacer', cluster=cluster_name):
+            jplace = pplacer(rp.path, fasta, out_dir=placedir(), threads=1,
+                             mmap_dir=pplacer_mmap_dir,
+                             mmap_threshold=pplacer_mmap_threshold,
+                             footprint=footprint)
         # Redup
         guppy_redup(jplace, redup_path, placedir('redup.jplace'))
         prune_leaves = set(
@@ -243,13 +255,21 @@ def choose_references(
         include_clusters=None,
         exclude_clusters=None,
         include_sequences=None,
-        exclude_sequences=None):
+        exclude_sequences=None,
+        pplacer_mmap_dir=None,
+        pplacer_mmap_threshold=wrap.PPLACER_MMAP_THRESHOLD,
+        executor=None):
     """
     Choose reference sequences from a search, choosing refs_per_cluster
     reference sequences for each nonoverlapping cluster.
 
     min_cluster_prop - Minimum proportion of total mass in a cluster to
                        require before including references
+    pplacer_mmap_dir - Scratch directory for pplacer memory-mapped files
+    pplacer_mmap_threshold - Estimated footprint above which pplacer uses a
+                       memory-mapped file (see ``wrap.pplacer``)
+    executor - Executor for per-cluster tasks (see ``execution``)
+                       [default: a ThreadPoolExecutor with ``threads`` workers]
     """
 
     if include_sequences:
@@ -290,7 +310,10 @@ ORDER BY ref_seqs.cluster_name ASC, SUM(sequences_samples.weight) DESC
 
     selected_clusters = set()
     futs = set()
-    with futures.ThreadPoolExecutor(threads) as executor:
+    if executor is None:
+        executor = futures.ThreadPoolExecutor(threads)
+
+    with executor:
         for cluster_name, values in grouped:
             cluster_seq_names = sequences_hitting_cluster(
                 deenurp_db, cluster_name)
@@ -333,7 +356,9 @@ ORDER BY ref_seqs.cluster_name ASC, SUM(sequences_samples.weight) DESC
                 cluster_weight=sum(v[-1] for v in values),
                 max_sample=max_sample,
                 max_weight=max_weight,
-                keep_leaves=refs_per_cluster))
+                keep_leaves=refs_per_cluster,
+                pplacer_mmap_dir=pplacer_mmap_dir,
+                pplacer_mmap_threshold=pplacer_mmap_threshold))
 
         # Whitelist
         if include_clusters:
@@ -352,10 +377,13 @@ ORDER BY ref_seqs.cluster_name ASC, SUM(sequences_samples.weight) DESC
                             cluster,
                             keep_leaves=refs_per_cluster))
 
+        clusters_progress = progress.Progress('clusters', total=len(futs),
+                                              unit='selected')
         while futs:
             try:
                 done, pending = futures.wait(futs, 1, futures.FIRST_COMPLETED)
                 futs = set(pending)
+                clusters_progress.update(len(done))
                 for f in done:
                     if f.exception():
                         raise f.exception()
@@ -374,3 +402,4 @@ ORDER BY ref_seqs.cluster_name ASC, SUM(sequences_samples.weight) DESC
                 logging.exception("Caught error in child thread - exiting")
                 executor.shutdown(False)
                 raise
+        clusters_progress.finish()
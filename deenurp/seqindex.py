@@ -0,0 +1,223 @@
+"""
+Persistent SSI indexes of sequence files, shared among threads and processes.
+
+An index is built once next to the sequence file (``<sequence_file>.ssi``)
+and reused for as long as the sequence file is unchanged. The size and
+modification time of the sequence file (and optionally a SHA1 digest of its
+contents) are recorded in ``<sequence_file>.ssi.json`` when the index is
+built; an index that no longer matches its sequence file is rebuilt.
+
+Building is serialized among threads with a lock and among processes with an
+advisory lock on ``<sequence_file>.ssi.lock``. The new index is written to a
+temporary file and renamed into place, so readers never see a partial index.
+"""
+
+import atexit
+import contextlib
+import errno
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import os.path
+import tempfile
+import threading
+
+import peasel
+
+log = logging.getLogger(__name__)
+
+"""Validate indexes using the size and modification time of the sequence file"""
+VALIDATE_STAT = 'stat'
+
+"""As VALIDATE_STAT, falling back to a SHA1 digest of the sequence file when
+the modification time has changed (eg, after copying)"""
+VALIDATE_HASH = 'hash'
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+def _sha1(path, bufsize=1 << 20):
+    h = hashlib.sha1()
+    with open(path, 'rb') as fp:
+        for block in iter(lambda: fp.read(bufsize), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+@contextlib.contextmanager
+def _file_lock(path):
+    """
+    Hold an exclusive advisory lock on ``path`` for the duration of the
+    context manager.
+    """
+    with open(path, 'a') as fp:
+        fcntl.flock(fp, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fp, fcntl.LOCK_UN)
+
+
+class SequenceIndex(object):
+
+    """
+    A validated SSI index for ``sequence_file``.
+
+    Sequence lookups use one open index handle per thread, so a single
+    instance may be shared by all of the threads in a process.
+    """
+
+    def __init__(self, sequence_file, validate=VALIDATE_STAT):
+        if validate not in (VALIDATE_STAT, VALIDATE_HASH):
+            raise ValueError('invalid validation method: ' + validate)
+        self.sequence_file = sequence_file
+        self.validate = validate
+        self.ssi_path = sequence_file + '.ssi'
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._ready = False
+
+    @property
+    def meta_path(self):
+        return self.ssi_path + '.json'
+
+    def _signature(self):
+        st = os.stat(self.sequence_file)
+        return {'size': st.st_size, 'mtime': st.st_mtime}
+
+    def _is_current(self):
+        """
+        Returns whether the index on disk describes the current contents of
+        the sequence file.
+        """
+        if not os.path.exists(self.ssi_path):
+            return False
+        try:
+            with open(self.meta_path) as fp:
+                meta = json.load(fp)
+        except (IOError, ValueError):
+            return False
+
+        sig = self._signature()
+        if meta.get('size') != sig['size']:
+            return False
+        if meta.get('mtime') == sig['mtime']:
+            return True
+        if self.validate == VALIDATE_HASH and meta.get('sha1'):
+            if meta['sha1'] == _sha1(self.sequence_file):
+                # contents unchanged; remember the new mtime
+                meta['mtime'] = sig['mtime']
+                self._write_meta(meta)
+                return True
+        return False
+
+    def _write_meta(self, meta):
+        dirname = os.path.dirname(os.path.abspath(self.meta_path))
+        fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.ssi-meta-')
+        with os.fdopen(fd, 'w') as fp:
+            json.dump(meta, fp)
+        os.rename(tmp, self.meta_path)
+
+    def _build(self):
+        dirname = os.path.dirname(os.path.abspath(self.ssi_path))
+        fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.ssi-', suffix='.ssi')
+        os.close(fd)
+        os.unlink(tmp)  # peasel refuses to overwrite an existing index
+        try:
+            meta = self._signature()
+            log.info('Indexing %s', self.sequence_file)
+            peasel.create_ssi(self.sequence_file, tmp)
+            if self.validate == VALIDATE_HASH:
+                meta['sha1'] = _sha1(self.sequence_file)
+            os.rename(tmp, self.ssi_path)
+        finally:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+        self._write_meta(meta)
+
+    def _build_temporary(self):
+        """
+        Index into the temporary directory when the directory containing the
+        sequence file is not writable. The index is removed at exit.
+        """
+        fd, tmp = tempfile.mkstemp(prefix='peasel-', suffix='.ssi')
+        os.close(fd)
+        os.unlink(tmp)
+        peasel.create_ssi(self.sequence_file, tmp)
+        atexit.register(os.unlink, tmp)
+        self.ssi_path = tmp
+
+    def ensure(self):
+        """
+        Make sure a current index exists, building it if necessary.
+        """
+        with self._lock:
+            if self._ready:
+                return
+            try:
+                with _file_lock(self.ssi_path + '.lock'):
+                    if self._is_current():
+                        log.debug('Using existing index for %s',
+                                  self.sequence_file)
+                    else:
+                        self._build()
+            except (IOError, OSError) as e:
+                if e.errno not in (errno.EACCES, errno.EROFS, errno.EPERM):
+                    raise
+                log.warning('Cannot write an index next to %s (%s); '
+                            'using a temporary index', self.sequence_file, e)
+                self._build_temporary()
+            self._ready = True
+
+    def _handle(self):
+        handle = getattr(self._local, 'handle', None)
+        if handle is None:
+            self.ensure()
+            handle = peasel.open_ssi(self.sequence_file, self.ssi_path)
+            self._local.handle = handle
+        return handle
+
+    def __getitem__(self, name):
+        return self._handle()[name]
+
+    def fetch(self, names):
+        """
+        Generate sequences named in ``names``, in order.
+        """
+        handle = self._handle()
+        for name in names:
+            yield handle[str(name)]
+
+    def write_fasta(self, names, output_fp):
+        """
+        Write the sequences named in ``names`` to ``output_fp`` in FASTA
+        format, returning the number of sequences written.
+        """
+        return peasel.write_fasta(self.fetch(names), output_fp)
+
+
+def open_index(sequence_file, validate=VALIDATE_STAT):
+    """
+    Return the shared :class:`SequenceIndex` for ``sequence_file``, building
+    or rebuilding the index on disk if it is missing or out of date.
+    """
+    key = os.path.realpath(sequence_file)
+    with _registry_lock:
+        index = _registry.get(key)
+        if index is None or index.validate != validate:
+            index = SequenceIndex(sequence_file, validate=validate)
+            _registry[key] = index
+    index.ensure()
+    return index
+
+
+def forget(sequence_file):
+    """
+    Drop the shared index for ``sequence_file`` from the registry, so the
+    next call to :func:`open_index` validates it again.
+    """
+    with _registry_lock:
+        _registry.pop(os.path.realpath(sequence_file), None)
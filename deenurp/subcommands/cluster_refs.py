@@ -30,19 +30,15 @@ def build_parser(p):
 
 def cluster_identify_redundant(named_sequence_file, named_ids, to_cluster,
         threshold=0.97):
-    with util.ntf(suffix='.uc', prefix='to_cluster') as tf:
-        # Search with uclust
-        uclust.search(named_sequence_file, to_cluster, tf.name,
-                pct_id=0.80,
-                maxaccepts=5,
-                maxrejects=100)
+    # Search with uclust
+    records = uclust.search_iter(named_sequence_file, to_cluster,
+            pct_id=0.80,
+            maxaccepts=5,
+            maxrejects=100,
+            types=('H',))
+    hits = (i.query_label for i in records if i.pct_id >= threshold * 100.0)
 
-        # Uclust.search renames to tf, need a new handle.
-        records = uclust.parse_uclust_out(tf)
-        hits = (i.query_label for i in records
-                if i.type == 'H' and i.pct_id >= threshold * 100.0)
-
-        return frozenset(hits)
+    return frozenset(hits)
 
 def taxonomic_clustered(taxonomy, cluster_rank):
     """
@@ -64,9 +60,8 @@ def identify_otus_unnamed(seq_file, cluster_similarity):
         # Sort and cluster
         uclust.cluster(
             seq_file, tf.name, pct_id=cluster_similarity, quiet=True)
-        clusters = uclust.sequences_by_cluster(uclust.parse_uclust_out(tf))
-        for _, sequences in clusters:
-            yield [i.query_label for i in sequences]
+        for _, sequences in uclust.cluster_members(tf.name):
+            yield sequences
 
 def action(a):
     # Load taxtable
@@ -8,7 +8,7 @@ import pandas
 
 from Bio import SeqIO
 
-from deenurp import util
+from deenurp import progress, util
 
 log = logging.getLogger(__name__)
 
@@ -49,7 +49,9 @@ def action(args):
     log.info('reading sequences')
     with util.file_opener()(args.sequences) as sequences_in:
         seqhashes = dict()
-        for record in util.Counter(SeqIO.parse(sequences_in, 'fasta')):
+        records = progress.track(SeqIO.parse(sequences_in, 'fasta'),
+                                 'reading', fileobj=sequences_in)
+        for record in records:
             seq = str(record.seq).replace('\n', '').upper()
             seqhashes[record.name] = hashlib.sha1(seq).hexdigest()
 
@@ -79,7 +81,9 @@ def action(args):
     log.info('writing dedup file')
     with util.file_opener()(args.sequences) as sequences_in, \
             util.file_opener('w')(args.out) as sequences_out:
-        for record in util.Counter(SeqIO.parse(sequences_in, 'fasta')):
+        records = progress.track(SeqIO.parse(sequences_in, 'fasta'),
+                                 'writing', fileobj=sequences_in)
+        for record in records:
             if record.name in seq_info.index:
                 fasta_out = '>{}\n{}\n'.format(record.name, str(record.seq))
                 sequences_out.write(fasta_out)
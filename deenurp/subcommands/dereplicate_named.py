@@ -3,7 +3,6 @@
 """
 
 import logging
-import os
 import sys
 
 import pandas as pd
@@ -71,12 +70,6 @@ def cluster(seqfile, seqnames, identity=1.0, prefix='cluster-', threads=None):
 
 
 def action(args):
-    # remove .ssi index for sequence file if it exists
-    try:
-        os.remove(args.seqs + '.ssi')
-    except OSError:
-        pass
-
     dtype = {'gi': str, 'tax_id': str, 'species': str}
     seq_info = pd.read_csv(args.seq_info, dtype=dtype)
     info_cols = seq_info.columns
@@ -130,6 +123,3 @@ def action(args):
 
     wrap.esl_sfetch(
         args.seqs, all_clusters['seed'].unique(), args.seqs_out)
-
-    # finally - clean up .ssi file
-    os.remove(args.seqs + '.ssi')
@@ -9,13 +9,13 @@ database.
 import argparse
 import csv
 import logging
-import os
 import shutil
 
+from Bio import SeqIO
 from deenurp import uclust
 from taxtastic.taxtable import TaxNode
 
-from .. import wrap, util
+from .. import kmer, wrap, util
 
 def build_parser(p):
     p.add_argument('sequence_file', help="""Named sequences""")
@@ -31,6 +31,12 @@ def build_parser(p):
             attempted to be recruited. [default: %(default)d]""")
     p.add_argument('--pct-id', help="""Percent ID to search at [default:
             %(default)f]""", default=0.99, type=float)
+    p.add_argument('--kmer-index', metavar='DIR', help="""k-mer index of
+            unnamed_file (see 'deenurp kmer_index'). If given, only
+            candidate sequences from the index are searched.""")
+    p.add_argument('--kmer-candidates', metavar='N', type=int,
+            default=kmer.TOP_K, help="""Candidate sequences per query
+            with --kmer-index [default: %(default)d]""")
 
 def find_underrepresented(tax_root, min_at_rank=5, rank='species'):
     """
@@ -49,11 +55,7 @@ def find_underrepresented(tax_root, min_at_rank=5, rank='species'):
     return inner(tax_root)
 
 def uclust_search(query, db, **kwargs):
-    with util.ntf(prefix='uclust') as tf:
-        uclust.search(db, query, tf.name, **kwargs)
-        lines = (i for i in tf if i.startswith('H'))
-        for i in uclust.parse_uclust_out(lines):
-            yield i
+    return uclust.search_iter(db, query, types=('H',), **kwargs)
 
 def action(a):
     with a.taxonomy as fp:
@@ -75,16 +77,31 @@ def action(a):
         seq_group.update({i: n.tax_id for i in seqs})
 
     with util.ntf(prefix='to_expand-', suffix='.fasta') as expand_fp, \
-         util.ntf(prefix='expand_hits-', suffix='.fasta') as hits_fp:
+         util.ntf(prefix='expand_hits-', suffix='.fasta') as hits_fp, \
+         util.ntf(prefix='candidates-', suffix='.fasta') as candidates_fp:
         # Extract sequences
         c = wrap.esl_sfetch(a.sequence_file, seq_group, expand_fp)
         logging.info('fetched %d sequences', c)
         expand_fp.close()
 
+        # Limit the search to candidates sharing k-mers with the sequences
+        search_db = a.unnamed_file
+        n_candidates = None
+        if a.kmer_index:
+            index = kmer.open_index(a.kmer_index, a.unnamed_file)
+            n_candidates = kmer.write_candidates(index,
+                    SeqIO.parse(expand_fp.name, 'fasta'), a.unnamed_file,
+                    candidates_fp, top_k=a.kmer_candidates)
+            candidates_fp.close()
+            search_db = candidates_fp.name
+
         # Search sequences against unnamed
-        r = uclust_search(expand_fp.name, a.unnamed_file, pct_id=a.pct_id,
-                maxaccepts=4, search_pct_id=0.9)
-        hits = list(r)
+        if n_candidates == 0:
+            hits = []
+        else:
+            r = uclust_search(expand_fp.name, search_db, pct_id=a.pct_id,
+                    maxaccepts=4, search_pct_id=0.9)
+            hits = list(r)
         # Map from hit to group
         hit_group = {i.target_label: seq_group[i.query_label] for i in hits}
 
@@ -111,10 +128,8 @@ def action(a):
         with open(a.output + '.fasta', 'w') as ofp:
             with open(a.sequence_file) as fp:
                 shutil.copyfileobj(fp, ofp)
-            try:
-                wrap.esl_sfetch(hits_fp.name, frozenset(update_hits) - current_seqs, ofp)
-            finally:
-                os.remove(hits_fp.name + '.ssi')
+            wrap.esl_sfetch(hits_fp.name, frozenset(update_hits) - current_seqs,
+                            ofp, use_temp=True)
 
         # Write a new seq_info
         with open(a.output + '.seq_info.csv', 'w') as ofp, open(a.seqinfo_file.name) as sinfo:
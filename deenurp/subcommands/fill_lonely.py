@@ -7,13 +7,12 @@ import copy
 import csv
 import logging
 import shutil
-import sys
 
 from Bio import SeqIO
 from concurrent import futures
 from taxtastic import taxtable
 
-from .. import config, util, wrap
+from .. import config, execution, progress, util, wrap
 
 RANK = 'species'
 PARENT_RANK = 'genus'
@@ -33,17 +32,13 @@ def is_lonely(node, parent_rank=PARENT_RANK):
         return False
 
 
-def fill_lonely_worker(
-        node_id, parent_id, full_taxonomy, full_fasta, n_reps=5):
+def sibling_sequence_ids(node_id, parent_id, full_taxonomy):
     """
-    Finds some company for lonely taxonomic node identified by ``node_id``
+    Sequence IDs of the nodes with the same rank as the lonely node
+    identified by ``node_id`` under the node identified by ``parent_id``
 
-    :param tax_id: Tax ID of lonely node
-    :param parent_id: Tax ID of parent node (at desired rank)
     :param full_taxonomy: complete taxtable.TaxNode, populated with available
-    sequences in ``full_fasta``
-    :param full_fasta: Path to FASTA file with candidate references
-    :returns: Sequence IDs to keep
+    sequences
     """
     parent_node = full_taxonomy.get_node(parent_id)
     lonely_node = next((i for i in parent_node if i.tax_id == node_id), None)
@@ -53,9 +48,19 @@ def fill_lonely_worker(
     # Find other nodes with equivalent rank
     other_nodes = [i for i in parent_node if i.rank ==
                    lonely_node.rank and i != lonely_node]
-    other_sequence_ids = [
-        s for i in other_nodes for s in i.subtree_sequence_ids()]
+    return [s for i in other_nodes for s in i.subtree_sequence_ids()]
+
+
+def fill_lonely_worker(node_id, other_sequence_ids, full_fasta, n_reps=5):
+    """
+    Finds some company for lonely taxonomic node identified by ``node_id``
 
+    :param tax_id: Tax ID of lonely node
+    :param other_sequence_ids: candidate sequence IDs, from
+    ``sibling_sequence_ids``
+    :param full_fasta: Path to FASTA file with candidate references
+    :returns: Sequence IDs to keep
+    """
     if len(other_sequence_ids) <= n_reps:
         return frozenset(other_sequence_ids)
 
@@ -66,21 +71,23 @@ def fill_lonely_worker(
         tf.seek(0)
         sequences = SeqIO.parse(tf, 'fasta')
 
+        n_seqs = len(other_sequence_ids)
+
         # Align
-        sys.stderr.write(
-            'Node {0}: cmalign {1} sequences\r'.format(
-                node_id, len(other_sequence_ids)))
-        aligned = list(wrap.cmalign(sequences))
+        logging.debug('Node %s: cmalign %d sequences', node_id, n_seqs)
+        with progress.stage('cmalign', tax_id=node_id, n_seqs=n_seqs):
+            aligned = list(wrap.cmalign(sequences))
 
         # Run FastTree
-        sys.stderr.write('Node {0}: FastTree {1} sequences\r'.format(
-            node_id, len(other_sequence_ids)))
-        wrap.fasttree(aligned, tree_fp, gtr=True)
+        logging.debug('Node %s: FastTree %d sequences', node_id, n_seqs)
+        with progress.stage('fasttree', tax_id=node_id, n_seqs=n_seqs):
+            wrap.fasttree(aligned, tree_fp, gtr=True)
         tree_fp.close()
 
         # Select reps
-        sys.stderr.write('Node {0}: Minimizing ADCL\r'.format(node_id))
-        prune_leaves = wrap.rppr_min_adcl_tree(tree_fp.name, 5)
+        logging.debug('Node %s: Minimizing ADCL', node_id)
+        with progress.stage('min_adcl', tax_id=node_id, n_seqs=n_seqs):
+            prune_leaves = wrap.rppr_min_adcl_tree(tree_fp.name, 5)
         return frozenset(other_sequence_ids) - frozenset(prune_leaves)
 
 
@@ -142,6 +149,8 @@ def build_parser(p):
         type=int,
         help="""Number of threads [default: %(default)s]""")
 
+    execution.add_arguments(p)
+
 
 def action(args):
     logging.info("Loading taxtable")
@@ -167,17 +176,25 @@ def action(args):
     lonely_nodes = [i for i in nodes if is_lonely(i)]
     additional_reps = set()
     futs = []
-    with futures.ThreadPoolExecutor(args.threads) as executor:
+    executor = execution.get_executor(
+        args.executor, args.threads, args.queue_dir, args.local_workers)
+    with executor:
         for node in lonely_nodes:
             futs.append(
                 executor.submit(
                     fill_lonely_worker,
                     node.tax_id,
-                    node.at_rank(args.parent_rank).tax_id,
-                    full_taxonomy,
+                    # only the candidates, not the whole taxonomy, are
+                    # passed to (and pickled for) each task
+                    sibling_sequence_ids(
+                        node.tax_id, node.at_rank(args.parent_rank).tax_id,
+                        full_taxonomy),
                     args.search_fasta,
                     n_reps=args.number_of_reps))
 
+        nodes_progress = progress.Progress('lonely nodes',
+                                           total=len(lonely_nodes),
+                                           unit='complete')
         while futs:
             try:
                 done, pending = futures.wait(futs, 1, futures.FIRST_COMPLETED)
@@ -186,16 +203,14 @@ def action(args):
                     if f.exception():
                         raise f.exception()
                     additional_reps |= f.result()
-                sys.stderr.write(
-                    "{0:6d}/{1:6d} complete        \r".format(
-                        len(lonely_nodes) - len(pending),
-                        len(lonely_nodes)))
+                nodes_progress.update(len(done))
             except futures.TimeoutError:
                 pass  # Keep waiting
             except:
                 logging.exception("Caught error in child thread - exiting")
                 executor.shutdown(False)
                 raise
+        nodes_progress.finish()
 
     if args.include_taxids:
         for t in args.include_taxids:
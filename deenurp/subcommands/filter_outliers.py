@@ -13,11 +13,15 @@ multiple alignment is created using a 16S rRNA alignment profile. A
 multiple alignment of non-16S sequences can be created using
 ``--aligner=muscle``, but note that alignment of large numbers of
 sequences may be slow. For both multiple alignment strategies,
-pairwise distances are calculated using ``FastTree
--makematrix``. Alternatively, ``--aligner=vsearch`` will calculate
-pairwise distances using global pairwise alignments. This tends to be
-faster for small groups of sequences, and seems acceptable for up to
-1000 or so records per group.
+pairwise Jukes-Cantor distances are calculated from the alignment (the
+same distances as ``FastTree -nt -makematrix``). Alternatively,
+``--aligner=vsearch`` will calculate pairwise distances using global
+pairwise alignments. This tends to be faster for small groups of
+sequences, and seems acceptable for up to 1000 or so records per
+group. ``--aligner=kmer`` estimates distances
+from the k-mers shared by each pair of unaligned sequences; it is much
+faster than the others, but less accurate, so is best suited to a first
+pass over the largest groups.
 
 Given a pairwise distance matrix, two strategies are available for
 outlier detection:
@@ -62,6 +66,9 @@ This can all take a while if there are many sequences. If a pool of
 candidate sequences needs to be updated, use ``--previous-details`` to
 provide the output of ``--detailed-seqinfo`` from a previous run to
 avoid re-analyzing tax_ids represented by the same set of sequences.
+``--distance-store`` keeps the distance matrix of each tax_id, so that
+when sequences are added to a tax_id only distances involving the new
+sequences are calculated.
 
 runtime parameters
 ==================
@@ -73,33 +80,73 @@ allocated to each job (eg via ``vsearch --threads`` or ``cmalign
 --cpu``). No effort is made to avoid exceeding available resources, so
 the user should consider the product of these two parameters.
 
+Alternatively ``--cores`` sets a total budget of cores, replacing both
+options: taxa are dispatched largest first, each with threads in proportion
+to its number of sequences (one per ``SEQS_PER_THREAD``, up to the whole
+budget), and a taxon starts once enough cores are free. Large taxa then
+finish early instead of holding up the end of the run, and the many small
+taxa share the remaining cores on single threads. ``--timing-report``
+writes the threads and elapsed time of each taxon.
+
+Starting cmalign has a fixed cost which dominates the time taken for small
+taxa. With ``--batch-seqs N``, taxa with fewer than N sequences are aligned
+together in batches of about N sequences; the alignment of each taxon is
+then recovered from the batch (see ``split_alignment``), so the results
+are the same.
+
+A run can be divided among several hosts with ``--shard I/N``: each of N
+runs filters a subset of the taxa with about 1/N of the sequences (the
+same for any I; see ``shard_taxa``), writing outputs for those taxa only.
+``deenurp filter_outliers_merge`` then combines the ``--detailed-seqinfo``
+of the shards into outputs for the whole run.
+
 """
 
 import argparse
+import functools
 import numpy
 import os
 import pandas as pd
 import sys
 import shutil
+import time
 import logging
 import csv
 import traceback
 
 from Bio import SeqIO
+from Bio.Seq import Seq
+from Bio.SeqRecord import SeqRecord
 from concurrent import futures
 import peasel
+from pandas.io.common import EmptyDataError
 
 from taxtastic.taxtable import TaxNode as _TaxNode
-from .. import config, wrap, util, outliers
+from .. import (config, diststore, execution, kmer, progress, wrap, util,
+               outliers)
 
 log = logging.getLogger(__name__)
 
 DEFAULT_RANK = 'species'
 DEFAULT_ALIGNER = 'cmalign'
+ALIGNERS = ['cmalign', 'muscle', 'vsearch', 'kmer']
 DROP = 'drop'
 KEEP = 'keep'
 BLAST6NAMES = ['query', 'target', 'pct_id', 'align_len', 'mismatches', 'gaps',
                'qstart', 'qend', 'tstart', 'tend', 'evalue', 'bit_score']
+BLAST6_CHUNKSIZE = 1000000
+EXACT = 'exact'
+SAMPLED = 'sampled'
+
+"""Columns of ``--detailed-seqinfo`` describing the outcome of filtering,
+with a column for the tax_id at ``--filter-rank``"""
+DETAIL_COLUMNS = ['centroid', 'cluster', 'dist', 'is_out', 'x', 'y']
+
+"""Sequences per thread allocated to a taxon with --cores"""
+SEQS_PER_THREAD = 250
+
+TIMING_FIELDS = ['tax_id', 'tax_name', 'n_seqs', 'threads', 'seconds',
+                 'source']
 
 
 # monkey patch class from taxtastic to warn when tax_id is missing
@@ -119,6 +166,21 @@ class TaxNode(_TaxNode):
                                 'was not found in the taxonomy'.format(**row))
 
 
+def shard_arg(value):
+    """
+    Parse ``I/N`` into a tuple of ints
+    """
+    try:
+        shard, n_shards = [int(i) for i in value.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            'expected I/N, got {}'.format(value))
+    if not 1 <= shard <= n_shards:
+        raise argparse.ArgumentTypeError(
+            'shard must be between 1 and {}, got {}'.format(n_shards, shard))
+    return shard, n_shards
+
+
 def build_parser(p):
     p.add_argument('sequence_file', help="""All sequences""")
     p.add_argument('seqinfo_file', help="""Sequence info file""")
@@ -131,6 +193,14 @@ def build_parser(p):
         help="""Output of --detailed-seqinfo from a previous run. If provided, use
         the previous results for any tax_ids represented by the same set of
         sequences in both sequence_file and this file.""")
+    input_group.add_argument(
+        '--distance-store', metavar='DIR',
+        help="""Directory of distance matrices for each tax_id, created if
+        necessary and updated with the distances calculated in this run.
+        Distances among sequences already in the store are reused, and
+        only distances to new sequences are calculated (with
+        --aligner=cmalign, only new sequences are aligned). Must be
+        visible to all workers with --executor=queue.""")
 
     output_group = p.add_argument_group('output options')
     output_group.add_argument(
@@ -143,6 +213,19 @@ def build_parser(p):
     output_group.add_argument(
         '--detailed-seqinfo', metavar='FILE',
         help="""Sequence info, including filtering details""")
+    output_group.add_argument(
+        '--embedding', choices=outliers.EMBEDDINGS,
+        help="""Method of calculating the x and y coordinates of each
+        sequence in --detailed-seqinfo: 'classical' MDS (one
+        eigendecomposition), 'smacof' (iterative metric MDS; slow for
+        large taxa), 'landmark' MDS (classical MDS of --landmarks
+        sequences, with the rest placed relative to them; for large
+        taxa), or 'none'. [default: 'smacof' with --detailed-seqinfo,
+        otherwise 'none']""")
+    output_group.add_argument(
+        '--landmarks', type=int, default=outliers.LANDMARKS, metavar='N',
+        help="""Number of landmarks for --embedding=landmark [default:
+        %(default)s]""")
 
     filter_group = p.add_argument_group('filtering options')
 
@@ -178,15 +261,40 @@ def build_parser(p):
         clustering (--strategy='cluster'). Overrides distance
         calculation using --distance-percentile if provided [default:
         %(default)s]""")
+    filter_group.add_argument(
+        '--medoid', choices=[EXACT, SAMPLED], default=EXACT,
+        help="""How to find the medoid with --strategy=radius. '{}'
+        compares medoid candidates from a random subsample of
+        --medoid-sample-size sequences with all sequences, computing
+        distances from only those candidates rather than among all
+        sequences; x and y are not calculated. [default:
+        %(default)s]""".format(SAMPLED))
+    filter_group.add_argument(
+        '--medoid-sample-size', type=int,
+        default=outliers.MEDOID_SAMPLE_SIZE, metavar='N',
+        help="""Subsample size for --medoid={} [default:
+        %(default)s]""".format(SAMPLED))
+    filter_group.add_argument(
+        '--medoid-check', action='store_true',
+        help="""With --medoid={}, also compute all distances to find the
+        exact medoid, and report the error of the approximation (slow;
+        the sampled medoid is still used)""".format(SAMPLED))
 
     aligner_group = p.add_argument_group("aligner-specific options")
     aligner_group.add_argument(
         '--aligner', help='multiple alignment tool [%(default)s]',
-        default=DEFAULT_ALIGNER, choices=['cmalign', 'muscle', 'vsearch'])
+        default=DEFAULT_ALIGNER, choices=ALIGNERS)
     aligner_group.add_argument(
         '--executable',
         help=('Optional absolute or relative path '
               'to the alignment tool executable'))
+    aligner_group.add_argument(
+        '--batch-seqs', type=int, default=0, metavar='N',
+        help="""With --aligner=cmalign, align taxa with fewer than N
+        sequences together, in batches of about N sequences, with one
+        cmalign run per batch. Results are the same as for taxa aligned
+        separately. Not used with --medoid=sampled or --distance-store
+        [default: %(default)s (no batches)]""")
 
     rare_group = p.add_argument_group("rare taxa")
     rare_group.add_argument(
@@ -203,6 +311,92 @@ def build_parser(p):
     p.add_argument('-t', '--threads-per-job', type=int, default=4,
                    help="""number of threads per job (eg, value to pass 'cmalign --cpu')
                    [default %(default)s]""")
+    p.add_argument('--cores', type=int, metavar='N',
+                   help="""total number of cores to use. Replaces --jobs and
+                   --threads-per-job: taxa are processed largest first,
+                   with threads in proportion to their size""")
+    p.add_argument('--shard', type=shard_arg, metavar='I/N',
+                   help="""filter only shard I of N (1 <= I <= N), a subset
+                   of the taxa with about 1/N of the sequences. Sequences
+                   classified above --filter-rank are in shard 1. Combine
+                   the --detailed-seqinfo of each shard with
+                   'deenurp filter_outliers_merge'""")
+    p.add_argument('--timing-report', metavar='FILE',
+                   help="""write the number of threads and elapsed seconds
+                   for each taxon to FILE (csv)""")
+    execution.add_arguments(p)
+
+
+def job_threads(n_seqs, cores):
+    """
+    Threads for a taxon of ``n_seqs`` sequences: one per
+    ``SEQS_PER_THREAD``, between 1 and ``cores``.
+    """
+    return int(max(1, min(cores, -(-n_seqs // SEQS_PER_THREAD))))
+
+
+def shard_taxa(groups, n_shards):
+    """
+    Divide ``groups`` of (node, seqs) into ``n_shards`` lists with about
+    the same number of sequences, each largest first. The assignment
+    depends only on tax_ids and numbers of sequences, so every shard of a
+    run reaches the same one.
+    """
+    shards = [[] for _ in range(n_shards)]
+    sizes = [0] * n_shards
+    for node, seqs in sorted(groups, key=lambda g: (-len(g[1]), g[0].tax_id)):
+        # the smallest shard so far
+        i = sizes.index(min(sizes))
+        shards[i].append((node, seqs))
+        sizes[i] += len(seqs)
+    return shards
+
+
+def write_outputs(outcomes, sequence_file, seqinfo_file, seqnames,
+                  output_seqs, filtered_seqinfo=None, detailed_seqinfo=None):
+    """
+    Write the outputs of filtering: sequences in ``sequence_file`` that
+    aren't outliers according to ``outcomes`` (a DataFrame indexed by
+    seqname) to ``output_seqs``, and rows of ``seqinfo_file`` for
+    ``seqnames`` to ``filtered_seqinfo`` (without outliers) and
+    ``detailed_seqinfo`` (joined with ``outcomes``).
+    """
+    kept_ids = set(outcomes.index[~outcomes.is_out.astype(bool)])
+
+    with output_seqs as fp:
+        # Extract all of the sequences that passed.
+        log.info('Extracting %d sequences', len(kept_ids))
+        wrap.esl_sfetch(sequence_file, kept_ids, fp)
+
+    # Filter seqinfo for sequences that passed.
+    seqinfo = pd.read_csv(
+        seqinfo_file, dtype={'seqname': str, 'tax_id': str, 'gi': str})
+    seqinfo = seqinfo.loc[seqinfo['seqname'].isin(seqnames)]
+    seqinfo.set_index('seqname', inplace=True)
+
+    merged = seqinfo.join(outcomes, lsuffix='.left')
+
+    # csv output
+    if filtered_seqinfo:
+        merged[~merged.is_out.astype(bool)].to_csv(
+            filtered_seqinfo,
+            columns=seqinfo.columns)
+
+    if detailed_seqinfo:
+        with open(detailed_seqinfo, 'w') as fp:
+            merged.to_csv(fp)
+
+
+def write_timing_report(rows, fp):
+    """
+    Write timing ``rows`` (dicts with ``TIMING_FIELDS``) to ``fp``, slowest
+    first
+    """
+    writer = csv.DictWriter(fp, fieldnames=TIMING_FIELDS,
+                            lineterminator='\n')
+    writer.writeheader()
+    for row in sorted(rows, key=lambda r: r['seconds'], reverse=True):
+        writer.writerow(dict(row, seconds='{0:.3f}'.format(row['seconds'])))
 
 
 def sequences_above_rank(taxonomy, rank=DEFAULT_RANK):
@@ -230,20 +424,136 @@ def distmat_muscle(sequence_file, prefix, maxiters=wrap.MUSCLE_MAXITERS):
         wrap.muscle_files(sequence_file, a_fasta.name, maxiters=maxiters)
         a_fasta.flush()
 
-        taxa, distmat = outliers.fasttree_dists(a_fasta.name)
+        taxa, distmat = outliers.alignment_dists(
+            SeqIO.parse(a_fasta.name, 'fasta'))
 
     return taxa, distmat
 
 
+def reference_columns(stockholm):
+    """Return the indices of the columns of Stockholm alignment file
+    ``stockholm`` marked as consensus columns by its ``#=GC RF``
+    annotation.
+
+    """
+
+    rf = []
+    with open(stockholm) as fp:
+        for line in fp:
+            if line.startswith('#=GC RF'):
+                rf.append(line.split()[2])
+    return numpy.flatnonzero(numpy.frombuffer(''.join(rf), dtype='S1') != '.')
+
+
+def distmat_kmer(sequence_file, k=kmer.DISTANCE_KMER_SIZE):
+    """Calculate a distance matrix from the k-mers shared by unaligned
+    sequences with ``kmer.kmer_distances``.
+
+    """
+
+    return kmer.kmer_distances(SeqIO.parse(sequence_file, 'fasta'), k)
+
+
+def cmalign_fasta(sequence_file, a_fasta, prefix, cpu=wrap.CMALIGN_THREADS,
+                  min_bitscore=10, match_fasta=None):
+    """Align ``sequence_file`` with cmalign, writing the alignment to
+    file object ``a_fasta`` (unless None) in FASTA format. If
+    ``match_fasta`` is given, the consensus columns of the alignment are
+    also written to it; these are the same for sequences aligned
+    separately.
+
+    """
+
+    with util.ntf(prefix=prefix, suffix='.aln') as a_sto:
+        scores = wrap.cmalign_files(sequence_file, a_sto.name, cpu=cpu)
+
+        low_scores = scores['bit_sc'] < min_bitscore
+        if low_scores.any():
+            msg = 'The following sequences aligned with bit score < {}: {}'
+            log.warning(msg.format(min_bitscore, scores[low_scores].index))
+
+        # distances are calculated from the alignment in FASTA format
+        if a_fasta is not None:
+            SeqIO.convert(a_sto, 'stockholm', a_fasta, 'fasta')
+            a_fasta.flush()
+
+        if match_fasta is not None:
+            columns = reference_columns(a_sto.name)
+            for record in SeqIO.parse(a_sto.name, 'stockholm'):
+                seq = numpy.frombuffer(str(record.seq), dtype='S1')
+                match_fasta.write('>{}\n{}\n'.format(
+                    record.id, seq[columns].tostring()))
+            match_fasta.flush()
+
+
 def distmat_cmalign(
         sequence_file,
         prefix,
         cpu=wrap.CMALIGN_THREADS,
         min_bitscore=10):
 
-    with util.ntf(prefix=prefix, suffix='.aln') as a_sto, \
-            util.ntf(prefix=prefix, suffix='.fasta') as a_fasta:
+    with util.ntf(prefix=prefix, suffix='.fasta') as a_fasta:
+        cmalign_fasta(sequence_file, a_fasta, prefix, cpu=cpu,
+                      min_bitscore=min_bitscore)
+        taxa, distmat = outliers.alignment_dists(
+            SeqIO.parse(a_fasta.name, 'fasta'), threads=cpu or 1)
+
+    return taxa, distmat
+
+
+def split_alignment(records, columns, groups):
+    """Split ``records``, aligned together by cmalign with consensus
+    ``columns`` (see ``reference_columns``), into a separate alignment
+    for each list of names in ``groups``.
+
+    cmalign aligns each sequence to the model independently, so only the
+    insert columns depend on the other sequences: these are removed where
+    all the sequences of a group have gaps. This reproduces the alignment
+    of the group by itself as long as insertions are flush left; a group
+    with any insertion that isn't (which can't be laid out the same way)
+    is None in the result.
+
+    """
+    records = list(records)
+    index = dict((r.id, i) for i, r in enumerate(records))
+    chars = numpy.array([numpy.frombuffer(str(r.seq), dtype='S1')
+                         for r in records])
+    occupied = ~numpy.in1d(chars, ['-', '.']).reshape(chars.shape)
+
+    consensus = numpy.zeros(chars.shape[1], dtype=bool)
+    consensus[columns] = True
+    inserts = numpy.flatnonzero(~consensus)
+    # insert columns between the same pair of consensus columns
+    region = numpy.cumsum(consensus)[inserts]
+    same_region = region[1:] == region[:-1]
+
+    result = []
+    for names in groups:
+        rows = [index[name] for name in names]
+        in_insert = occupied[numpy.ix_(rows, inserts)]
+        not_flush = in_insert[:, 1:] & ~in_insert[:, :-1]
+        if not_flush[:, same_region].any():
+            result.append(None)
+            continue
+        keep = consensus.copy()
+        keep[inserts] = in_insert.any(axis=0)
+        result.append([
+            SeqRecord(Seq(chars[i, keep].tostring()), id=records[i].id,
+                      description='')
+            for i in rows])
+    return result
+
+
+def cmalign_batch(sequence_file, groups, prefix, cpu=wrap.CMALIGN_THREADS,
+                  min_bitscore=10):
+    """Align the sequences in ``sequence_file`` with one run of cmalign,
+    returning an alignment (list of SeqRecords) for each list of names in
+    ``groups``, or None for groups which must be aligned separately (see
+    ``split_alignment``).
+
+    """
 
+    with util.ntf(prefix=prefix, suffix='.aln') as a_sto:
         scores = wrap.cmalign_files(sequence_file, a_sto.name, cpu=cpu)
 
         low_scores = scores['bit_sc'] < min_bitscore
@@ -251,57 +561,268 @@ def distmat_cmalign(
             msg = 'The following sequences aligned with bit score < {}: {}'
             log.warning(msg.format(min_bitscore, scores[low_scores].index))
 
-        # FastTree requires FASTA
-        SeqIO.convert(a_sto, 'stockholm', a_fasta, 'fasta')
-        a_fasta.flush()
+        return split_alignment(SeqIO.parse(a_sto.name, 'stockholm'),
+                               reference_columns(a_sto.name), groups)
+
+
+def distmat_stored(tax_id, sequence_file, prefix, aligner, distance_store,
+                   executable=None, iddef=wrap.VSEARCH_IDDEF, threads=None,
+                   maxiters=wrap.MUSCLE_MAXITERS):
+    """Calculate a distance matrix for ``tax_id`` like ``distmat_cmalign``,
+    ``distmat_muscle`` or ``distmat_pairwise``, reusing distances among
+    sequences saved in directory ``distance_store`` by a previous run, and
+    saving the result.
+
+    If the stored distances for ``tax_id`` cover enough of the sequences
+    (see ``diststore.MAX_NEW_FRACTION``), only distances from new
+    sequences are calculated: with vsearch by searching the new sequences
+    against all others, and with cmalign by aligning only the new
+    sequences. Insert columns depend on the other sequences in an
+    alignment, so stored cmalign distances are always calculated from the
+    consensus columns, including the first time (they may differ slightly
+    from those of ``distmat_cmalign``). Alignments from muscle depend on
+    all sequences, so any new sequence requires recalculating all
+    distances.
 
-        taxa, distmat = outliers.fasttree_dists(a_fasta.name)
+    """
 
+    store = diststore.DistanceStore(distance_store)
+    params = {'aligner': aligner}
+    if aligner == 'cmalign':
+        params['columns'] = 'consensus'
+    elif aligner == 'vsearch':
+        params['iddef'] = iddef
+    elif aligner == 'muscle':
+        params['maxiters'] = maxiters
+    elif aligner == 'kmer':
+        params['k'] = kmer.DISTANCE_KMER_SIZE
+
+    records = list(SeqIO.parse(sequence_file, 'fasta'))
+    taxa = [r.id for r in records]
+    stored = store.get(tax_id, params)
+    new = numpy.arange(len(taxa)) if stored is None else \
+        diststore.new_names(stored, taxa)
+    if aligner == 'cmalign' and stored is not None and stored.aligned is None:
+        new = numpy.arange(len(taxa))  # can't align incrementally
+
+    incremental = len(new) <= len(taxa) * diststore.MAX_NEW_FRACTION and \
+        (aligner != 'muscle' or len(new) == 0)
+    progress.increment('stored_sequences',
+                       len(taxa) - len(new) if incremental else 0)
+    progress.increment('new_sequences',
+                       len(new) if incremental else len(taxa))
+
+    aligned = None
+    if incremental and aligner == 'cmalign':
+        aligned = dict(stored.aligned)
+        if len(new):
+            with util.as_fasta([records[i] for i in new]) as new_fasta, \
+                    util.ntf(prefix=prefix, suffix='.fasta') as m_fasta:
+                cmalign_fasta(new_fasta, None, prefix,
+                              cpu=threads or wrap.CMALIGN_THREADS,
+                              match_fasta=m_fasta)
+                aligned.update(SeqIO.to_dict(
+                    SeqIO.parse(m_fasta.name, 'fasta')))
+        aligned = [aligned[t] for t in taxa]
+        distmat = diststore.update(
+            stored, taxa, outliers.AlignmentProfiles(aligned).distances)
+    elif incremental and aligner == 'vsearch':
+        distmat = diststore.update(stored, taxa, functools.partial(
+            vsearch_block, records, executable=executable, iddef=iddef,
+            threads=threads or wrap.VSEARCH_THREADS))
+    elif incremental and aligner == 'kmer':
+        distmat = diststore.update(
+            stored, taxa, kmer.KmerProfiles(records).distances)
+    elif incremental:
+        distmat = diststore.update(stored, taxa, None)
+    elif aligner == 'cmalign':
+        with util.ntf(prefix=prefix, suffix='.fasta') as m_fasta:
+            cmalign_fasta(sequence_file, None, prefix,
+                          cpu=threads or wrap.CMALIGN_THREADS,
+                          match_fasta=m_fasta)
+            aligned = list(SeqIO.parse(m_fasta.name, 'fasta'))
+        # the same columns as sequences added incrementally
+        taxa, distmat = outliers.alignment_dists(
+            aligned, threads=threads or wrap.CMALIGN_THREADS)
+    elif aligner == 'muscle':
+        taxa, distmat = distmat_muscle(sequence_file, prefix, maxiters)
+    elif aligner == 'vsearch':
+        taxa, distmat = distmat_pairwise(
+            sequence_file, prefix, aligner, executable, iddef,
+            threads=threads or wrap.VSEARCH_THREADS)
+    elif aligner == 'kmer':
+        taxa, distmat = distmat_kmer(sequence_file)
+
+    store.put(tax_id, params, taxa, distmat, aligned=aligned)
     return taxa, distmat
 
 
+def vsearch_block(records, rows, cols, executable=None,
+                  iddef=wrap.VSEARCH_IDDEF, threads=wrap.VSEARCH_THREADS):
+    """Distances between unaligned sequences ``records[i]`` for ``i`` in
+    ``rows`` and ``cols`` (index arrays) using global alignments from
+    vsearch. Pairs without an alignment are NaN.
+
+    """
+
+    queries = [records[i].id for i in rows]
+    targets = [records[i].id for i in cols]
+    result = numpy.repeat(numpy.float32(numpy.nan), len(rows) * len(cols))
+    result.shape = (len(rows), len(cols))
+
+    with util.as_fasta([records[i] for i in rows]) as query, \
+            util.as_fasta([records[i] for i in numpy.unique(cols)]) as db, \
+            util.ntf(suffix='.blast6out') as out:
+        wrap.vsearch_pairs_files(query, db, out.name,
+                                 executable=executable or wrap.VSEARCH,
+                                 iddef=iddef, threads=threads)
+        try:
+            hits = pd.read_csv(
+                out.name, sep='\t', header=None, usecols=[0, 1, 2, 3],
+                names=BLAST6NAMES[:4],
+                dtype={'query': str, 'target': str, 'pct_id': numpy.float32,
+                       'align_len': numpy.int32})
+        except EmptyDataError:
+            hits = None
+
+    if hits is not None:
+        # the longest alignment of each pair is written last
+        hits = hits.sort_values('align_len', kind='mergesort')
+        ii = pd.Index(queries).get_indexer(hits['query'])
+        jj = pd.Index(targets).get_indexer(hits['target'])
+        result[ii, jj] = 1.0 - hits['pct_id'].values / numpy.float32(100.0)
+
+    result[numpy.asarray(rows)[:, None] == numpy.asarray(cols)[None, :]] = 0
+    return result
+
+
+def sampled_dists(sequence_file, prefix, aligner, executable=None,
+                  iddef=wrap.VSEARCH_IDDEF, threads=None,
+                  maxiters=wrap.MUSCLE_MAXITERS,
+                  sample_size=outliers.MEDOID_SAMPLE_SIZE, random_state=0):
+    """Find an approximate medoid of the sequences in ``sequence_file``
+    with ``outliers.sampled_medoid``, computing distances with
+    ``aligner`` only from subsampled sequences and medoid candidates.
+
+    Returns (taxa, medoid, dists), where ``dists`` are the distances from
+    the medoid to each of ``taxa``.
+
+    """
+
+    with util.ntf(prefix=prefix, suffix='.fasta') as a_fasta:
+        if aligner == 'cmalign':
+            cmalign_fasta(sequence_file, a_fasta, prefix,
+                          cpu=threads or wrap.CMALIGN_THREADS)
+        elif aligner == 'muscle':
+            wrap.muscle_files(sequence_file, a_fasta.name, maxiters=maxiters)
+
+        if aligner == 'vsearch':
+            records = list(SeqIO.parse(sequence_file, 'fasta'))
+            distances = functools.partial(
+                vsearch_block, records, executable=executable, iddef=iddef,
+                threads=threads or wrap.VSEARCH_THREADS)
+        elif aligner == 'kmer':
+            records = list(SeqIO.parse(sequence_file, 'fasta'))
+            distances = kmer.KmerProfiles(records).distances
+        else:
+            records = list(SeqIO.parse(a_fasta.name, 'fasta'))
+            distances = outliers.AlignmentProfiles(records).distances
+
+        medoid, dists = outliers.sampled_medoid(
+            distances, len(records), sample_size=sample_size,
+            random_state=random_state)
+
+    return [r.id for r in records], medoid, dists
+
+
+def medoid_error(tax_id, taxa, distmat, medoid):
+    """Compare approximate ``medoid`` with the exact medoid of
+    ``distmat``, logging the difference and writing it to the metrics
+    stream. Returns the difference in median distance to all sequences.
+
+    """
+
+    exact = outliers.find_medoid(distmat)
+    exact_median = float(numpy.nanmedian(distmat[exact, :]))
+    sampled_median = float(numpy.nanmedian(distmat[medoid, :]))
+    error = sampled_median - exact_median
+    log.info('tax_id %s: sampled medoid %s (median distance %.5f), exact '
+             'medoid %s (%.5f)', tax_id, taxa[medoid], sampled_median,
+             taxa[exact], exact_median)
+    progress.emit('medoid_check', tax_id=tax_id, n_seqs=len(taxa),
+                  sampled=taxa[medoid], exact=taxa[exact],
+                  sampled_median=sampled_median, exact_median=exact_median,
+                  error=error)
+    return error
+
+
 class UsearchError(Exception):
     pass
 
 
-def parse_usearch_allpairs(filename, seqnames):
+def parse_usearch_allpairs(filename, seqnames, chunksize=BLAST6_CHUNKSIZE):
     """Read output of ``usearch -allpairs_global -blast6out`` and return a
-    square distance matrix. ``seqnames`` determines the marginal order
-    of sequences in the matrix.
-
-    """
+    ``outliers.DistanceMatrix``. ``seqnames`` determines the marginal
+    order of sequences in the matrix.
 
-    data = pd.read_table(filename, header=None, names=BLAST6NAMES)
-    data['dist'] = pd.Series(
-        1.0 - data['pct_id'] / 100.0, index=data.index)
+    Only the query, target, pct_id and align_len columns are read, in
+    chunks of ``chunksize`` rows, directly into a preallocated float32
+    condensed matrix. If a sequence pair appears more than once, in
+    either order, the longest alignment is used (the first occurrence if
+    there are two the same length).
 
-    # for each sequence pair, select the longest alignment if there is
-    # more than one (chooses first occurrence if there are two the same
-    # length).
-    maxidx = data.groupby(['query', 'target']).apply(
-        lambda x: x['align_len'].idxmax())
-    data = data.iloc[maxidx]
+    """
 
-    if set(seqnames) != set(data['query']) | set(data['target']):
+    nseqs = len(seqnames)
+    index = pd.Index(seqnames)
+    distmat = outliers.DistanceMatrix.empty(nseqs)
+    # length of the alignment providing each distance; -1 if none yet
+    align_len = numpy.repeat(numpy.int32(-1), len(distmat.data))
+    seen = numpy.zeros(nseqs, dtype=bool)
+
+    chunks = pd.read_csv(
+        filename, sep='\t', header=None, usecols=[0, 1, 2, 3],
+        names=BLAST6NAMES[:4], chunksize=chunksize,
+        dtype={'query': str, 'target': str, 'pct_id': numpy.float32,
+               'align_len': numpy.int32})
+
+    for chunk in chunks:
+        ii = index.get_indexer(chunk['query'])
+        jj = index.get_indexer(chunk['target'])
+        if (ii < 0).any() or (jj < 0).any():
+            raise UsearchError(
+                'unexpected sequences in the output ({})'.format(filename))
+        seen[ii] = True
+        seen[jj] = True
+
+        # usearch_allpairs_files returns comparisons corresponding to a
+        # triangular matrix, whereas vsearch_allpairs_files returns all
+        # comparisons: both orders of a pair share a position in the
+        # condensed matrix.
+        distinct = ii != jj
+        pos = distmat.index(numpy.minimum(ii, jj)[distinct],
+                            numpy.maximum(ii, jj)[distinct])
+        lengths = chunk['align_len'].values[distinct]
+        dists = 1.0 - chunk['pct_id'].values[distinct] / numpy.float32(100.0)
+
+        # Order rows so that the preferred alignment for each pair is
+        # written last: by increasing length, then by decreasing position
+        # within the chunk.
+        order = numpy.lexsort((-numpy.arange(len(lengths)), lengths))
+        pos, lengths, dists = pos[order], lengths[order], dists[order]
+
+        # Alignments from earlier chunks win ties
+        better = lengths > align_len[pos]
+        pos = pos[better]
+        distmat.data[pos] = dists[better]
+        align_len[pos] = lengths[better]
+
+    if not seen.all():
         # shutil.copy(filename, '.')
         raise UsearchError(
             'some sequences are missing from the output ({})'.format(filename))
 
-    nseqs = len(seqnames)
-    distmat = numpy.repeat(0.0, nseqs ** 2)
-    distmat.shape = (nseqs, nseqs)
-    ii = pd.match(data['query'], seqnames)
-    jj = pd.match(data['target'], seqnames)
-
-    # usearch_allpairs_files returns comparisons corresponding to a
-    # triangular matrix, whereas vsearch_allpairs_files returns all
-    # comparisons. Here we convert both to a square matrix.
-    if data.shape[0] == nseqs * nseqs:
-        distmat[ii, jj] = data['dist']
-    elif data.shape[0] == (nseqs * (nseqs - 1)) / 2:
-        distmat[ii, jj] = data['dist']
-        distmat[jj, ii] = data['dist']
-    else:
+    if (align_len < 0).any():
         msg = 'not all pairwise comparisons are represented ({})'
         raise UsearchError(msg.format(filename))
 
@@ -354,34 +875,74 @@ def filter_sequences(tax_id,
                      executable=None,
                      maxiters=wrap.MUSCLE_MAXITERS,
                      iddef=wrap.VSEARCH_IDDEF,
-                     threads=None):
+                     threads=None,
+                     medoid=EXACT,
+                     medoid_sample_size=outliers.MEDOID_SAMPLE_SIZE,
+                     medoid_check=False,
+                     embedding='smacof',
+                     landmarks=outliers.LANDMARKS,
+                     distance_store=None):
     """
     Return a list of sequence names identifying outliers.
+
+    With ``medoid='sampled'`` and ``strategy='radius'``, the medoid is
+    approximated with ``sampled_dists`` unless ``distmat`` is provided;
+    ``medoid_check`` also computes the full distance matrix to report
+    the error of the approximation.
+
+    The x and y columns are calculated using ``outliers.embed`` with
+    method ``embedding`` (NaN for 'none' and for a sampled medoid).
+
+    If ``distance_store`` (a directory) is given, distances are reused
+    from and saved to it with ``distmat_stored``.
     """
 
-    assert aligner in {'cmalign', 'muscle', 'vsearch'}, 'invalid aligner: ' + aligner
+    assert aligner in ALIGNERS, 'invalid aligner: ' + aligner
     assert strategy in {'radius', 'cluster'}, 'invalid strategy: ' + strategy
     assert cluster_type in {'single', 'RobustSingleLinkage'}, \
         'invalid cluster_type ' + cluster_type
 
     prefix = '{}_'.format(tax_id)
 
-    if distmat is None:
-        log.debug('running {} on {}'.format(aligner, tax_id))
-        if aligner == 'cmalign':
-            taxa, distmat = distmat_cmalign(
-                sequence_file, prefix, cpu=threads or wrap.CMALIGN_THREADS)
-        elif aligner == 'muscle':
-            taxa, distmat = distmat_muscle(sequence_file, prefix, maxiters)
-        elif aligner == 'vsearch':
-            taxa, distmat = distmat_pairwise(
+    sampled = None
+    if medoid == SAMPLED and strategy == 'radius' and distmat is None:
+        with progress.stage('sampled_medoid', tax_id=tax_id, aligner=aligner):
+            taxa, approx_medoid, approx_dists = sampled_dists(
                 sequence_file, prefix, aligner, executable, iddef,
-                threads=threads or wrap.VSEARCH_THREADS)
+                threads=threads, maxiters=maxiters,
+                sample_size=medoid_sample_size)
+        sampled = approx_medoid, approx_dists
+
+    if distmat is None and (sampled is None or medoid_check):
+        log.debug('running {} on {}'.format(aligner, tax_id))
+        with progress.stage('distances', tax_id=tax_id, aligner=aligner):
+            if distance_store:
+                taxa, distmat = distmat_stored(
+                    tax_id, sequence_file, prefix, aligner, distance_store,
+                    executable=executable, iddef=iddef, threads=threads,
+                    maxiters=maxiters)
+            elif aligner == 'cmalign':
+                taxa, distmat = distmat_cmalign(
+                    sequence_file, prefix, cpu=threads or wrap.CMALIGN_THREADS)
+            elif aligner == 'muscle':
+                taxa, distmat = distmat_muscle(sequence_file, prefix, maxiters)
+            elif aligner == 'vsearch':
+                taxa, distmat = distmat_pairwise(
+                    sequence_file, prefix, aligner, executable, iddef,
+                    threads=threads or wrap.VSEARCH_THREADS)
+            elif aligner == 'kmer':
+                taxa, distmat = distmat_kmer(sequence_file)
     else:
         assert taxa is not None
 
+    if sampled is not None and medoid_check:
+        medoid_error(tax_id, taxa, distmat, sampled[0])
+
     if cutoff is not None:
         cutoff = cutoff
+    elif percentile is not None and sampled is not None:
+        cutoff = outliers.bounded_percentile(
+            sampled[1], percentile, min_radius, max_radius)
     elif percentile is not None:
         cutoff = outliers.scaled_radius(
             distmat, percentile, min_radius, max_radius)
@@ -392,13 +953,19 @@ def filter_sequences(tax_id,
         cutoff, 'calculated' if percentile else 'pre-defined'))
 
     log.info('strategy: {}'.format(strategy))
-    if strategy == 'radius':
-        medoid, dists, is_out = outliers.outliers(distmat, cutoff)
-        clusters = numpy.repeat(medoid, len(taxa))
-    elif strategy == 'cluster':
-        medoid, dists, is_out, clusters = outliers.outliers_by_cluster(
-            distmat, t=cutoff, D=1.5,
-            min_size=2, cluster_type=cluster_type)
+    with progress.stage('outliers', tax_id=tax_id, strategy=strategy):
+        if sampled is not None:
+            medoid, dists = sampled
+            with numpy.errstate(invalid='ignore'):
+                is_out = dists > cutoff
+            clusters = numpy.repeat(medoid, len(taxa))
+        elif strategy == 'radius':
+            medoid, dists, is_out = outliers.outliers(distmat, cutoff)
+            clusters = numpy.repeat(medoid, len(taxa))
+        elif strategy == 'cluster':
+            medoid, dists, is_out, clusters = outliers.outliers_by_cluster(
+                distmat, t=cutoff, D=1.5,
+                min_size=2, cluster_type=cluster_type)
 
     assert len(is_out) == len(taxa)
 
@@ -409,8 +976,12 @@ def filter_sequences(tax_id,
         'is_out': is_out,
         'cluster': clusters})
 
-    mds = outliers.mds(distmat, taxa)
-    result = pd.merge(result, mds, how='left', on='seqname')
+    if sampled is not None:
+        # no distance matrix to embed
+        embedding = 'none'
+    with progress.stage('embedding', tax_id=tax_id, method=embedding):
+        coords = outliers.embed(distmat, taxa, embedding, n_landmarks=landmarks)
+    result = pd.merge(result, coords, how='left', on='seqname')
 
     return result
 
@@ -441,7 +1012,13 @@ def filter_worker(tax_id,
                   max_radius,
                   aligner,
                   executable,
-                  threads):
+                  threads,
+                  medoid=EXACT,
+                  medoid_sample_size=outliers.MEDOID_SAMPLE_SIZE,
+                  medoid_check=False,
+                  embedding='smacof',
+                  landmarks=outliers.LANDMARKS,
+                  distance_store=None):
     """
     Worker task for running filtering tasks.
 
@@ -456,6 +1033,8 @@ def filter_worker(tax_id,
     :{min, max}_radius: Bounds of calculated distance cutoff
     :cluster_type: clustering algorithm (method of scipy.cluster.hierarchy)
     :aligner: name of alignment program
+    :medoid, medoid_sample_size, medoid_check, embedding, landmarks,
+     distance_store: see ``filter_sequences()``
     :executable: name or path of executable for alignmment program
 
     :returns: output of ``filter_sequences()``
@@ -479,18 +1058,61 @@ def filter_worker(tax_id,
             max_radius=max_radius,
             aligner=aligner,
             executable=executable,
-            threads=threads)
+            threads=threads,
+            medoid=medoid,
+            medoid_sample_size=medoid_sample_size,
+            medoid_check=medoid_check,
+            embedding=embedding,
+            landmarks=landmarks,
+            distance_store=distance_store)
 
         return filtered
 
 
-def action(a):
-    # remove .ssi index for sequence file if it exists
-    try:
-        os.remove(a.sequence_file + '.ssi')
-    except OSError:
-        pass
+def filter_batch_worker(batch, sequence_file, threads, **kwargs):
+    """
+    Worker task for filtering several small taxa, aligned together with a
+    single run of cmalign.
+
+    Arguments:
+    :batch: list of (tax_id, seqs) pairs
+    :sequence_file: Complete sequence file
+    :threads: value to pass 'cmalign --cpu'
+    :kwargs: other arguments of ``filter_worker()``
+
+    :returns: list of outputs of ``filter_sequences()``, one for each
+     tax_id in ``batch``, the same as those of ``filter_worker()``
+    """
+
+    groups = [list(seqs) for _, seqs in batch]
+    prefix = 'batch_{}_'.format(batch[0][0])
+    options = dict(kwargs)
+    options['cutoff'] = options.pop('distance_cutoff')
+
+    with util.ntf(prefix=prefix, suffix='.fasta') as tf:
+        wrap.esl_sfetch(sequence_file, (s for g in groups for s in g), tf)
+        tf.flush()
+
+        with progress.stage('batch_alignment', taxa=len(batch)):
+            alignments = cmalign_batch(
+                tf.name, groups, prefix, cpu=threads or wrap.CMALIGN_THREADS)
+
+    results = []
+    for (tax_id, seqs), aligned in zip(batch, alignments):
+        if aligned is None:
+            log.info('aligning tax_id %s separately', tax_id)
+            results.append(filter_worker(
+                tax_id, sequence_file, seqs, threads=threads, **kwargs))
+            continue
+        with progress.stage('distances', tax_id=tax_id, aligner='cmalign'):
+            taxa, distmat = outliers.alignment_dists(
+                aligned, threads=threads or wrap.CMALIGN_THREADS)
+        results.append(filter_sequences(
+            tax_id, distmat=distmat, taxa=taxa, threads=threads, **options))
+    return results
 
+
+def action(a):
     # itemize sequences provided in the input file
     seqnames = {seq.name for seq in peasel.read_seq_file(a.sequence_file)}
 
@@ -511,15 +1133,18 @@ def action(a):
 
     executable = a.executable or {'cmalign': 'cmalign',
                                   'muscle': 'muscle',
-                                  'vsearch': wrap.VSEARCH}[a.aligner]
+                                  'vsearch': wrap.VSEARCH,
+                                  'kmer': None}[a.aligner]
+
+    # coordinates are only written to --detailed-seqinfo
+    embedding = a.embedding or ('smacof' if a.detailed_seqinfo else 'none')
 
     if (a.previous_details and
             os.path.isfile(a.previous_details) and
             os.stat(a.previous_details).st_size):
         dtype = {'seqname': str, 'tax_id': str, a.filter_rank: str, 'gi': str}
         # columns in output of `filter_worker`
-        filter_worker_cols = [
-            'centroid', 'cluster', 'dist', 'is_out', 'seqname', 'x', 'y']
+        filter_worker_cols = sorted(DETAIL_COLUMNS + ['seqname'])
         previous_details = pd.read_csv(
             a.previous_details, dtype=dtype).groupby(a.filter_rank)
     else:
@@ -529,12 +1154,13 @@ def action(a):
 
     # Sequences which are classified above the desired rank should just be kept
     names_above_rank = list(sequences_above_rank(taxonomy, a.filter_rank))
-    log.info('Keeping %d sequences classified above %s',
-             len(names_above_rank), a.filter_rank)
-    above_rank = mock_filter(names_above_rank, keep=True)
-    above_rank[a.filter_rank] = pd.Series(
-        numpy.nan, index=above_rank.index)
-    outcomes.append(above_rank)
+    if not a.shard or a.shard[0] == 1:
+        log.info('Keeping %d sequences classified above %s',
+                 len(names_above_rank), a.filter_rank)
+        above_rank = mock_filter(names_above_rank, keep=True)
+        above_rank[a.filter_rank] = pd.Series(
+            numpy.nan, index=above_rank.index)
+        outcomes.append(above_rank)
 
     # For each filter-rank, filter
     nodes = [i for i in taxonomy if i.rank == a.filter_rank]
@@ -546,12 +1172,71 @@ def action(a):
         if s not in names_above_rank and s not in names_at_rank:
             raise ValueError(s + ' missing tax_id at filter rank')
 
-    # Filter each tax_id, running ``--jobs`` tasks in parallel
-    with futures.ThreadPoolExecutor(a.jobs) as executor:
+    # largest taxa first, so that they don't hold up the end of the run
+    groups = [(node, frozenset(node.subtree_sequence_ids())) for node in nodes]
+    groups.sort(key=lambda g: len(g[1]), reverse=True)
+    if a.shard:
+        shard, n_shards = a.shard
+        groups = shard_taxa(groups, n_shards)[shard - 1]
+        log.info('shard %d of %d: %d taxa with %d sequences', shard,
+                 n_shards, len(groups), sum(len(s) for _, s in groups))
+
+    # Filter each tax_id, running ``--jobs`` tasks in parallel, or as many
+    # as fit in ``--cores``
+    budget = None
+    max_workers = a.jobs
+    if a.cores:
+        max_workers = a.cores
+        if a.executor == execution.THREADS:
+            budget = execution.CoreBudget(a.cores)
+    executor = execution.get_executor(
+        a.executor, max_workers, a.queue_dir, a.local_workers)
+    # arguments of filter_worker and filter_batch_worker
+    options = dict(
+        sequence_file=a.sequence_file,
+        strategy=a.strategy,
+        distance_cutoff=a.distance_cutoff,
+        percentile=a.distance_percentile,
+        min_radius=a.min_distance,
+        max_radius=a.max_distance,
+        cluster_type=a.cluster_type,
+        aligner=a.aligner,
+        executable=executable,
+        medoid=a.medoid,
+        medoid_sample_size=a.medoid_sample_size,
+        medoid_check=a.medoid_check,
+        embedding=embedding,
+        landmarks=a.landmarks,
+        distance_store=a.distance_store)
+
+    def submit(fn, n_seqs, **kwargs):
+        """
+        Submit ``fn`` for ``n_seqs`` sequences, returning (future, threads)
+        """
+        if a.cores:
+            threads = job_threads(n_seqs, a.cores)
+        else:
+            threads = a.threads_per_job
+        task = (execution.timed, fn)
+        if budget:
+            task = (budget.run, threads) + task
+        kwargs.update(options)
+        return executor.submit(*task, threads=threads, **kwargs), threads
+
+    batch_seqs = a.batch_seqs
+    if batch_seqs and (a.aligner != 'cmalign' or a.medoid != EXACT or
+                       a.distance_store):
+        log.warning('--batch-seqs is only used with --aligner=cmalign, '
+                    '--medoid=%s and no --distance-store', EXACT)
+        batch_seqs = 0
+
+    timings = []
+    start = time.time()
+    with executor:
         # dispatch a pool of tasks
         futs = {}
-        for i, node in enumerate(nodes):
-            seqs = frozenset(node.subtree_sequence_ids())
+        batch = []  # small taxa to align together
+        for node, seqs in groups:
 
             if previous_details and node.tax_id in previous_details.groups:
                 prev_seqs = previous_details.get_group(node.tax_id)
@@ -559,46 +1244,60 @@ def action(a):
                 prev_seqs = None
 
             # in each case, `f` is a Future returning a DataFrame (see
-            # filter_sequences)
+            # filter_sequences), or a list of them for a batch, and the
+            # seconds taken
+            threads = 1
             if not seqs:
                 log.debug("No sequences for %s (%s)", node.tax_id, node.name)
                 continue
             elif len(seqs) < a.min_seqs_for_filtering:
                 log.debug('{} sequence(s) for {} ({}) [action: {}]'.format(
                     len(seqs), node.tax_id, node.name, a.rare_taxon_action))
-                f = executor.submit(mock_filter, seqs=list(seqs),
-                                    keep=a.rare_taxon_action == KEEP)
+                source = 'rare'
+                f = execution.completed(
+                    execution.timed, mock_filter, seqs=list(seqs),
+                    keep=a.rare_taxon_action == KEEP)
             elif prev_seqs is not None and set(prev_seqs['seqname']) == seqs:
                 # use previous results
                 log.info(
                     'using previous results for tax_id {}'.format(node))
-                f = executor.submit(
-                    lambda f: f, f=prev_seqs[filter_worker_cols])
+                source = 'previous'
+                f = execution.completed(
+                    execution.timed, lambda f: f,
+                    f=prev_seqs[filter_worker_cols])
+            elif len(seqs) < batch_seqs:
+                batch.append((node, seqs))
+                n_batched = sum(len(s) for _, s in batch)
+                if n_batched < batch_seqs:
+                    continue
+                f, threads = submit(
+                    filter_batch_worker, n_batched,
+                    batch=[(n.tax_id, s) for n, s in batch])
+                futs[f] = {'taxa': batch, 'batch': True,
+                           'threads': threads, 'source': 'batch'}
+                batch = []
+                continue
             else:
-                f = executor.submit(
-                    filter_worker,
-                    tax_id=node.tax_id,
-                    sequence_file=a.sequence_file,
-                    seqs=seqs,
-                    strategy=a.strategy,
-                    distance_cutoff=a.distance_cutoff,
-                    percentile=a.distance_percentile,
-                    min_radius=a.min_distance,
-                    max_radius=a.max_distance,
-                    cluster_type=a.cluster_type,
-                    aligner=a.aligner,
-                    executable=executable,
-                    threads=a.threads_per_job)
-
-            futs[f] = {'n_seqs': len(seqs), 'node': node}
+                source = 'filtered'
+                f, threads = submit(filter_worker, len(seqs),
+                                    tax_id=node.tax_id, seqs=seqs)
+
+            futs[f] = {'taxa': [(node, seqs)], 'batch': False,
+                       'threads': threads, 'source': source}
+
+        if batch:
+            f, threads = submit(
+                filter_batch_worker, sum(len(s) for _, s in batch),
+                batch=[(n.tax_id, s) for n, s in batch])
+            futs[f] = {'taxa': batch, 'batch': True,
+                       'threads': threads, 'source': 'batch'}
 
         # log results for each tax_id as tasks complete
-        complete = 0
+        taxa_progress = progress.Progress(
+            'taxa', total=sum(len(i['taxa']) for i in futs.values()),
+            unit='completed')
         while futs:
             done, pending = futures.wait(futs, 1, futures.FIRST_COMPLETED)
-            complete += len(done)
-            sys.stderr.write('{0:8d}/{1:8d} taxa completed\r'.format(
-                complete, complete + len(pending)))
             for f in done:
                 exception = f.exception()
                 if exception:
@@ -609,55 +1308,59 @@ def action(a):
                     raise exception
 
                 info = futs.pop(f)
-                filtered = f.result()  # here's the DataFrame again...
-
-                # add a column for tax_d at filter_rank
-                filtered.loc[:, a.filter_rank] = pd.Series(
-                    info['node'].tax_id, index=filtered.index)
-                outcomes.append(filtered)
-
-                kept = frozenset(filtered.seqname[~filtered.is_out])
-                if len(kept) == 0:
-                    log.info('Pruned all %d sequences for %s (%s)',
-                             info['n_seqs'], info['node'].tax_id,
-                             info['node'].name)
-                elif len(kept) != info['n_seqs']:
-                    log.info('Pruned %d/%d sequences for %s (%s)',
-                             info['n_seqs'] - len(kept), info['n_seqs'],
-                             info['node'].tax_id, info['node'].name)
+                result, seconds = f.result()  # here's the DataFrame again...
+                results = result if info['batch'] else [result]
+                taxa_progress.update(len(results))
+                n_total = sum(len(seqs) for _, seqs in info['taxa'])
+
+                for (node, seqs), filtered in zip(info['taxa'], results):
+                    n_seqs = len(seqs)
+                    # time of a batch is divided among its taxa by size
+                    timings.append({'tax_id': node.tax_id,
+                                    'tax_name': node.name,
+                                    'n_seqs': n_seqs,
+                                    'threads': info['threads'],
+                                    'seconds': seconds * n_seqs / n_total,
+                                    'source': info['source']})
+
+                    # add a column for tax_d at filter_rank
+                    filtered.loc[:, a.filter_rank] = pd.Series(
+                        node.tax_id, index=filtered.index)
+                    outcomes.append(filtered)
+
+                    kept = frozenset(filtered.seqname[~filtered.is_out])
+                    progress.increment('outliers', n_seqs - len(kept))
+                    if len(kept) == 0:
+                        log.info('Pruned all %d sequences for %s (%s)',
+                                 n_seqs, node.tax_id, node.name)
+                    elif len(kept) != n_seqs:
+                        log.info('Pruned %d/%d sequences for %s (%s)',
+                                 n_seqs - len(kept), n_seqs,
+                                 node.tax_id, node.name)
+        taxa_progress.finish()
+
+    if budget:
+        elapsed = time.time() - start
+        log.info('%.1f core-seconds used by filtering in %.1fs '
+                 '(%.0f%% of %d cores)', budget.busy, elapsed,
+                 100 * budget.busy / (elapsed * a.cores) if elapsed else 0,
+                 a.cores)
+    if a.timing_report:
+        with open(a.timing_report, 'w') as fp:
+            write_timing_report(timings, fp)
 
     all_outcomes = pd.concat(outcomes, ignore_index=True)
     all_outcomes.set_index('seqname', inplace=True)
 
-    # all input sequences should be in the output
-    assert {
-        s for node in taxonomy for s in node.sequence_ids} == set(
-        all_outcomes.index)
-
-    kept_ids = set(all_outcomes.index[~all_outcomes.is_out])
-
-    with a.output_seqs as fp:
-        # Extract all of the sequences that passed.
-        log.info('Extracting %d sequences', len(kept_ids))
-        wrap.esl_sfetch(a.sequence_file, kept_ids, fp)
-
-    # Filter seqinfo for sequences that passed.
-    seqinfo = pd.read_csv(
-        a.seqinfo_file, dtype={'seqname': str, 'tax_id': str, 'gi': str})
-    seqinfo = seqinfo.loc[seqinfo['seqname'].isin(seqnames)]
-    seqinfo.set_index('seqname', inplace=True)
-
-    merged = seqinfo.join(all_outcomes, lsuffix='.left')
-
-    # csv output
-    if a.filtered_seqinfo:
-        merged[~merged.is_out].to_csv(
-            a.filtered_seqinfo,
-            columns=seqinfo.columns)
-
-    if a.detailed_seqinfo:
-        with open(a.detailed_seqinfo, 'w') as detailed_seqinfo:
-            merged.to_csv(detailed_seqinfo)
+    # all input sequences (of this shard) should be in the output
+    if a.shard:
+        expected = {s for _, seqs in groups for s in seqs}
+        if a.shard[0] == 1:
+            expected.update(names_above_rank)
+    else:
+        expected = {s for node in taxonomy for s in node.sequence_ids}
+    assert expected == set(all_outcomes.index)
 
-    # finally - clean up .ssi file
-    os.remove(a.sequence_file + '.ssi')
+    write_outputs(all_outcomes, a.sequence_file, a.seqinfo_file,
+                  all_outcomes.index if a.shard else seqnames,
+                  a.output_seqs, a.filtered_seqinfo, a.detailed_seqinfo)
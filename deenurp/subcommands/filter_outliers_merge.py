@@ -0,0 +1,76 @@
+"""Combine the outputs of sharded filter_outliers runs
+
+``filter_outliers --shard I/N`` filters a subset of the taxa. Given the
+``--detailed-seqinfo`` of every shard, this writes ``--output-seqs``,
+``--filtered-seqinfo`` and ``--detailed-seqinfo`` for all of the taxa, as
+a single run of ``filter_outliers`` would have.
+"""
+
+import argparse
+import logging
+
+import pandas as pd
+import peasel
+
+from .filter_outliers import DEFAULT_RANK, DETAIL_COLUMNS, write_outputs
+
+log = logging.getLogger(__name__)
+
+
+def build_parser(p):
+    p.add_argument('sequence_file', help="""All sequences""")
+    p.add_argument('seqinfo_file', help="""Sequence info file""")
+    p.add_argument('shard_details', nargs='+', metavar='shard_details',
+                   help="""--detailed-seqinfo of each shard""")
+    p.add_argument('--filter-rank', default=DEFAULT_RANK,
+                   help="""--filter-rank of the shards [%(default)s]""")
+
+    output_group = p.add_argument_group('output options')
+    output_group.add_argument(
+        '--output-seqs', help="""REQUIRED destination for sequences""",
+        required=True,
+        type=argparse.FileType('w'), metavar='FILE')
+    output_group.add_argument(
+        '--filtered-seqinfo', type=argparse.FileType('w'), metavar='FILE',
+        help="""Path to write filtered sequence info""")
+    output_group.add_argument(
+        '--detailed-seqinfo', metavar='FILE',
+        help="""Sequence info, including filtering details""")
+
+
+def read_details(paths, filter_rank=DEFAULT_RANK):
+    """
+    Read the outcomes of filtering from each ``--detailed-seqinfo`` in
+    ``paths``, returning a DataFrame indexed by seqname. Raises
+    ValueError if a sequence appears in more than one.
+    """
+    dtype = {'seqname': str, 'tax_id': str, filter_rank: str, 'gi': str}
+    columns = sorted(DETAIL_COLUMNS + [filter_rank])
+    frames = []
+    for path in paths:
+        details = pd.read_csv(path, dtype=dtype, index_col='seqname',
+                              float_precision='round_trip')
+        log.info('%d sequences in %s', len(details), path)
+        frames.append(details.reindex(columns=columns))
+    outcomes = pd.concat(frames)
+
+    duplicated = outcomes.index[outcomes.index.duplicated()]
+    if len(duplicated):
+        raise ValueError(
+            '{} sequence(s) in more than one shard, eg {}'.format(
+                len(duplicated), duplicated[0]))
+    return outcomes
+
+
+def action(a):
+    seqnames = {seq.name for seq in peasel.read_seq_file(a.sequence_file)}
+    outcomes = read_details(a.shard_details, a.filter_rank)
+
+    missing = seqnames - set(outcomes.index)
+    if missing:
+        raise ValueError(
+            '{} sequence(s) missing from the shards, eg {}; are all shards '
+            'present?'.format(len(missing), sorted(missing)[0]))
+
+    write_outputs(outcomes, a.sequence_file, a.seqinfo_file, seqnames,
+                  a.output_seqs, a.filtered_seqinfo, a.detailed_seqinfo)
@@ -0,0 +1,26 @@
+"""Build a k-mer index of a sequence file
+
+The index is used by ``expand_named --kmer-index`` and ``transfer_names
+--kmer-index`` to search only candidate sequences sharing the most k-mers
+with each query.
+"""
+
+import logging
+
+from .. import kmer
+
+log = logging.getLogger(__name__)
+
+
+def build_parser(p):
+    p.add_argument('sequence_file', help='sequences to index (FASTA)')
+    p.add_argument('index_dir', help='output directory')
+    p.add_argument('-k', '--kmer-size', type=int, default=kmer.KMER_SIZE,
+                   help='k-mer length [default: %(default)d]')
+
+
+def action(a):
+    index = kmer.KmerIndex.build(a.sequence_file, k=a.kmer_size)
+    index.save(a.index_dir)
+    log.info('%d postings for %d sequences written to %s',
+             len(index.postings), len(index.names), a.index_dir)
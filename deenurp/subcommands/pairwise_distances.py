@@ -17,7 +17,7 @@ def build_parser(parser):
     parser.add_argument('distmat', help="""File name for output
     distance matrix (csv with column labels)""")
     parser.add_argument(
-        '-a', '--aligner', default='cmalign', choices=['cmalign', 'muscle', 'vsearch'])
+        '-a', '--aligner', default='cmalign', choices=filter_outliers.ALIGNERS)
     parser.add_argument(
         '--iddef', default=VSEARCH_IDDEF, type=int, choices=[0, 1, 2, 3, 4],
         help='vsearch: method for calculating pairwise identity [%(default)s]')
@@ -37,6 +37,9 @@ def action(args):
         taxa, distmat = filter_outliers.distmat_cmalign(args.seqs, pfx, cpu=args.threads)
     elif args.aligner == 'muscle':
         taxa, distmat = filter_outliers.distmat_muscle(args.seqs, pfx)
+    elif args.aligner == 'kmer':
+        taxa, distmat = filter_outliers.distmat_kmer(args.seqs)
 
     if args.distmat:
-        numpy.savetxt(args.distmat, distmat, delimiter=',', header=','.join(taxa))
+        numpy.savetxt(args.distmat, distmat.square(), delimiter=',',
+                      header=','.join(taxa))
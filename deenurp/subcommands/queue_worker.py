@@ -0,0 +1,32 @@
+"""Run tasks from a shared work queue
+
+Subcommands run with ``--executor queue --queue-dir DIR`` place their
+per-taxon or per-cluster tasks in DIR; start any number of workers on hosts
+that can see DIR to run them.
+"""
+
+import logging
+
+from .. import execution
+
+log = logging.getLogger(__name__)
+
+
+def build_parser(p):
+    p.add_argument('queue_dir', help='work queue directory')
+    p.add_argument('--idle-timeout', type=float, metavar='SECONDS',
+                   help="""exit after no tasks have been available for this
+                   many seconds [default: run until killed]""")
+    p.add_argument('--max-tasks', type=int, metavar='N',
+                   help='exit after running N tasks')
+    p.add_argument('--poll-interval', type=float,
+                   default=execution.POLL_INTERVAL, metavar='SECONDS',
+                   help="""seconds between checks for new tasks
+                   [default: %(default)s]""")
+
+
+def action(a):
+    count = execution.run_worker(
+        a.queue_dir, idle_timeout=a.idle_timeout, max_tasks=a.max_tasks,
+        poll_interval=a.poll_interval)
+    log.info('ran %d tasks', count)
@@ -15,7 +15,7 @@ from sqlalchemy.sql import select
 from taxtastic.taxonomy import Taxonomy
 from taxtastic import ncbi
 
-from deenurp import util
+from deenurp import progress, util
 from deenurp.subcommands import ncbi_extract_genbank
 
 type_keywords = ['(T)', 'ATCC', 'NCTC', 'NBRC', 'CCUG',
@@ -32,7 +32,7 @@ def species_is_classified_fn(taxonomy):
     ranks = taxonomy.ranks
     species_index = ranks.index('species')
 
-    @util.memoize
+    @util.lru_memoize()
     def fetch_tax_id(tax_id):
         # get tax node data
         c = nodes.c
@@ -40,7 +40,7 @@ def species_is_classified_fn(taxonomy):
         s = s.where(c.tax_id == tax_id)
         return s.execute().fetchone()
 
-    @util.memoize
+    @util.lru_memoize()
     def is_classified(tax_id):
         res = fetch_tax_id(tax_id)
         if not res:
@@ -75,12 +75,15 @@ def count_ambiguous(seq):
     return sum(i not in s for i in seq)
 
 
-def update_taxid(tax_id, taxonomy, name):
+def update_taxid_fn(taxonomy):
     """
+    Creates a function returning the current tax_id for a tax_id and
+    organism name, looking up merged tax_ids and the name when the tax_id
+    is missing from ``taxonomy``; None if no tax_id is found.
     """
 
-    @util.memoize
-    def update(tax_id, name):
+    @util.lru_memoize()
+    def update_taxid(tax_id, name):
         try:
             taxonomy._node(tax_id)
         except KeyError as err:
@@ -96,13 +99,21 @@ def update_taxid(tax_id, taxonomy, name):
                     logging.warn(err)
                     tax_id = None
             else:
-                msg = 'taxid {} not found in taxonomy, dropping'.format(tax_id)
+                msg = 'taxid {} not found in taxonomy, dropping'.format(
+                    tax_id)
                 logging.warn(msg)
                 tax_id = None
 
         return tax_id
 
-    return update(tax_id, name)
+    return update_taxid
+
+
+def update_taxid(tax_id, taxonomy, name):
+    """
+    Return the current tax_id for ``tax_id`` (see ``update_taxid_fn``)
+    """
+    return update_taxid_fn(taxonomy)(tax_id, name)
 
 
 def build_parser(p):
@@ -111,7 +122,8 @@ def build_parser(p):
     p.add_argument('database', help="""Path to taxonomy database""")
     p.add_argument('fasta_out', type=util.file_opener('w'),
                    help="""Path to write sequences in FASTA format.
-                           Specify '.gz' or '.bz2' extension to compress.""")
+                           Specify '.gz', '.bz2', '.xz' or '.zst' extension
+                           to compress.""")
     p.add_argument('output', metavar='tax_out', type=argparse.FileType('w'),
                    help="""Output path to write taxonomic
                            information in CSV format""")
@@ -124,17 +136,18 @@ def action(a):
     e = sqlalchemy.create_engine('sqlite:///{0}'.format(a.database))
     taxonomy = Taxonomy(e, ncbi.ranks)
     is_classified = species_is_classified_fn(taxonomy)
+    update_taxid = update_taxid_fn(taxonomy)
 
     with a.infile as fp, \
             a.output as out_fp, \
             a.fasta_out as fasta_fp:
         records = SeqIO.parse(fp, 'genbank')
-        records = util.Counter(records, prefix='Record ')
+        records = progress.track(records, 'Record', fileobj=fp)
         taxa = ((record, ncbi_extract_genbank.tax_of_genbank(record))
                 for record in records)
         taxa = ((record, tax_id, record.annotations['organism'])
                 for record, tax_id in taxa)
-        taxa = ((record, update_taxid(tax_id, taxonomy, organism))
+        taxa = ((record, update_taxid(tax_id, organism))
                 for record, tax_id, organism in taxa)
 
         writer = csv.writer(out_fp,
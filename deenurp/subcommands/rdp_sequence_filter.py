@@ -13,7 +13,8 @@ import logging
 
 from Bio import SeqIO
 
-from deenurp.util import Counter, file_opener
+from deenurp import progress
+from deenurp.util import file_opener
 
 
 def count_ambiguous(seq):
@@ -49,7 +50,8 @@ def build_parser(p):
 
 def action(a):
     with a.fasta_file as fasta_fp, a.seqinfo_file as seqinfo_fp:
-        sequences = Counter(SeqIO.parse(fasta_fp, 'fasta'))
+        sequences = progress.track(SeqIO.parse(fasta_fp, 'fasta'),
+                                   'sequences', fileobj=fasta_fp)
         reader = csv.DictReader(seqinfo_fp)
         with open(a.named_seqs, 'w') as named_fa_fp, \
                 open(a.named_info, 'w') as named_si_fp, \
@@ -10,7 +10,7 @@ import sqlite3
 
 from Bio import SeqIO
 
-from .. import config, search, select, util
+from .. import config, execution, search, select, util, wrap
 
 
 def meta_writer(fp):
@@ -95,6 +95,20 @@ def build_parser(p):
         type=argparse.FileType('r'),
         help=('List of sequence ids to exclude from the results'))
 
+    execution.add_arguments(p)
+
+    pplacer_options = p.add_argument_group('pplacer options')
+    pplacer_options.add_argument(
+        '--pplacer-mmap-dir', metavar='DIR',
+        help="""Scratch directory for pplacer memory-mapped working
+        files [default: system temporary directory]""")
+    pplacer_options.add_argument(
+        '--pplacer-mmap-threshold', metavar='FLOAT',
+        type=float, default=wrap.PPLACER_MMAP_THRESHOLD,
+        help="""Run pplacer with a memory-mapped working file when the
+        estimated footprint of a cluster (sites x references x queries)
+        exceeds this value [default: %(default).0e]""")
+
     info_options = p.add_argument_group('Sequence info options')
     info_options.add_argument(
         '--seqinfo-out', metavar='FILE',
@@ -153,7 +167,12 @@ def action(args):
                 include_clusters=include_clusters,
                 exclude_clusters=exclude_clusters,
                 # include_sequences=include_sequences,
-                exclude_sequences=exclude_sequences)
+                exclude_sequences=exclude_sequences,
+                pplacer_mmap_dir=args.pplacer_mmap_dir,
+                pplacer_mmap_threshold=args.pplacer_mmap_threshold,
+                executor=execution.get_executor(
+                    args.executor, args.threads, args.queue_dir,
+                    args.local_workers))
 
             with args.output as fp:
                 # Unique IDs
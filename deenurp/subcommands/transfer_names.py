@@ -10,7 +10,7 @@ import logging
 from Bio import SeqIO
 from taxtastic import refpkg, taxtable
 
-from .. import util, uclust
+from .. import kmer, util, uclust
 
 def build_parser(p):
     p.add_argument('refpkg', help="""Reference package""",
@@ -32,6 +32,12 @@ def build_parser(p):
 
     p.add_argument('-i', '--percent-id', type=float, default=0.99, help="""Minimum
         percent ID to transfer taxonomy [default: %(default).2f]""")
+    p.add_argument('--kmer-index', metavar='DIR', help="""k-mer index of
+        fasta_file (see 'deenurp kmer_index'). If given, only candidate
+        sequences from the index are searched.""")
+    p.add_argument('--kmer-candidates', metavar='N', type=int,
+        default=kmer.TOP_K, help="""Candidate sequences per reference
+        sequence with --kmer-index [default: %(default)d]""")
 
 def add_to_taxonomy(taxonomy, tax_node):
     """Add tax_node to taxonomy, including any missing"""
@@ -90,24 +96,30 @@ def action(args):
     with args.refpkg.open_resource('taxonomy') as fp:
         ref_taxonomy = taxtable.read(fp)
 
-    search = functools.partial(uclust.search,
+    search = functools.partial(uclust.search_iter,
             pct_id=args.percent_id,
-            search_pct_id=0.9, quiet=True)
+            search_pct_id=0.9, quiet=True, types=('H',))
 
     # Search the sequences from the reference package against the input sequences
-    with util.as_fasta(ref_sequences) as ref_fasta_path, util.ntf(prefix='uclust') as tf:
-        search(args.fasta_file, ref_fasta_path, tf.name)
-        input_records = uclust.parse_uclust_out(i for i in tf if i.startswith('H'))
+    with util.as_fasta(ref_sequences) as ref_fasta_path, \
+            util.ntf(prefix='candidates-', suffix='.fasta') as candidates_fp:
+        # Limit the search to candidates sharing k-mers with the references
+        if args.kmer_index:
+            index = kmer.open_index(args.kmer_index, args.fasta_file)
+            n = kmer.write_candidates(index, ref_sequences, args.fasta_file,
+                    candidates_fp, top_k=args.kmer_candidates)
+            candidates_fp.close()
+            input_records = search(candidates_fp.name, ref_fasta_path) if n else []
+        else:
+            input_records = search(args.fasta_file, ref_fasta_path)
 
         # Also search sequences from the reference package against themselves
         # TODO: decide if we want to use this
-        #with util.ntf(prefix='uclust') as self_tf:
-            #search(ref_fasta_path, ref_fasta_path, self_tf.name, maxaccepts=10)
-            #ref_records = uclust.parse_uclust_out(i for i in self_tf if i.startswith('H'))
-            ## Drop self-hits
-            #ref_records = (i for i in ref_records if i.query_label != i.target_label)
-            #grouped = itertools.groupby(ref_records, operator.attrgetter('query_label'))
-            #best_hit_id = dict((g, max(i.pct_id for i in v)) for g, v in grouped)
+        #ref_records = search(ref_fasta_path, ref_fasta_path, maxaccepts=10)
+        ## Drop self-hits
+        #ref_records = (i for i in ref_records if i.query_label != i.target_label)
+        #grouped = itertools.groupby(ref_records, operator.attrgetter('query_label'))
+        #best_hit_id = dict((g, max(i.pct_id for i in v)) for g, v in grouped)
 
         for record in input_records:
 
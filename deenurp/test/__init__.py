@@ -1,16 +1,41 @@
+import functools
+import os.path
+import shutil
+import tempfile
 import unittest
 
 modules = [
+    'test_diststore',
+    'test_execution',
+    'test_kmer',
     'test_outliers',
+    'test_progress',
+    'test_scratch',
     'test_search',
+    'test_seqindex',
+    'test_treecache',
+    'test_uclust',
     'test_subcommand_hrefpkg_build',
     'test_subcommand_filter_outliers',
+    'test_subcommand_filter_outliers_merge',
     'test_util',
     'test_wrap',
 #    'test_subcommand_extract_genbank'
 ]
 
 
+def mkdtemp(testcase, **kwargs):
+    """
+    Create a temporary directory, removed when ``testcase`` is cleaned up.
+
+    :returns: a partially applied os.path.join, with name of the temporary
+    directory as the first argument
+    """
+    path = tempfile.mkdtemp(**kwargs)
+    testcase.addCleanup(shutil.rmtree, path, True)
+    return functools.partial(os.path.join, path)
+
+
 def get_test_suites(module):
     for name in dir(module):
         obj = getattr(module, name)
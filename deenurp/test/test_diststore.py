@@ -0,0 +1,82 @@
+import os
+import unittest
+
+import numpy as np
+from Bio import SeqIO
+
+from deenurp import diststore, outliers, util, wrap
+from deenurp.subcommands import filter_outliers
+from deenurp.test import util as test_util
+from deenurp.test import mkdtemp
+
+
+class DistanceStoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.td = mkdtemp(self, prefix='diststore-')
+        self.store = diststore.DistanceStore(self.td('store'))
+        with open(test_util.data_path('e_faecium.distmat')) as f:
+            self.taxa, self.dm = outliers.read_condensed(f)
+        self.params = {'aligner': 'vsearch', 'iddef': wrap.VSEARCH_IDDEF}
+
+
+    def test_get_put(self):
+        self.assertIsNone(self.store.get('1352', self.params))
+        self.store.put('1352', self.params, self.taxa, self.dm)
+        stored = self.store.get('1352', self.params)
+        self.assertEqual(self.taxa, stored.names)
+        self.assertTrue((self.dm.data == stored.distmat.data).all())
+        self.assertIsNone(stored.aligned)
+        self.assertEqual(1, self.store.hits)
+
+        # replaced by a later put
+        self.store.put('1352', self.params, self.taxa[:10],
+                       self.dm.submatrix(np.arange(10)))
+        self.assertEqual(10, self.store.get('1352', self.params).distmat.n)
+        self.assertEqual(['1352'], os.listdir(self.td('store')))
+
+        # distances computed with other parameters aren't used
+        self.assertIsNone(self.store.get('1352', {'aligner': 'muscle'}))
+
+    def test_aligned(self):
+        aligned = list(SeqIO.parse(
+            test_util.data_path('e_faecium.aln.fasta'), 'fasta'))
+        self.store.put('1352', self.params, self.taxa, self.dm, aligned)
+        stored = self.store.get('1352', self.params)
+        self.assertEqual(str(aligned[5].seq),
+                         str(stored.aligned[aligned[5].id].seq))
+
+    def test_update(self):
+        stored = diststore.Stored(self.taxa[:80], self.dm.submatrix(
+            np.arange(80)))
+        # drop some stored sequences, add new ones, and change the order
+        order = np.random.RandomState(1).permutation(np.arange(10, 100))
+        names = [self.taxa[i] for i in order]
+        new = diststore.new_names(stored, names)
+        self.assertEqual(20, len(new))
+
+        calls = []
+
+        def distances(rows, cols):
+            calls.append((len(rows), len(cols)))
+            return self.dm.block(order[rows], order[cols])
+
+        updated = diststore.update(stored, names, distances)
+        self.assertEqual([(20, 90)], calls)
+        self.assertTrue(
+            (self.dm.submatrix(order).data == updated.data).all())
+
+        with self.assertRaises(ValueError):
+            diststore.update(stored, self.taxa[80:], distances)
+
+    def test_distmat_stored(self):
+        self.store.put('1352', self.params, self.taxa, self.dm)
+        # a subset of the stored sequences requires no alignment
+        with util.as_fasta(list(SeqIO.parse(
+                test_util.data_path('e_faecium.aln.fasta'),
+                'fasta'))[:50]) as fasta:
+            taxa, distmat = filter_outliers.distmat_stored(
+                '1352', fasta, '1352_', 'vsearch', self.td('store'))
+        self.assertEqual(self.taxa[:50], taxa)
+        self.assertTrue(
+            (self.dm.submatrix(np.arange(50)).data == distmat.data).all())
+        self.assertEqual(50, self.store.get('1352', self.params).distmat.n)
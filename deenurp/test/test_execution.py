@@ -0,0 +1,215 @@
+import os
+import threading
+import time
+import unittest
+
+from concurrent import futures
+
+from deenurp import execution, scratch
+from deenurp.test import mkdtemp
+
+
+def square(x):
+    return x * x
+
+
+def fail(msg):
+    raise ValueError(msg)
+
+
+class CompletedTestCase(unittest.TestCase):
+    def test_result(self):
+        f = execution.completed(square, 3)
+        self.assertTrue(f.done())
+        self.assertEqual(9, f.result())
+
+    def test_exception(self):
+        f = execution.completed(fail, 'bad')
+        self.assertIsInstance(f.exception(), ValueError)
+
+
+class TimedTestCase(unittest.TestCase):
+    def test_timed(self):
+        result, seconds = execution.timed(square, 4)
+        self.assertEqual(16, result)
+        self.assertGreaterEqual(seconds, 0)
+
+
+class CoreBudgetTestCase(unittest.TestCase):
+    def test_limit(self):
+        budget = execution.CoreBudget(4)
+        lock = threading.Lock()
+        in_use = [0, 0]  # current, maximum
+
+        def task(n):
+            with lock:
+                in_use[0] += n
+                in_use[1] = max(in_use)
+            time.sleep(0.01)
+            with lock:
+                in_use[0] -= n
+            return n
+
+        sizes = [4, 3, 2, 2, 1, 1, 1, 6]
+        with futures.ThreadPoolExecutor(len(sizes)) as executor:
+            futs = [executor.submit(budget.run, n, task, min(n, 4))
+                    for n in sizes]
+            self.assertEqual([min(n, 4) for n in sizes],
+                             [f.result() for f in futs])
+        self.assertLessEqual(in_use[1], 4)
+        self.assertEqual(4, budget.free)
+        self.assertGreater(budget.busy, 0)
+
+    def test_first_come_first_served(self):
+        budget = execution.CoreBudget(4)
+        order = []
+
+        def run(n):
+            with budget.reserve(n):
+                order.append(n)
+
+        with budget.reserve(1):
+            large = threading.Thread(target=run, args=(4,))
+            large.start()
+            time.sleep(0.05)
+            # 3 cores are free, but the earlier request comes first
+            small = threading.Thread(target=run, args=(1,))
+            small.start()
+            time.sleep(0.05)
+            self.assertEqual([], order)
+        large.join()
+        small.join()
+        self.assertEqual([4, 1], order)
+
+
+class QueueExecutorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.td = mkdtemp(self, prefix='queue-')
+        self.queue_dir = self.td('queue')
+        # queue executors reconfigure the default scratch manager
+        self._scratch = scratch._default
+        scratch._default = scratch.Scratch(ram_dir=self.td())
+
+    def tearDown(self):
+        scratch._default = self._scratch
+
+    def run_worker(self, **kwargs):
+        t = threading.Thread(target=execution.run_worker,
+                             args=(self.queue_dir,),
+                             kwargs=dict(idle_timeout=0.5, poll_interval=0.01,
+                                         **kwargs))
+        t.start()
+        return t
+
+    def test_submit(self):
+        executor = execution.QueueExecutor(self.queue_dir, poll_interval=0.01)
+        with executor:
+            futs = [executor.submit(square, i) for i in range(5)]
+            workers = [self.run_worker() for _ in range(2)]
+            results = [f.result() for f in futs]
+        for w in workers:
+            w.join()
+        self.assertEqual([0, 1, 4, 9, 16], results)
+        for d in (execution.TASKS, execution.CLAIMED, execution.RESULTS):
+            self.assertEqual([], os.listdir(os.path.join(self.queue_dir, d)))
+
+    def test_exception(self):
+        executor = execution.QueueExecutor(self.queue_dir, poll_interval=0.01)
+        with executor:
+            f = executor.submit(fail, 'bad')
+            self.run_worker(max_tasks=1).join()
+            futures.wait([f])
+        self.assertIsInstance(f.exception(), ValueError)
+
+    def test_shutdown_nowait(self):
+        executor = execution.QueueExecutor(self.queue_dir, poll_interval=0.01)
+        f = executor.submit(square, 2)
+        executor.shutdown(wait=False)
+        self.assertTrue(f.cancelled())
+        self.assertEqual(
+            [], os.listdir(os.path.join(self.queue_dir, execution.TASKS)))
+        self.assertRaises(RuntimeError, executor.submit, square, 2)
+
+    def test_local_workers(self):
+        executor = execution.get_executor(
+            execution.QUEUE, queue_dir=self.queue_dir, local_workers=1)
+        with executor:
+            f = executor.submit(square, 7)
+            self.assertEqual(49, f.result(timeout=30))
+
+    def claim(self):
+        """
+        Claim a task as a worker that dies without running it
+        """
+        claimed = None
+        while claimed is None:
+            claimed = execution._claim(self.queue_dir)
+            time.sleep(0.01)
+        return claimed
+
+    def test_stale_retried(self):
+        executor = execution.QueueExecutor(
+            self.queue_dir, poll_interval=0.01, stale_timeout=0.2)
+        with executor:
+            f = executor.submit(square, 3)
+            self.claim()
+            # returned to the queue, and run by a live worker
+            self.run_worker(max_tasks=1).join()
+            self.assertEqual(9, f.result(timeout=10))
+
+    def test_stale_fails(self):
+        executor = execution.QueueExecutor(
+            self.queue_dir, poll_interval=0.01, stale_timeout=0.2,
+            max_retries=0)
+        with executor:
+            f = executor.submit(square, 3)
+            self.claim()
+            futures.wait([f], timeout=10)
+        self.assertIsInstance(f.exception(), RuntimeError)
+        self.assertEqual(
+            [], os.listdir(os.path.join(self.queue_dir, execution.CLAIMED)))
+
+    def test_heartbeat(self):
+        executor = execution.QueueExecutor(
+            self.queue_dir, poll_interval=0.01, stale_timeout=0.3)
+        with executor:
+            f = executor.submit(time.sleep, 1)
+            task_id, path = self.claim()
+            t = threading.Thread(target=execution.run_task,
+                                 args=(self.queue_dir, task_id, path, 0.05))
+            t.start()
+            self.assertIsNone(f.result(timeout=10))
+            t.join()
+        # not returned to the queue, though it ran for longer than the timeout
+        self.assertEqual(
+            [], os.listdir(os.path.join(self.queue_dir, execution.TASKS)))
+
+    def test_shared_scratch(self):
+        manager = scratch.default()
+        in_ram = os.path.join(manager.acquire(size_hint=10), 'a.fasta')
+        self.assertTrue(manager.in_ram(in_ram))
+        executor = execution.QueueExecutor(self.queue_dir, poll_interval=0.01)
+        with executor:
+            shared = os.path.join(self.queue_dir, execution.SCRATCH)
+            self.assertEqual(shared, manager.acquire(size_hint=10))
+            self.assertRaises(ValueError, executor.submit, square, in_ram)
+            self.assertRaises(ValueError, executor.submit, square, x=in_ram)
+            f = executor.submit(square, 5)
+            self.run_worker(max_tasks=1).join()
+            self.assertEqual(25, f.result(timeout=10))
+
+    def test_unreadable_result(self):
+        executor = execution.QueueExecutor(self.queue_dir, poll_interval=0.01)
+        with executor:
+            f = executor.submit(square, 3)
+            task_id, path = self.claim()
+            execution._write_atomic(
+                os.path.join(self.queue_dir, execution.RESULTS),
+                task_id + execution.RESULT_SUFFIX, 'not a pickle')
+            os.remove(path)
+            futures.wait([f], timeout=10)
+            self.assertIsNotNone(f.exception())
+            # the collector is still running
+            f = executor.submit(square, 4)
+            self.run_worker(max_tasks=1).join()
+            self.assertEqual(16, f.result(timeout=10))
@@ -0,0 +1,92 @@
+import shutil
+import unittest
+
+from cStringIO import StringIO
+
+import numpy as np
+from Bio import SeqIO
+
+from deenurp import kmer, outliers, seqindex
+from deenurp.test import mkdtemp, util as test_util
+
+
+class KmersTestCase(unittest.TestCase):
+    def test_kmers(self):
+        self.assertEqual([0b0001101100011011],
+                         kmer.kmers('ACGTACGT').tolist())
+        self.assertEqual([0b00011011], kmer.kmers('ACGTACGT', k=4)[:1].tolist())
+
+    def test_ambiguous(self):
+        self.assertEqual(0, len(kmer.kmers('ACGTNACGT', k=5)))
+        self.assertEqual(2, len(kmer.kmers('ACGTN-ACGTA', k=4)))
+        self.assertEqual(0, len(kmer.kmers('ACG')))
+
+
+class KmerIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        self.fasta = test_util.data_path('test_db_head.fasta')
+        self.sequences = list(SeqIO.parse(self.fasta, 'fasta'))
+        self.index = kmer.KmerIndex.build(self.fasta)
+
+    def test_query_self(self):
+        for i, seq in enumerate(self.sequences):
+            refs, shared = self.index.query(seq.seq, top_k=3)
+            self.assertEqual(i, refs[0])
+            self.assertEqual(self.index.counts[i], shared[0])
+            self.assertTrue(len(refs) <= 3)
+
+    def test_save_load(self):
+        td = mkdtemp(self, prefix='kmer-')
+        self.index.save(td('index'))
+        loaded = kmer.open_index(td('index'), self.fasta)
+        self.assertEqual(self.index.names, loaded.names)
+        seq = self.sequences[4].seq
+        self.assertEqual(self.index.query(seq)[0].tolist(),
+                         loaded.query(seq)[0].tolist())
+
+    def test_write_candidates(self):
+        buf = StringIO()
+        fasta = mkdtemp(self, prefix='kmer-')('seqs.fasta')
+        shutil.copy(self.fasta, fasta)
+        count = kmer.write_candidates(self.index, self.sequences[2:3],
+                                      fasta, buf, top_k=1)
+        seqindex.forget(fasta)
+        self.assertEqual(1, count)
+        buf.seek(0)
+        self.assertEqual([self.sequences[2].id],
+                         [i.id for i in SeqIO.parse(buf, 'fasta')])
+
+
+class KmerDistanceTestCase(unittest.TestCase):
+    def setUp(self):
+        self.sequences = list(SeqIO.parse(
+            test_util.data_path('e_faecium.aln.fasta'), 'fasta'))
+
+    def test_kmer_distance(self):
+        self.assertEqual(0, kmer.kmer_distance(100, 100, 120))
+        self.assertAlmostEqual(1 - 0.5 ** 0.1, kmer.kmer_distance(50, 100, 100))
+        self.assertEqual(kmer.MAX_DISTANCE, kmer.kmer_distance(0, 100, 100))
+        self.assertEqual(kmer.MAX_DISTANCE, kmer.kmer_distance(0, 0, 100))
+
+    def test_profiles(self):
+        profiles = kmer.KmerProfiles(self.sequences[:3], k=4)
+        seq = str(self.sequences[1].seq).replace('-', '')
+        self.assertEqual(len(kmer.kmers(seq, k=4)), profiles.counts[1])
+        self.assertEqual(profiles.counts[1], profiles.shared([1], [1])[0, 0])
+        # all k-mers are common to more than a quarter of the sequences
+        dense = kmer.KmerProfiles(self.sequences[:3], k=4, common=1.0)
+        self.assertEqual(0, dense.common.shape[1])
+        self.assertTrue((profiles.shared(range(3), range(3)) ==
+                         dense.shared(range(3), range(3))).all())
+
+    def test_kmer_distances(self):
+        names, distmat = kmer.kmer_distances(self.sequences, chunk=1000)
+        self.assertEqual([s.id for s in self.sequences], names)
+        profiles = kmer.KmerProfiles(self.sequences)
+        self.assertTrue(np.allclose(
+            profiles.distances(range(100), range(100)), distmat.square()))
+
+        # agrees with distances from the alignment
+        with open(test_util.data_path('e_faecium.distmat')) as fp:
+            _, expected = outliers.read_condensed(fp)
+        self.assertGreater(np.corrcoef(expected.data, distmat.data)[0, 1], 0.8)
@@ -1,9 +1,14 @@
 import os
 import unittest
 
+from cStringIO import StringIO
+
 try:
     import numpy as np
     import pandas as pd
+    from Bio import SeqIO
+    from Bio.Seq import Seq
+    from Bio.SeqRecord import SeqRecord
     from deenurp import outliers, wrap
     from deenurp.subcommands.filter_outliers import filter_sequences, distmat_muscle
     from deenurp.util import MissingDependencyError
@@ -50,6 +55,210 @@ class TestReadDists(unittest.TestCase):
             self.assertAlmostEqual(list(mat[(0, 0, 99, 99), (0, 99, 0, 99)]),
                                    [0, 0.003299, 0.003299, 0])
 
+    def test_float32_blocks(self):
+        with open(data_path('e_faecium.distmat')) as f:
+            taxa, expected = outliers.read_dists(f)
+        read_chunk = outliers.READ_CHUNK
+        outliers.READ_CHUNK = 250  # parse two rows at a time
+        try:
+            with open(data_path('e_faecium.distmat')) as f:
+                taxa32, mat = outliers.read_dists(f, dtype=np.float32)
+        finally:
+            outliers.READ_CHUNK = read_chunk
+        self.assertEqual(taxa, taxa32)
+        self.assertEqual(np.float32, mat.dtype)
+        self.assertTrue((expected.astype(np.float32) == mat).all())
+
+    def test_free_format(self):
+        taxa, mat = outliers.read_dists(StringIO('2\na 0 0.5\nb 0.5 12.25\n'))
+        self.assertEqual(['a', 'b'], taxa)
+        self.assertEqual([[0, 0.5], [0.5, 12.25]], mat.tolist())
+
+    def test_malformed(self):
+        self.assertRaises(ValueError, outliers.read_dists,
+                          StringIO('2\na 0.0 0.1\nb 0.1\n'))
+        self.assertRaises(ValueError, outliers.read_dists,
+                          StringIO('2\na 0.0 0.1\n'))
+
+
+class TestDistanceMatrix(unittest.TestCase):
+
+    def setUp(self):
+        with open(data_path('e_faecium.distmat')) as f:
+            self.taxa, self.mat = outliers.read_dists(f)
+        with open(data_path('e_faecium.distmat')) as f:
+            taxa, self.dm = outliers.read_condensed(f)
+        self.assertEqual(self.taxa, taxa)
+
+    def test_read_condensed(self):
+        self.assertEqual(np.float32, self.dm.data.dtype)
+        self.assertEqual(100 * 99 / 2, len(self.dm.data))
+        self.assertTrue(
+            (self.mat.astype(np.float32) == self.dm.square()).all())
+
+        read_chunk = outliers.READ_CHUNK
+        outliers.READ_CHUNK = 250
+        try:
+            with open(data_path('e_faecium.distmat')) as f:
+                _, dm = outliers.read_condensed(f, mmap=True)
+        finally:
+            outliers.READ_CHUNK = read_chunk
+        self.assertIsInstance(dm.data, np.memmap)
+        self.assertTrue((self.dm.data == dm.data).all())
+
+    def test_getitem(self):
+        self.assertAlmostEqual(self.mat[3, 57], self.dm[3, 57], places=6)
+        self.assertAlmostEqual(self.mat[57, 3], self.dm[57, 3], places=6)
+        self.assertEqual(0, self.dm[5, 5])
+        self.assertTrue(np.allclose(self.mat[7, :], self.dm[7, :]))
+
+    def test_submatrix(self):
+        ii = np.arange(100) % 3 == 0
+        sub = self.dm.submatrix(ii)
+        self.assertEqual(34, sub.n)
+        self.assertTrue(np.allclose(self.mat[np.ix_(ii, ii)], sub.square()))
+        self.assertTrue(
+            (sub.data == self.dm.submatrix(np.flatnonzero(ii)).data).all())
+
+    def test_same_as_square(self):
+        ii = np.array([i > 50 for i in range(100)], dtype=bool)
+        self.assertEqual(3, outliers.find_medoid(self.dm))
+        self.assertEqual(82, outliers.find_medoid(self.dm, ii=ii))
+
+        _, _, expected = outliers.outliers(self.mat, radius=0.015)
+        _, _, is_outlier = outliers.outliers(self.dm, radius=0.015)
+        self.assertEqual(list(expected), list(is_outlier))
+
+        expected = outliers.outliers_by_cluster(self.mat, t=0.015, D=0.015)
+        actual = outliers.outliers_by_cluster(self.dm, t=0.015, D=0.015)
+        self.assertEqual(expected[0], actual[0])
+        self.assertEqual(list(expected[2]), list(actual[2]))
+        self.assertEqual(list(expected[3]), list(actual[3]))
+
+    def test_nan(self):
+        self.dm.data[self.dm.index(3, np.arange(90, 100))] = np.nan
+        expected = np.argmin(np.nanmedian(self.dm.square(), axis=0))
+        medoid, dists, is_outlier = outliers.outliers(self.dm, radius=0.015)
+        self.assertEqual(expected, medoid)
+        self.assertFalse(np.isnan(dists).any())
+        self.assertEqual(list(dists > 0.015), list(is_outlier))
+
+
+class TestSampledMedoid(unittest.TestCase):
+
+    def setUp(self):
+        with open(data_path('e_faecium.distmat')) as f:
+            self.taxa, self.dm = outliers.read_condensed(f)
+        self.calls = []
+
+    def distances(self, rows, cols):
+        self.calls.append((len(rows), len(cols)))
+        return self.dm.block(rows, cols)
+
+    def test_exact(self):
+        medoid, dists = outliers.sampled_medoid(
+            self.distances, self.dm.n, sample_size=100)
+        self.assertEqual(outliers.find_medoid(self.dm), medoid)
+        self.assertTrue(np.allclose(self.dm.row(medoid), dists))
+        self.assertEqual([(100, 100)], self.calls)
+
+    def test_sampled(self):
+        medoid, dists = outliers.sampled_medoid(
+            self.distances, self.dm.n, sample_size=30, n_candidates=4,
+            random_state=1)
+        self.assertEqual([(30, 30), (4, 100)], self.calls)
+        self.assertEqual(100, len(dists))
+        self.assertTrue(np.allclose(self.dm.row(medoid), dists))
+        self.assertEqual(medoid, outliers.sampled_medoid(
+            self.distances, self.dm.n, sample_size=30, n_candidates=4,
+            random_state=1)[0])
+
+        # the approximation is close to the exact medoid
+        exact = outliers.find_medoid(self.dm)
+        self.assertLess(np.median(dists) - np.median(self.dm.row(exact)),
+                        0.002)
+
+    def test_bounded_percentile(self):
+        dists = self.dm.row(3)
+        R = outliers.bounded_percentile(dists, 90)
+        self.assertEqual(np.percentile(dists, 90), R)
+        self.assertEqual(1.0, outliers.bounded_percentile(
+            dists, 90, min_radius=1.0))
+        self.assertEqual(0.001, outliers.bounded_percentile(
+            dists, 90, max_radius=0.001))
+        with_nan = np.append(dists, np.nan)
+        self.assertEqual(R, outliers.bounded_percentile(with_nan, 90))
+
+
+class TestUniqueColumns(unittest.TestCase):
+
+    def check(self, X):
+        columns, counts = outliers._unique_columns(X)
+        expected = {}
+        for j in range(X.shape[1]):
+            key = tuple(X[:, j])
+            expected[key] = expected.get(key, 0) + 1
+        found = dict(zip(map(tuple, columns.T), counts))
+        self.assertEqual(expected, found)
+        self.assertEqual(X.shape[0], columns.shape[0])
+
+    def test_unique(self):
+        X = np.random.RandomState(1).randint(0, 3, size=(5, 200))
+        self.check(X.astype(np.uint8))
+        self.check(X < 2)
+
+    def test_empty(self):
+        columns, counts = outliers._unique_columns(np.zeros((3, 0), bool))
+        self.assertEqual((3, 0), columns.shape)
+        self.assertEqual(0, len(counts))
+        self.check(np.zeros((0, 4), bool))
+
+
+class TestAlignmentDists(unittest.TestCase):
+
+    def records(self, *seqs):
+        return [SeqRecord(Seq(s), id='s{}'.format(i))
+                for i, s in enumerate(seqs)]
+
+    def test_same_as_fasttree(self):
+        for name in ['e_faecium', 'e_faecalis']:
+            with open(data_path(name + '.distmat')) as f:
+                expected_taxa, expected = outliers.read_condensed(f)
+            taxa, distmat = outliers.alignment_dists(
+                SeqIO.parse(data_path(name + '.aln.fasta'), 'fasta'))
+            self.assertEqual(expected_taxa, taxa)
+            # FastTree writes six decimal places
+            self.assertLess(np.abs(expected.data - distmat.data).max(), 1e-6)
+
+    def test_blocks(self):
+        records = list(SeqIO.parse(data_path('e_faecium.aln.fasta'), 'fasta'))
+        _, expected = outliers.alignment_dists(records)
+        read_chunk = outliers.READ_CHUNK
+        outliers.READ_CHUNK = 300
+        try:
+            _, distmat = outliers.alignment_dists(records, threads=3)
+        finally:
+            outliers.READ_CHUNK = read_chunk
+        self.assertTrue((expected.data == distmat.data).all())
+
+    def test_gaps(self):
+        profiles = outliers.AlignmentProfiles(self.records(
+            'ACGTACGTAC', 'ACGTACGTAA', 'acgtNNGTAA', 'ACGU--GTAC', '----------'))
+        overlap, differences = profiles.counts(range(5), range(5))
+        self.assertEqual([10, 10, 8, 8, 0], list(overlap[0]))
+        self.assertEqual([0, 1, 1, 0, 0], list(differences[0]))
+        self.assertEqual(0, differences[2, 1])
+
+        p = profiles.distances([0], range(5), model='p')[0]
+        self.assertTrue(np.allclose([0, 0.1, 0.125, 0, 1], p))
+        jc = profiles.distances([0], range(5))[0]
+        self.assertAlmostEqual(-0.75 * np.log(1 - 0.4 / 3), jc[1], places=6)
+        self.assertEqual(outliers.MAX_JC_DISTANCE, jc[4])
+
+    def test_unaligned(self):
+        with self.assertRaises(ValueError):
+            outliers.AlignmentProfiles(self.records('ACGT', 'ACG'))
+
 
 class TestFastTreeDists(unittest.TestCase):
 
@@ -129,6 +338,50 @@ class TestFindOutliers(unittest.TestCase):
         self.assertTrue((df['x'] == 0).all())
         self.assertTrue((df['y'] == 0).all())
 
+    def test_classical_mds(self):
+        coords = outliers.classical_mds(self.mat)
+        self.assertEqual((100, 2), coords.shape)
+        # embedded distances approximate the originals
+        embedded = np.sqrt(np.square(
+            coords[:, None, :] - coords[None, :, :]).sum(axis=2))
+        ii = np.triu_indices(100, 1)
+        self.assertGreater(
+            np.corrcoef(self.mat[ii], embedded[ii])[0, 1], 0.85)
+
+        dense_eigh = outliers.DENSE_EIGH
+        outliers.DENSE_EIGH = 10
+        try:
+            self.assertTrue(np.allclose(
+                coords, outliers.classical_mds(self.mat), atol=1e-6))
+        finally:
+            outliers.DENSE_EIGH = dense_eigh
+
+    def test_landmark_mds(self):
+        coords = outliers.classical_mds(self.mat)
+        self.assertTrue(np.allclose(
+            coords, outliers.landmark_mds(self.mat, n_landmarks=100)))
+        landmarks = outliers.landmark_mds(self.mat, n_landmarks=40)
+        self.assertTrue(np.allclose(coords, landmarks, atol=0.005))
+
+        with open(data_path('e_faecium.distmat')) as f:
+            _, dm = outliers.read_condensed(f)
+        self.assertTrue(np.allclose(
+            landmarks, outliers.landmark_mds(dm, n_landmarks=40), atol=1e-5))
+
+    def test_maxmin_landmarks(self):
+        landmarks, distances = outliers.maxmin_landmarks(self.mat, 10)
+        self.assertEqual(10, len(set(landmarks)))
+        self.assertTrue(np.allclose(self.mat[:, landmarks], distances))
+        # the most distant sequence is chosen first after the start
+        self.assertEqual(np.argmax(self.mat[landmarks[0]]), landmarks[1])
+
+    def test_embed(self):
+        for method in outliers.EMBEDDINGS:
+            df = outliers.embed(self.mat, self.taxa, method)
+            self.assertEqual(['seqname', 'x', 'y'], list(df.columns))
+            self.assertEqual(self.taxa, list(df['seqname']))
+            self.assertEqual(method == 'none', df['x'].isnull().all())
+
 try:
     wrap.require_executable(wrap.VSEARCH)
 except MissingDependencyError, e:
@@ -193,3 +446,28 @@ class TestFilterSequences(unittest.TestCase):
                                     strategy='cluster',
                                     percentile=90, min_radius=0.1)
         self.assertEqual(sum(to_prune['is_out']), 0)
+
+
+class TestFilterSequencesKmer(unittest.TestCase):
+
+    fa = data_path('test_db_head.fasta')
+    tax_id = '53635'
+
+    def test_radius(self):
+        to_prune = filter_sequences(self.tax_id,
+                                    sequence_file=self.fa,
+                                    strategy='radius',
+                                    cutoff=0.015,
+                                    aligner='kmer')
+        self.assertEqual(sum(to_prune['is_out']), 6)
+
+    def test_sampled(self):
+        to_prune = filter_sequences(self.tax_id,
+                                    sequence_file=self.fa,
+                                    strategy='radius',
+                                    cutoff=0.015,
+                                    aligner='kmer',
+                                    medoid='sampled',
+                                    medoid_sample_size=5)
+        self.assertEqual(len(to_prune), 10)
+        self.assertTrue(to_prune['x'].isnull().all())
@@ -0,0 +1,77 @@
+import json
+import unittest
+
+from cStringIO import StringIO
+
+from deenurp import progress, util
+from deenurp.test import mkdtemp
+
+
+class ProgressTestCase(unittest.TestCase):
+    def test_track(self):
+        stream = StringIO()
+        p = progress.Progress('test', total=10, stream=stream,
+                              report_every=0)
+        self.assertEqual(range(10), list(p.track(xrange(10))))
+        self.assertEqual(10, p.count)
+        self.assertTrue(p.finished)
+        lines = stream.getvalue().split('\r')
+        self.assertTrue(lines[0].startswith('test: 1/10 records ['))
+        self.assertIn('ETA', lines[0])
+        self.assertTrue(lines[-1].startswith('test: 10/10 records ['))
+        self.assertNotIn('ETA', lines[-1])
+
+    def test_eta(self):
+        p = progress.Progress('test', total=100, stream=None)
+        self.assertIsNone(p.eta())
+        p.start -= 10
+        p.update(50)
+        self.assertAlmostEqual(10, p.eta(), places=1)
+        self.assertAlmostEqual(5, p.rate(), places=1)
+
+    def test_bytes(self):
+        with util.ntf() as tf:
+            tf.write('x' * 1000)
+            tf.flush()
+            with open(tf.name) as fp:
+                p = progress.Progress('test', fileobj=fp, stream=None)
+                self.assertEqual(1000, p.total_bytes)
+                p.start -= 10
+                fp.read(250)
+                p.update()
+                self.assertAlmostEqual(25, p.byte_rate(), places=1)
+                self.assertAlmostEqual(30, p.eta(), places=1)
+                self.assertEqual(250, p.metrics()['bytes'])
+
+
+class MetricsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.td = mkdtemp(self, prefix='progress-')
+        progress.configure(self.td('metrics.json'), version='test')
+
+    def tearDown(self):
+        progress._metrics_fp.close()
+        progress._metrics_fp = None
+
+    def records(self):
+        progress._metrics_fp.flush()
+        with open(self.td('metrics.json')) as fp:
+            return [json.loads(line) for line in fp]
+
+    def test_stream(self):
+        with progress.stage('test-stage', tax_id='1'):
+            pass
+        progress.increment('test-counter', 2)
+        with progress.Progress('test', stream=None) as p:
+            p.update(3)
+        progress.emit_summary()
+
+        records = self.records()
+        self.assertEqual(['start', 'stage', 'progress_done', 'summary'],
+                         [i['event'] for i in records])
+        self.assertEqual('test', records[0]['version'])
+        self.assertEqual('1', records[1]['tax_id'])
+        self.assertEqual(3, records[2]['count'])
+        summary = records[3]
+        self.assertEqual(2, summary['counters']['test-counter'])
+        self.assertGreaterEqual(summary['stages']['test-stage']['calls'], 1)
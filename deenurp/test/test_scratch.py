@@ -0,0 +1,150 @@
+import os.path
+import threading
+import time
+import unittest
+
+from deenurp import scratch, util
+from deenurp.test import mkdtemp
+
+
+class ScratchTestCase(unittest.TestCase):
+    def setUp(self):
+        self.td = mkdtemp(self, prefix='scratch-')
+        os.mkdir(self.td('ram'))
+        os.mkdir(self.td('disk'))
+        self._default = scratch._default
+
+    def tearDown(self):
+        scratch._default = self._default
+
+    def manager(self, **kwargs):
+        return scratch.Scratch(self.td('disk'), ram_dir=self.td('ram'),
+                               **kwargs)
+
+    def test_placement(self):
+        s = self.manager(ram_quota=100, small_file=50)
+        ram = s.acquire(size_hint=10)
+        self.assertEqual(self.td('ram'), os.path.dirname(ram))
+        self.assertEqual(self.td('disk'), s.acquire(size_hint=60))
+        self.assertEqual(self.td('disk'), s.acquire())
+
+    def test_spill(self):
+        s = self.manager(ram_quota=100, small_file=100)
+        path = os.path.join(s.acquire(size_hint=10), 'a')
+        with open(path, 'w') as fp:
+            fp.write('x' * 95)
+        s.track(path)
+        self.assertEqual((95, 95), s.usage())
+        # would exceed the RAM quota
+        self.assertEqual(self.td('disk'), s.acquire(size_hint=10))
+        s.release(path)
+        self.assertEqual(95, s.peak_ram)
+
+    def test_quota_waits(self):
+        s = self.manager(quota=10, block_timeout=30)
+        path = self.td('disk', 'a')
+        with open(path, 'w') as fp:
+            fp.write('x' * 20)
+
+        ready = threading.Event()
+
+        def hold():
+            s.track(path)
+            ready.set()
+            time.sleep(0.2)
+            s.release(path)
+
+        t = threading.Thread(target=hold)
+        t.start()
+        ready.wait()
+        start = time.time()
+        s.acquire()
+        self.assertTrue(time.time() - start >= 0.1)
+        t.join()
+        self.assertEqual(20, s.peak)
+
+    def test_growth_waits(self):
+        s = self.manager(quota=10, block_timeout=30)
+        path = self.td('disk', 'a')
+        open(path, 'w').close()
+        grown = threading.Event()
+
+        def grow():
+            # tracked while empty, without a size hint
+            s.track(path)
+            with open(path, 'w') as fp:
+                fp.write('x' * 20)
+            grown.set()
+            time.sleep(0.3)
+            s.release(path)
+
+        t = threading.Thread(target=grow)
+        t.start()
+        grown.wait()
+        start = time.time()
+        s.acquire()
+        self.assertTrue(time.time() - start >= 0.2)
+        t.join()
+        self.assertEqual(20, s.peak)
+
+    def test_peak_measured(self):
+        s = self.manager(measure_interval=0)
+        paths = [self.td('disk', name) for name in 'ab']
+        for path in paths:
+            open(path, 'w').close()
+            s.track(path)
+        for path in paths:
+            with open(path, 'w') as fp:
+                fp.write('x' * 15)
+        for path in paths:
+            s.release(path)
+        self.assertEqual(30, s.peak)
+        self.assertEqual((0, 0), s.usage())
+
+    def test_own_files_do_not_wait(self):
+        s = self.manager(quota=10, block_timeout=30)
+        path = self.td('disk', 'a')
+        with open(path, 'w') as fp:
+            fp.write('x' * 20)
+        s.track(path)
+        start = time.time()
+        s.acquire()
+        self.assertTrue(time.time() - start < 1)
+
+    def test_ntf(self):
+        scratch._default = self.manager(ram_quota=1 << 20)
+        with util.ntf(size_hint=10) as tf:
+            self.assertEqual(self.td('ram'),
+                             os.path.dirname(os.path.dirname(tf.name)))
+            tf.write('ACGT')
+            tf.flush()
+        with util.tempdir() as td:
+            self.assertEqual(self.td('disk'), os.path.dirname(td()))
+        # the size hint is counted while the file is live
+        self.assertEqual(10, scratch._default.peak)
+        self.assertEqual((0, 0), scratch._default.usage())
+
+    def test_size_at_release(self):
+        s = self.manager()
+        path = self.td('disk', 'a')
+        open(path, 'w').close()
+        s.track(path)
+        with open(path, 'w') as fp:
+            fp.write('x' * 30)
+        # not measured again until released
+        self.assertEqual((0, 0), s.usage())
+        s.release(path)
+        self.assertEqual((0, 0), s.usage())
+        self.assertEqual(30, s.peak)
+
+    def test_share(self):
+        s = self.manager(ram_quota=100, small_file=50)
+        self.assertEqual(self.td('ram'),
+                         os.path.dirname(s.acquire(size_hint=10)))
+        s.share(self.td('shared'))
+        # a scratch directory was set, so it is kept
+        self.assertEqual(self.td('disk'), s.acquire(size_hint=10))
+
+        s = scratch.Scratch(ram_dir=self.td('ram'))
+        s.share(self.td('shared'))
+        self.assertEqual(self.td('shared'), s.acquire(size_hint=10))
@@ -1,8 +1,12 @@
 import collections
 import os.path
+import sqlite3
 from cStringIO import StringIO
 import unittest
-from deenurp import search
+
+from Bio import SeqIO
+
+from deenurp import search, util
 
 class RandomDict(dict):
     def __getitem__(self, key):
@@ -60,3 +64,32 @@ class SelectHitsTestCase(unittest.TestCase):
             ('seq2', [TestHit('seq2', 't6', 98.4)])]
         self.assertItemsEqual(expected, r)
 
+
+
+class LoadSequencesTestCase(unittest.TestCase):
+    def load(self):
+        con = sqlite3.connect(':memory:')
+        search._create_tables(con, 'ref.fasta', 'ref.csv', 'query.fasta')
+        names = [i.id for i in SeqIO.parse(data_path('test_input.fasta'),
+                                           'fasta')]
+        weights = {n: {'s{}'.format(i % 3): 1.0}
+                   for i, n in enumerate(names)}
+        count = search._load_sequences(
+            con, data_path('test_input.fasta'), weights)
+        self.assertEqual(len(names), count)
+        return con
+
+    def test_samples(self):
+        con = self.load()
+        rows = con.execute('SELECT name FROM samples ORDER BY sample_id')
+        self.assertEqual(['s0', 's1', 's2'], [r[0] for r in rows])
+
+    def test_cache_per_call(self):
+        self.load()
+        n_caches = len(util.memo_stats())
+        con = self.load()
+        # counted with the cache of the first call
+        self.assertEqual(n_caches, len(util.memo_stats()))
+        # ids aren't shared between databases
+        rows = con.execute('SELECT sample_id FROM samples')
+        self.assertEqual([1, 2, 3], sorted(r[0] for r in rows))
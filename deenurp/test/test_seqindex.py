@@ -0,0 +1,83 @@
+import os
+import os.path
+import shutil
+import threading
+import unittest
+
+from cStringIO import StringIO
+
+from Bio import SeqIO
+
+from deenurp import seqindex
+from deenurp.test import util as test_util
+from deenurp.test import mkdtemp
+
+
+class SequenceIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        self.td = mkdtemp(self, prefix='seqindex-')
+        self.fasta = self.td('seqs.fasta')
+        shutil.copy(test_util.data_path('test_db_head.fasta'), self.fasta)
+        self.names = [i.id for i in SeqIO.parse(self.fasta, 'fasta')]
+
+    def tearDown(self):
+        seqindex.forget(self.fasta)
+
+    def fetch(self, index, names):
+        buf = StringIO()
+        count = index.write_fasta(names, buf)
+        buf.seek(0)
+        return count, [i.id for i in SeqIO.parse(buf, 'fasta')]
+
+    def test_fetch(self):
+        index = seqindex.open_index(self.fasta)
+        names = self.names[::-1][:4]
+        count, fetched = self.fetch(index, names)
+        self.assertEqual(4, count)
+        self.assertEqual(names, fetched)
+        self.assertTrue(os.path.exists(self.fasta + '.ssi'))
+
+    def test_reused(self):
+        seqindex.open_index(self.fasta)
+        seqindex.forget(self.fasta)
+        os.utime(self.fasta + '.ssi', (1000, 1000))
+        seqindex.open_index(self.fasta)
+        self.assertEqual(1000, os.stat(self.fasta + '.ssi').st_mtime)
+
+    def test_stale_rebuilt(self):
+        seqindex.open_index(self.fasta)
+        seqindex.forget(self.fasta)
+        with open(self.fasta, 'a') as fp:
+            fp.write('>extra\nACGT\n')
+        index = seqindex.open_index(self.fasta)
+        self.assertEqual((1, ['extra']), self.fetch(index, ['extra']))
+
+    def test_hash_validation(self):
+        seqindex.open_index(self.fasta, validate=seqindex.VALIDATE_HASH)
+        seqindex.forget(self.fasta)
+        st = os.stat(self.fasta)
+        os.utime(self.fasta, (st.st_atime, st.st_mtime + 10))
+        index = seqindex.SequenceIndex(
+            self.fasta, validate=seqindex.VALIDATE_HASH)
+        self.assertTrue(index._is_current())
+        index = seqindex.SequenceIndex(self.fasta)
+        self.assertTrue(index._is_current())
+
+    def test_threads(self):
+        errors = []
+        index = seqindex.SequenceIndex(self.fasta)
+
+        def worker():
+            try:
+                for _ in range(10):
+                    count, fetched = self.fetch(index, self.names)
+                    assert fetched == self.names
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=worker) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual([], errors)
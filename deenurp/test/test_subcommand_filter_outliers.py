@@ -1,12 +1,19 @@
+import argparse
 import unittest
+from StringIO import StringIO
 
 from Bio import SeqIO
+from Bio.Seq import Seq
+from Bio.SeqRecord import SeqRecord
+import pandas as pd
 
-from deenurp import wrap
+import deenurp.util
+from deenurp import outliers, wrap
 from deenurp.subcommands import filter_outliers
+from deenurp.subcommands.filter_outliers import TaxNode
 from deenurp.util import which
 
-from deenurp.test import util
+from deenurp.test import mkdtemp, util
 
 
 class FilterOutliersFunctions(unittest.TestCase):
@@ -22,6 +29,199 @@ class FilterOutliersFunctions(unittest.TestCase):
         distmat = filter_outliers.parse_usearch_allpairs(filename, seqnames)
         self.assertEqual(len(seqnames), distmat.shape[0])
 
+    def test_parse_usearch_allpairs_duplicates(self):
+        with open(util.data_path('e_faecalis.head.allpairs')) as f:
+            lines = f.read().splitlines()
+        with open(util.data_path('e_faecalis.head.fasta')) as f:
+            seqnames = [seq.id for seq in SeqIO.parse(f, 'fasta')]
+
+        # add a shorter and a longer alignment for the first pair
+        first = lines[0].split('\t')
+        shorter = first[:2] + ['10.0', str(int(first[3]) - 1)] + first[4:]
+        longer = first[:2] + ['50.0', str(int(first[3]) + 1)] + first[4:]
+        with deenurp.util.ntf(suffix='.blast6out') as tf:
+            tf.write('\n'.join(lines + ['\t'.join(shorter),
+                                         '\t'.join(longer)]) + '\n')
+            tf.close()
+            distmat = filter_outliers.parse_usearch_allpairs(
+                tf.name, seqnames, chunksize=7)
+
+        i, j = seqnames.index(first[0]), seqnames.index(first[1])
+        self.assertAlmostEqual(0.5, distmat[i, j])
+        self.assertAlmostEqual(0.5, distmat[j, i])
+
+    def test_reference_columns(self):
+        with deenurp.util.ntf(suffix='.sto') as tf:
+            tf.write('# STOCKHOLM 1.0\n\n'
+                     'A        AC..GT\n'
+                     'B        ACgaGT\n'
+                     '#=GC RF  xx..xx\n\n'
+                     'A        -a\n'
+                     'B        A.\n'
+                     '#=GC RF  x.\n'
+                     '//\n')
+            tf.close()
+            columns = filter_outliers.reference_columns(tf.name)
+        self.assertEqual([0, 1, 4, 5, 6], list(columns))
+
+    def test_split_alignment(self):
+        records = [SeqRecord(Seq(seq), id=name) for name, seq in [
+            ('A', 'ACgaGT'), ('B', 'AC--GT'), ('C', 'ACt-GT'),
+            ('D', 'AC-tGT')]]
+        groups = [['A', 'B'], ['C', 'B'], ['B'], ['D', 'A']]
+        result = filter_outliers.split_alignment(records, [0, 1, 4, 5], groups)
+        self.assertEqual(
+            [['ACgaGT', 'AC--GT'], ['ACtGT', 'AC-GT'], ['ACGT']],
+            [[str(r.seq) for r in aligned] for aligned in result[:3]])
+        self.assertEqual(['C', 'B'], [r.id for r in result[1]])
+        # insertion in D isn't flush left
+        self.assertIsNone(result[3])
+
+    def stockholm(self, rows, rf):
+        return ('# STOCKHOLM 1.0\n\n' +
+                ''.join('{:8} {}\n'.format(*row) for row in rows) +
+                '{:8} {}\n//\n'.format('#=GC RF', rf))
+
+    def test_cmalign_batch(self):
+        # a stored cmalign alignment of all the sequences together
+        batch = self.stockholm([
+            ('A', 'ACgt.GTAC..C'), ('B', 'AC...GTTCa.C'),
+            ('C', 'ACg..GAACtaC'), ('D', 'AC...GTAC..G'),
+            ('E', 'AC.g.GTAC..C')], 'xx...xxxx..x')
+        # and of each group by itself
+        separate = [
+            self.stockholm([('A', 'ACgtGTAC.C'), ('B', 'AC..GTTCaC')],
+                           'xx..xxxx.x'),
+            self.stockholm([('C', 'ACgGAACtaC'), ('D', 'AC.GTAC..G')],
+                           'xx.xxxx..x'),
+            self.stockholm([('B', 'ACGTTCaC'), ('D', 'ACGTAC.G')],
+                           'xxxxxx.x')]
+        groups = [['A', 'B'], ['C', 'D'], ['B', 'D'], ['A', 'E']]
+
+        def cmalign_files(input_file, output_file, cpu=None):
+            with open(output_file, 'w') as fp:
+                fp.write(batch)
+            return pd.DataFrame({'bit_sc': [50.0] * 5},
+                                index=list('ABCDE'))
+
+        original = wrap.cmalign_files
+        wrap.cmalign_files = cmalign_files
+        try:
+            result = filter_outliers.cmalign_batch('unused.fasta', groups,
+                                                   'test', cpu=1)
+        finally:
+            wrap.cmalign_files = original
+
+        # the insertion in E isn't flush left
+        self.assertIsNone(result[3])
+        for aligned, sto in zip(result, separate):
+            expected = list(SeqIO.parse(StringIO(sto), 'stockholm'))
+            self.assertEqual([str(r.seq) for r in expected],
+                             [str(r.seq) for r in aligned])
+            taxa, distmat = outliers.alignment_dists(aligned)
+            expected_taxa, expected_distmat = outliers.alignment_dists(
+                expected)
+            self.assertEqual(expected_taxa, taxa)
+            self.assertEqual(expected_distmat[0, 1], distmat[0, 1])
+            self.assertGreater(distmat[0, 1], 0)
+
+    def test_distmat_stored_cmalign(self):
+        # alignments by name, with insert columns in lower case (or '.'),
+        # as cmalign would produce them; the inserts differ between
+        # sequences
+        alignments = [
+            ('A', 'ACgtGTACGTAC'), ('B', 'ACacGTACGAAC'),
+            ('C', 'AC..GTTCGTAC'), ('D', 'ACg.GTACCTAC'),
+            ('E', 'ACttGTACGTTC'), ('F', 'AC..GAACGTAC')]
+        full = dict(alignments)
+        unaligned = [SeqRecord(Seq(seq.replace('.', '').upper()), id=name,
+                               description='') for name, seq in alignments]
+
+        def cmalign_fasta(sequence_file, a_fasta, prefix, cpu=None,
+                          min_bitscore=10, match_fasta=None):
+            for r in SeqIO.parse(sequence_file, 'fasta'):
+                seq = full[r.id]
+                if a_fasta is not None:
+                    a_fasta.write('>{}\n{}\n'.format(r.id, seq))
+                match_fasta.write('>{}\n{}\n'.format(
+                    r.id, ''.join(c for c in seq if c.isupper())))
+            if a_fasta is not None:
+                a_fasta.flush()
+            match_fasta.flush()
+
+        def distmat(records, store):
+            with deenurp.util.as_fasta(records) as fasta:
+                return filter_outliers.distmat_stored(
+                    '1', fasta, 'test', 'cmalign', store, threads=1)
+
+        original = filter_outliers.cmalign_fasta
+        filter_outliers.cmalign_fasta = cmalign_fasta
+        td = mkdtemp(self)
+        try:
+            distmat(unaligned[:4], td('updated'))
+            taxa, updated = distmat(unaligned, td('updated'))
+            fresh_taxa, fresh = distmat(unaligned, td('fresh'))
+        finally:
+            filter_outliers.cmalign_fasta = original
+
+        self.assertEqual(fresh_taxa, taxa)
+        for i in range(len(taxa)):
+            for j in range(len(taxa)):
+                self.assertAlmostEqual(fresh[i, j], updated[i, j])
+
+    @unittest.skipUnless(which('cmalign'), "cmalign not found.")
+    def test_filter_batch_worker(self):
+        fasta = util.data_path('e_faecalis.fasta')
+        names = [r.id for r in SeqIO.parse(fasta, 'fasta')]
+        batch = [(str(i), frozenset(names[i:i + 10]))
+                 for i in range(0, 40, 10)]
+        options = dict(sequence_file=fasta, strategy='radius',
+                       cluster_type='single', distance_cutoff=None,
+                       percentile=50.0, min_radius=0.01, max_radius=0.05,
+                       aligner='cmalign', executable='cmalign', threads=1,
+                       embedding='none')
+        batched = filter_outliers.filter_batch_worker(batch, **options)
+        for (tax_id, seqs), result in zip(batch, batched):
+            expected = filter_outliers.filter_worker(tax_id, seqs=seqs,
+                                                     **options)
+            self.assertTrue(expected.equals(result))
+
+    def test_shard_arg(self):
+        self.assertEqual((2, 8), filter_outliers.shard_arg('2/8'))
+        for value in ('0/8', '9/8', '2', 'a/b'):
+            self.assertRaises(argparse.ArgumentTypeError,
+                              filter_outliers.shard_arg, value)
+
+    def test_shard_taxa(self):
+        sizes = [50, 40, 30, 20, 10, 10, 5, 5]
+        groups = [(TaxNode('species', str(i)), frozenset(range(n)))
+                  for i, n in enumerate(sizes)]
+        shards = filter_outliers.shard_taxa(groups[::-1], 3)
+        self.assertEqual(
+            [['0', '5'], ['1', '4', '6'], ['2', '3', '7']],
+            [[node.tax_id for node, _ in shard] for shard in shards])
+        self.assertEqual([60, 55, 55],
+                         [sum(len(s) for _, s in shard) for shard in shards])
+
+    def test_job_threads(self):
+        per = filter_outliers.SEQS_PER_THREAD
+        self.assertEqual(1, filter_outliers.job_threads(5, 8))
+        self.assertEqual(1, filter_outliers.job_threads(per, 8))
+        self.assertEqual(2, filter_outliers.job_threads(per + 1, 8))
+        self.assertEqual(8, filter_outliers.job_threads(100 * per, 8))
+
+    def test_write_timing_report(self):
+        rows = [{'tax_id': '1', 'tax_name': 'a', 'n_seqs': 5, 'threads': 1,
+                 'seconds': 0.5, 'source': 'filtered'},
+                {'tax_id': '2', 'tax_name': 'b', 'n_seqs': 900, 'threads': 4,
+                 'seconds': 12.25, 'source': 'filtered'}]
+        out = StringIO()
+        filter_outliers.write_timing_report(rows, out)
+        self.assertEqual(
+            'tax_id,tax_name,n_seqs,threads,seconds,source\n'
+            '2,b,900,4,12.250,filtered\n'
+            '1,a,5,1,0.500,filtered\n', out.getvalue())
+
     @unittest.skipUnless(which(wrap.VSEARCH), "{} not found.".format(wrap.VSEARCH))
     def test_distmat_pairwise_vsearch(self):
         infile = util.data_path('e_faecalis.head.fasta')
@@ -0,0 +1,36 @@
+import unittest
+
+from deenurp.subcommands import filter_outliers_merge
+from deenurp.test import mkdtemp
+
+HEADER = 'seqname,tax_id,centroid,cluster,dist,is_out,species,x,y\n'
+
+
+class ReadDetailsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.td = mkdtemp(self, prefix='merge-')
+        with open(self.td('1.csv'), 'w') as fp:
+            fp.write(HEADER)
+            fp.write('a,10,a,1.0,0.0,False,10,0.5,0.25\n')
+            fp.write('b,10,a,1.0,0.125,True,10,-0.5,0.0\n')
+            fp.write('c,2,,,,False,,,\n')
+        with open(self.td('2.csv'), 'w') as fp:
+            fp.write('seqname,tax_id,centroid,dist,is_out,species\n')
+            fp.write('d,11,,,False,11\n')
+
+
+    def test_read_details(self):
+        outcomes = filter_outliers_merge.read_details(
+            [self.td('1.csv'), self.td('2.csv')])
+        self.assertEqual(['a', 'b', 'c', 'd'], list(outcomes.index))
+        self.assertEqual(
+            ['centroid', 'cluster', 'dist', 'is_out', 'species', 'x', 'y'],
+            list(outcomes.columns))
+        self.assertEqual([False, True, False, False],
+                         list(outcomes.is_out))
+        self.assertEqual('11', outcomes.species['d'])
+
+    def test_duplicates(self):
+        with self.assertRaises(ValueError):
+            filter_outliers_merge.read_details(
+                [self.td('1.csv'), self.td('1.csv')])
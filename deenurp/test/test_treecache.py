@@ -0,0 +1,97 @@
+import os
+import unittest
+
+from cStringIO import StringIO
+
+from Bio import SeqIO
+
+from deenurp import treecache, wrap
+from deenurp.test import util as test_util
+from deenurp.test import mkdtemp
+
+
+class TreeCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.td = mkdtemp(self, prefix='treecache-')
+        self.cache = treecache.TreeCache(self.td('cache'))
+
+
+    def test_key(self):
+        k = self.cache.key('>a\nACGT\n', ['-nt', '-gtr'])
+        self.assertEqual(k, self.cache.key('>a\nACGT\n', ['-gtr', '-nt']))
+        self.assertNotEqual(k, self.cache.key('>a\nACGT\n', ['-nt']))
+        self.assertNotEqual(k, self.cache.key('>a\nACGA\n', ['-nt', '-gtr']))
+        self.assertNotEqual(
+            self.cache.key('>a\nACGT\n', ['-nt'], '2.1.10'),
+            self.cache.key('>a\nACGT\n', ['-nt'], '2.1.11'))
+
+    def test_get_put(self):
+        self.assertIsNone(self.cache.get('abcd'))
+        self.cache.put('abcd', '(a,b);\n', 'log')
+        self.assertEqual(('(a,b);\n', 'log'), self.cache.get('abcd'))
+        self.assertEqual({'hits': 1, 'misses': 1, 'stores': 1,
+                          'evictions': 0}, self.cache.stats())
+
+    def test_evict(self):
+        for i, key in enumerate(['aa01', 'bb02', 'cc03']):
+            self.cache.put(key, 'x' * 100)
+            path = self.cache._path(key, treecache.TREE_SUFFIX)
+            os.utime(path, (1000 + i, 1000 + i))
+        self.cache.get('aa01')  # most recently used
+        self.cache.evict(max_bytes=200)
+        self.assertEqual(1, self.cache.evictions)
+        self.assertIsNone(self.cache.get('bb02'))
+        self.assertIsNotNone(self.cache.get('aa01'))
+        self.assertIsNotNone(self.cache.get('cc03'))
+
+    def test_evict_amortized(self):
+        cache = treecache.TreeCache(self.td('cache'), max_bytes=250)
+        scans = []
+        entries = cache._entries
+
+        def counted():
+            scans.append(1)
+            return entries()
+        cache._entries = counted
+
+        cache.put('aa01', 'x' * 100)
+        cache.put('bb02', 'x' * 100)
+        self.assertEqual(1, len(scans))  # the first put only
+        cache.put('cc03', 'x' * 100)
+        self.assertEqual(2, len(scans))
+        self.assertEqual(1, cache.evictions)
+        cache.put('dd04', 'x' * 10)
+        self.assertEqual(2, len(scans))
+
+    def test_env_max_bytes(self):
+        old = os.environ.get(treecache.ENV_MAX_BYTES)
+        os.environ[treecache.ENV_MAX_BYTES] = '1000'
+        try:
+            cache = treecache.configure(self.td('cache'), None)
+            self.assertEqual(1000, cache.max_bytes)
+            cache = treecache.configure(self.td('cache'), 2000)
+            self.assertEqual(2000, cache.max_bytes)
+        finally:
+            if old is None:
+                del os.environ[treecache.ENV_MAX_BYTES]
+            else:
+                os.environ[treecache.ENV_MAX_BYTES] = old
+            treecache.configure(None)
+
+    def test_fasttree_cached(self):
+        sequences = list(SeqIO.parse(
+            test_util.data_path('e_faecium.aln.fasta'), 'fasta'))[:5]
+        buf = StringIO()
+        SeqIO.write(sequences, buf, 'fasta')
+        key = self.cache.key(buf.getvalue(), ['-nt', '-gtr'],
+                             wrap.fasttree_version('FastTree'))
+        self.cache.put(key, '(a,b);\n', 'log text')
+
+        output = StringIO()
+        log_path = self.td('fasttree.log')
+        wrap.fasttree(sequences, output, log_path=log_path, gtr=True,
+                      threads=1, cache=self.cache)
+        self.assertEqual('(a,b);\n', output.getvalue())
+        with open(log_path) as fp:
+            self.assertEqual('log text', fp.read())
+        self.assertEqual(1, self.cache.hits)
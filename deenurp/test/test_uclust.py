@@ -1,7 +1,13 @@
+import csv
 import unittest
 
+from cStringIO import StringIO
+
+from Bio import SeqIO
+
 from deenurp import uclust
 from deenurp.test import util
+from deenurp.util import which
 
 
 class ParseUclustAsDfTestCase(unittest.TestCase):
@@ -12,3 +18,142 @@ class ParseUclustAsDfTestCase(unittest.TestCase):
         df = uclust.parse_uclust_as_df(self.infile)
         # target_label always has a value for types S and H
         self.assertFalse(any(df[df['type'] != 'C']['target_label'].isnull()))
+
+
+class ParseUclustBatchesTestCase(unittest.TestCase):
+    def setUp(self):
+        self.infile = util.data_path('fusobacterium_nucleatum_refs.uc')
+
+    def test_records(self):
+        batches = uclust.parse_uclust_batches(self.infile, batchsize=50)
+        self.assertEqual(list(uclust.parse_uclust_out(self.infile)),
+                         list(uclust.records_from_batches(batches)))
+
+    def test_filters(self):
+        expected = [i.query_label
+                    for i in uclust.parse_uclust_out(self.infile)
+                    if i.type == 'H' and i.pct_id >= 99.5]
+        batches = list(uclust.parse_uclust_batches(
+            self.infile, types=('H',), min_pct_id=99.5,
+            usecols=['query_label'], batchsize=100))
+        self.assertTrue(all(len(b) <= 100 for b in batches))
+        self.assertEqual(
+            expected, [i for b in batches for i in b['query_label']])
+
+
+class ClusterMembersTestCase(unittest.TestCase):
+    def setUp(self):
+        self.infile = util.data_path('fusobacterium_nucleatum_refs.uc')
+
+    def test_sequences_by_cluster(self):
+        expected = [
+            (seed, [i.query_label for i in records])
+            for seed, records in uclust.sequences_by_cluster(
+                self.infile, batchsize=30)]
+        self.assertEqual(26, len(expected))
+        self.assertEqual(
+            expected, list(uclust.cluster_members(self.infile, batchsize=40)))
+
+    def test_sequences_by_cluster_records(self):
+        records = list(uclust.parse_uclust_out(self.infile))
+        expected = {}
+        for i in records:
+            if i.type in ('S', 'H'):
+                expected.setdefault(i.cluster_number, []).append(i)
+        result = list(uclust.sequences_by_cluster(self.infile))
+        self.assertEqual([expected[k] for k in sorted(expected)],
+                         [l for _, l in result])
+        self.assertTrue(all(l[0].type == 'S' for _, l in result))
+        self.assertEqual([], list(uclust.sequences_by_cluster(StringIO(''))))
+
+
+@unittest.skipUnless(which('vsearch'), "vsearch not found.")
+class ClusterCentroidsTestCase(unittest.TestCase):
+    def test_centroids(self):
+        infile = util.data_path('test_db_head.fasta')
+        names = [i.id for i in SeqIO.parse(infile, 'fasta')]
+        seeds = uclust.cluster(infile, pct_id=0.97, quiet=True,
+                               centroids=True)
+        self.assertTrue(seeds)
+        self.assertTrue(set(i.id for i in seeds) <= set(names))
+
+
+class ClusterTestCase(unittest.TestCase):
+    def test_requires_output(self):
+        self.assertRaises(ValueError, uclust.cluster,
+                          util.data_path('test_db_head.fasta'))
+
+
+@unittest.skipUnless(which('vsearch'), "vsearch not found.")
+class SearchIterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.infile = util.data_path('test_db_head.fasta')
+
+    def test_self_hits(self):
+        names = [i.id for i in SeqIO.parse(self.infile, 'fasta')]
+        records = list(uclust.search_iter(
+            self.infile, self.infile, pct_id=0.99, maxaccepts=1,
+            quiet=True, types=('H',)))
+        self.assertEqual(sorted(names), sorted(i.query_label for i in records))
+        self.assertTrue(all(i.pct_id >= 99.0 for i in records))
+
+    def test_close(self):
+        records = uclust.search_iter(self.infile, self.infile, quiet=True)
+        next(records)
+        records.close()
+
+
+class GuppyRedupTestCase(unittest.TestCase):
+    def setUp(self):
+        self.infile = util.data_path('fusobacterium_nucleatum_refs.uc')
+        records = list(uclust.parse_uclust_out(self.infile))
+        self.sample_map = {i.query_label: i.query_label[:4] for i in records}
+
+    def expected(self, sample_map):
+        seeds, clusters = {}, {}
+        for i in uclust.parse_uclust_out(self.infile):
+            if i.type not in ('S', 'H'):
+                continue
+            if i.type == 'S':
+                seeds[i.cluster_number] = i.query_label
+            sample = sample_map[i.query_label] if sample_map else None
+            rep = clusters.setdefault((i.cluster_number, sample),
+                                      [i.query_label, 0])
+            rep[1] += 1
+        return sorted((seeds[c], rep, n)
+                      for (c, _), (rep, n) in clusters.items())
+
+    def test_samples(self):
+        with open(self.infile) as fp:
+            rows = list(uclust.guppy_redup_from_uclust(
+                uclust.parse_uclust_out(fp), self.sample_map))
+        self.assertEqual(self.expected(self.sample_map), sorted(rows))
+
+    def test_batches(self):
+        for batchsize in (7, 50, 1000):
+            batches = uclust.parse_uclust_batches(
+                self.infile, types=('S', 'H'),
+                usecols=['type', 'cluster_number', 'query_label'],
+                batchsize=batchsize)
+            rows = list(uclust.guppy_redup_rows(batches, self.sample_map))
+            self.assertEqual(self.expected(self.sample_map), sorted(rows))
+
+    def test_write(self):
+        buf = StringIO()
+        count = uclust.write_guppy_redup(self.infile, buf, self.sample_map,
+                                         batchsize=50)
+        rows = [(a, b, int(c)) for a, b, c in
+                csv.reader(StringIO(buf.getvalue()))]
+        self.assertEqual(count, len(rows))
+        self.assertEqual(self.expected(self.sample_map), sorted(rows))
+        # in cluster order, as generated
+        self.assertEqual(
+            list(uclust.guppy_redup_from_uclust(
+                uclust.parse_uclust_out(self.infile), self.sample_map)),
+            rows)
+
+    def test_no_samples(self):
+        rows = list(uclust.guppy_redup_from_uclust(
+            uclust.parse_uclust_out(self.infile)))
+        self.assertEqual(26, len(rows))
+        self.assertEqual(self.expected(None), sorted(rows))
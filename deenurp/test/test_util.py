@@ -1,8 +1,12 @@
+import bz2
+import gc
+import gzip
 import os.path
 import operator
 import unittest
 
 from deenurp import util
+from deenurp.test import mkdtemp
 
 
 class UniqueTestCase(unittest.TestCase):
@@ -38,6 +42,51 @@ class MemoizeTestCase(unittest.TestCase):
         self.assertIsNone(m('test'))
 
 
+class LruMemoizeTestCase(unittest.TestCase):
+    def test_bounded(self):
+        calls = []
+
+        @util.lru_memoize(2)
+        def f(x):
+            calls.append(x)
+            return x * 2
+
+        self.assertEqual([2, 4, 2, 6, 2], [f(1), f(2), f(1), f(3), f(1)])
+        # 2 was least recently used when 3 was added
+        self.assertEqual(4, f(2))
+        self.assertEqual([1, 2, 3, 2], calls)
+        info = f.cache_info()
+        self.assertEqual((2, 4, 2, 2), (info['hits'], info['misses'],
+                                        info['evictions'], info['size']))
+        self.assertIn({'name': 'f', 'hits': 2, 'misses': 4, 'evictions': 2},
+                      util.memo_stats())
+
+    def test_stats_by_definition(self):
+        def make():
+            @util.lru_memoize(10)
+            def g(x):
+                return x
+            return g
+
+        for _ in range(3):
+            g = make()
+            g(1)
+            g(1)
+        del g
+        gc.collect()
+        stats = [i for i in util.memo_stats() if i['name'] == 'g']
+        self.assertEqual([{'name': 'g', 'hits': 3, 'misses': 3,
+                           'evictions': 0}], stats)
+
+    def test_recursive(self):
+        @util.lru_memoize(10)
+        def fib(n):
+            return n if n < 2 else fib(n - 1) + fib(n - 2)
+
+        self.assertEqual(6765, fib(20))
+        self.assertEqual(10, fib.cache_info()['size'])
+
+
 class MaybeTempFileTestCase(unittest.TestCase):
     def test_tempfile(self):
         with util.maybe_tempfile(prefix='tmp') as tf:
@@ -52,6 +101,59 @@ class MaybeTempFileTestCase(unittest.TestCase):
             self.assertEqual(o, tf)
 
 
+class FileOpenerTestCase(unittest.TestCase):
+    lines = ['line {}\n'.format(i) for i in xrange(1000)]
+
+    def setUp(self):
+        self.td = mkdtemp(self, prefix='file_opener-')
+
+
+    def _round_trip(self, name, external=True):
+        path = self.td(name)
+        with util.file_opener('w', external=external)(path) as fp:
+            fp.writelines(self.lines)
+        with util.file_opener('r', external=external)(path) as fp:
+            self.assertEqual(self.lines, list(fp))
+        return path
+
+    def test_plain(self):
+        self._round_trip('test.txt')
+
+    def test_gzip(self):
+        path = self._round_trip('test.gz')
+        with gzip.open(path) as fp:
+            self.assertEqual(self.lines, fp.readlines())
+        self._round_trip('test.gz', external=False)
+
+    def test_bzip2(self):
+        path = self._round_trip('test.bz2')
+        with bz2.BZ2File(path) as fp:
+            self.assertEqual(self.lines, fp.readlines())
+        self._round_trip('test.bz2', external=False)
+
+    @unittest.skipUnless(util.which('xz'), "xz not found.")
+    def test_xz(self):
+        self._round_trip('test.xz')
+
+    @unittest.skipUnless(util.which('gzip'), "gzip not found.")
+    def test_partial_read(self):
+        path = self._round_trip('test.gz')
+        with util.file_opener('r')(path) as fp:
+            self.assertEqual(self.lines[0], next(iter(fp)))
+
+    @unittest.skipUnless(util.which('gzip'), "gzip not found.")
+    def test_corrupt(self):
+        path = self.td('corrupt.gz')
+        with open(path, 'w') as fp:
+            fp.write('not gzipped')
+        with util.file_opener('r')(path) as fp:
+            self.assertRaises(IOError, fp.close)
+
+    def test_missing(self):
+        self.assertRaises(IOError, util.file_opener('r'),
+                          self.td('missing.gz'))
+
+
 class RequireExecutableTestCase(unittest.TestCase):
     def test_exists(self):
         util.require_executable('python')
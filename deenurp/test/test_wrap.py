@@ -4,11 +4,13 @@ import tempfile
 import unittest
 
 from Bio import SeqIO
+from taxtastic.refpkg import Refpkg
 
 import deenurp
 from deenurp import wrap
 from deenurp.test import util
 from deenurp.util import which, MissingDependencyError
+from deenurp.test import mkdtemp
 
 
 @unittest.skipUnless(which('cmalign'), "cmalign not found.")
@@ -68,6 +70,80 @@ class RpprMinAdclTreeTestCase(unittest.TestCase):
         self.assertEqual(7, len(prune_seqs))
 
 
+class PplacerTestCase(unittest.TestCase):
+    """
+    Commands built by ``wrap.pplacer``, with pplacer replaced by a stub
+    """
+
+    def setUp(self):
+        self.td = mkdtemp(self, prefix='pplacer-')
+
+        # 3 references and 2 queries of 10 sites
+        with open(self.td('ref.fasta'), 'w') as fp:
+            for i in range(3):
+                fp.write('>ref{0}\nACGTACGTAC\n'.format(i))
+        self.refpkg = self.td('test.refpkg')
+        rp = Refpkg(self.refpkg, create=True)
+        rp.update_file('aln_fasta', self.td('ref.fasta'))
+        with open(self.td('query.fasta'), 'w') as fp:
+            fp.write(open(self.td('ref.fasta')).read())
+            fp.write('>q1\nACGTACGTAC\n>q2\nACGTACGTAA\n')
+
+        self.commands = []
+        self._check_call = wrap.subprocess.check_call
+        self._require_executable = wrap.require_executable
+        wrap.subprocess.check_call = self.check_call
+        wrap.require_executable = lambda name: None
+
+    def tearDown(self):
+        wrap.subprocess.check_call = self._check_call
+        wrap.require_executable = self._require_executable
+
+    def check_call(self, cmd, **kwargs):
+        self.commands.append(cmd)
+        if '--mmap-file' in cmd:
+            # the directory for the mmap file exists while pplacer runs
+            mmap_file = cmd[cmd.index('--mmap-file') + 1]
+            self.assertTrue(os.path.isdir(os.path.dirname(mmap_file)))
+        out_dir = cmd[cmd.index('--out-dir') + 1]
+        open(os.path.join(out_dir, 'query.jplace'), 'w').close()
+
+    def test_footprint(self):
+        self.assertEqual(10 * 3 * 2, wrap.pplacer_footprint(
+            self.refpkg, self.td('query.fasta')))
+
+    def test_below_threshold(self):
+        jplace = wrap.pplacer(self.refpkg, self.td('query.fasta'),
+                              out_dir=self.td(), mmap_threshold=60)
+        self.assertEqual(self.td('query.jplace'), jplace)
+        self.assertEqual(
+            [['pplacer', '-j', '2', '-c', self.refpkg,
+              self.td('query.fasta'), '--out-dir', self.td()]],
+            self.commands)
+
+    def test_above_threshold(self):
+        wrap.pplacer(self.refpkg, self.td('query.fasta'), out_dir=self.td(),
+                     mmap_threshold=59, mmap_dir=self.td())
+        cmd, = self.commands
+        self.assertEqual('--mmap-file', cmd[-2])
+        mmap_file = cmd[-1]
+        self.assertEqual('pplacer.mmap', os.path.basename(mmap_file))
+        self.assertEqual(self.td(), os.path.dirname(os.path.dirname(
+            mmap_file)))
+        # removed after pplacer finishes
+        self.assertFalse(os.path.exists(os.path.dirname(mmap_file)))
+
+    def test_footprint_given(self):
+        wrap.pplacer(self.refpkg, self.td('query.fasta'), out_dir=self.td(),
+                     footprint=10 ** 10)
+        self.assertIn('--mmap-file', self.commands[0])
+
+    def test_no_threshold(self):
+        wrap.pplacer(self.refpkg, self.td('query.fasta'), out_dir=self.td(),
+                     mmap_threshold=None, footprint=10 ** 10)
+        self.assertNotIn('--mmap-file', self.commands[0])
+
+
 try:
     wrap.require_executable(wrap.VSEARCH)
 except MissingDependencyError, e:
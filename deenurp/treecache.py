@@ -0,0 +1,224 @@
+"""
+Content-addressed cache of FastTree results.
+
+Trees are keyed by a digest of the input alignment and the FastTree options
+that affect the result, so rebuilding a reference package for an unchanged
+set of sequences reuses the tree (and FastTree log, used for the phylogenetic
+model) from a previous run. The cache is opt-in: it is enabled with the
+global ``--tree-cache`` option or the ``DEENURP_TREE_CACHE`` environment
+variable.
+
+Entries are evicted least-recently-used first when the total size of the
+cache exceeds its limit.
+"""
+
+import atexit
+import hashlib
+import logging
+import os
+import os.path
+import tempfile
+import threading
+
+log = logging.getLogger(__name__)
+
+ENV_DIR = 'DEENURP_TREE_CACHE'
+ENV_MAX_BYTES = 'DEENURP_TREE_CACHE_MAX_BYTES'
+
+DEFAULT_MAX_BYTES = 1 << 30
+
+TREE_SUFFIX = '.tre'
+LOG_SUFFIX = '.log'
+
+
+class TreeCache(object):
+
+    """
+    A directory of cached FastTree results limited to ``max_bytes``.
+
+    Statistics are available in ``hits``, ``misses``, ``stores`` and
+    ``evictions``.
+    """
+
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        # bytes in the cache as of the last scan, plus entries stored since
+        self._total = None
+        self._lock = threading.Lock()
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory):
+                    raise
+
+    @staticmethod
+    def key(alignment, flags, version=None):
+        """
+        Digest of the FASTA-formatted ``alignment``, FastTree ``flags`` and
+        FastTree ``version``
+        """
+        h = hashlib.sha1()
+        h.update(' '.join(sorted(flags)))
+        h.update('\0')
+        h.update(version or '')
+        h.update('\0')
+        h.update(alignment)
+        return h.hexdigest()
+
+    def _path(self, key, suffix):
+        return os.path.join(self.directory, key[:2], key + suffix)
+
+    def get(self, key):
+        """
+        Return (newick, log) for ``key``, or None if the key is absent.
+        ``log`` is None if no log was stored.
+        """
+        tree_path = self._path(key, TREE_SUFFIX)
+        try:
+            with open(tree_path) as fp:
+                newick = fp.read()
+            log_text = None
+            if os.path.exists(self._path(key, LOG_SUFFIX)):
+                with open(self._path(key, LOG_SUFFIX)) as fp:
+                    log_text = fp.read()
+            os.utime(tree_path, None)  # mark as recently used
+        except (IOError, OSError):
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+        return newick, log_text
+
+    def _write(self, path, text):
+        dirname = os.path.dirname(path)
+        if not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                if not os.path.isdir(dirname):
+                    raise
+        fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.tmp-')
+        with os.fdopen(fd, 'w') as fp:
+            fp.write(text)
+        os.rename(tmp, path)
+
+    def put(self, key, newick, log_text=None):
+        """
+        Store a result, then evict old entries if the cache is over its size
+        limit. The directory is only scanned for the first result stored
+        and when the running total of its size exceeds the limit.
+        """
+        # the log is written first: an entry is present once its tree is
+        if log_text is not None:
+            self._write(self._path(key, LOG_SUFFIX), log_text)
+        self._write(self._path(key, TREE_SUFFIX), newick)
+        size = len(newick) + len(log_text or '')
+        with self._lock:
+            self.stores += 1
+            if self._total is not None:
+                self._total += size
+            full = self._total is None or self._total > self.max_bytes
+        if full:
+            self.evict()
+
+    def _entries(self):
+        """
+        List (mtime, key, size) for each entry.
+        """
+        entries = []
+        for subdir in os.listdir(self.directory):
+            subdir = os.path.join(self.directory, subdir)
+            if not os.path.isdir(subdir):
+                continue
+            for name in os.listdir(subdir):
+                if not name.endswith(TREE_SUFFIX):
+                    continue
+                key = name[:-len(TREE_SUFFIX)]
+                try:
+                    st = os.stat(os.path.join(subdir, name))
+                    size = st.st_size
+                    log_path = self._path(key, LOG_SUFFIX)
+                    if os.path.exists(log_path):
+                        size += os.path.getsize(log_path)
+                except OSError:
+                    continue  # removed by another process
+                entries.append((st.st_mtime, key, size))
+        return entries
+
+    def size(self):
+        return sum(size for _, _, size in self._entries())
+
+    def evict(self, max_bytes=None):
+        """
+        Remove least-recently-used entries until the cache holds at most
+        ``max_bytes``.
+        """
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        entries = sorted(self._entries())
+        total = sum(size for _, _, size in entries)
+        for _, key, size in entries:
+            if total <= max_bytes:
+                break
+            for suffix in (TREE_SUFFIX, LOG_SUFFIX):
+                try:
+                    os.remove(self._path(key, suffix))
+                except OSError:
+                    pass
+            total -= size
+            with self._lock:
+                self.evictions += 1
+        with self._lock:
+            self._total = total
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'stores': self.stores, 'evictions': self.evictions}
+
+    def log_stats(self):
+        log.info('tree cache %s: %d hits, %d misses, %d stores, '
+                 '%d evictions', self.directory, self.hits, self.misses,
+                 self.stores, self.evictions)
+
+
+_default = None
+_default_lock = threading.Lock()
+
+
+def env_max_bytes():
+    """
+    Cache size limit from the environment, or the default
+    """
+    return int(os.environ.get(ENV_MAX_BYTES, DEFAULT_MAX_BYTES))
+
+
+def configure(directory, max_bytes=None):
+    """
+    Set the cache used by ``wrap.fasttree`` when none is given explicitly,
+    limited to ``max_bytes`` (by default, from ``env_max_bytes``).
+    """
+    global _default
+    if max_bytes is None:
+        max_bytes = env_max_bytes()
+    with _default_lock:
+        _default = TreeCache(directory, max_bytes) if directory else None
+        if _default:
+            atexit.register(_default.log_stats)
+    return _default
+
+
+def default_cache():
+    """
+    Return the configured cache, configuring it from the environment on
+    first use. Returns None if caching is not enabled.
+    """
+    if _default is None and os.environ.get(ENV_DIR):
+        configure(os.environ[ENV_DIR])
+    return _default
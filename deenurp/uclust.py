@@ -15,11 +15,11 @@ import itertools
 import logging
 import operator
 import subprocess
-import tempfile
 
 import numpy as np
 import pandas as pd
 from Bio import SeqIO
+from pandas.io.common import EmptyDataError
 
 from .util import require_executable
 
@@ -35,6 +35,16 @@ UCLUST_TYPES = {'cluster_number': int, 'pct_id': float, 'query_start': int,
 
 UClustRecord = collections.namedtuple('UClustRecord', UCLUST_HEADERS)
 
+# Column types for ``parse_uclust_batches``. Integer columns that may be
+# missing (*) are read as floats.
+UCLUST_DTYPES = {'type': str, 'cluster_number': np.int64, 'size': np.int64,
+                 'pct_id': np.float64, 'strand': str,
+                 'query_start': np.float64, 'seed_start': np.float64,
+                 'alignment': str, 'query_label': str, 'target_label': str}
+
+# Rows per batch for ``parse_uclust_batches``
+UCLUST_BATCHSIZE = 100000
+
 
 @contextlib.contextmanager
 def _handle(s, *args, **kwargs):
@@ -51,15 +61,6 @@ def _handle(s, *args, **kwargs):
         yield s
 
 
-@contextlib.contextmanager
-def _maybe_tempfile_name(obj=None, **kwargs):
-    if obj:
-        yield obj
-    else:
-        with tempfile.NamedTemporaryFile(**kwargs) as tf:
-            yield tf.name
-
-
 def _check_call(cmd, **kwargs):
     """
     Log and run command. Additional arguments are passed to
@@ -71,17 +72,16 @@ def _check_call(cmd, **kwargs):
 
 
 # Parsing
+_NA = frozenset(('*', ''))
+_CONVERTERS = [UCLUST_TYPES.get(h, str) for h in UCLUST_HEADERS]
+
+
 def _parse_uclust_row(row):
     if not len(row) == len(UCLUST_HEADERS):
         raise ValueError("Unexpected row length: {0} ({1})".format(len(row), row))
-    for i, (header, val) in enumerate(zip(UCLUST_HEADERS, row)):
-        # Replace NA char (*) with None, type convert
-        if val in ('*', ''):
-            row[i] = None
-        elif header in UCLUST_TYPES:
-            row[i] = UCLUST_TYPES[header](val)
-
-    return UClustRecord(*row)
+    # Replace NA char (*) with None, type convert
+    return UClustRecord._make([None if val in _NA else convert(val)
+                               for convert, val in zip(_CONVERTERS, row)])
 
 
 def parse_uclust_out(ucout_fp):
@@ -91,11 +91,76 @@ def parse_uclust_out(ucout_fp):
     ucout_fp can be file name or file handle.
     """
     with _handle(ucout_fp) as fp:
-        # Skip comments
-        rows = (i.rstrip() for i in fp if not i.startswith('#'))
-        reader = csv.reader(rows, delimiter='\t')
-        for row in reader:
-            yield _parse_uclust_row(row)
+        for line in fp:
+            # Skip comments
+            if line.startswith('#'):
+                continue
+            yield _parse_uclust_row(line.rstrip('\r\n').split('\t'))
+
+
+def parse_uclust_batches(ucout_fp, types=None, min_pct_id=None,
+                         usecols=None, batchsize=UCLUST_BATCHSIZE):
+    """
+    Parse the results of running UCLUST in batches of up to ``batchsize``
+    rows, generating DataFrames with columns ``UCLUST_HEADERS`` (or
+    ``usecols``).
+
+    Filters are applied to each batch as it is read:
+
+     types:       keep only records with a type in ``types`` (eg, ``'H'``)
+     min_pct_id:  drop hits with identity below ``min_pct_id`` (a
+                  percentage, as reported in the file)
+
+    Missing values (``*``) are NaN; ``query_start`` and ``seed_start`` are
+    floating point so that they can hold NaN. Unlike ``parse_uclust_out``,
+    comment lines are not supported (vsearch does not write them).
+
+    ucout_fp can be file name or file handle.
+    """
+    if usecols is not None:
+        # filtered columns are always read
+        usecols = set(usecols)
+        if types is not None:
+            usecols.add('type')
+        if min_pct_id is not None:
+            usecols.add('pct_id')
+        usecols = [h for h in UCLUST_HEADERS if h in usecols]
+    try:
+        reader = pd.read_csv(
+            ucout_fp, sep='\t', names=UCLUST_HEADERS, usecols=usecols,
+            dtype=UCLUST_DTYPES, na_values=list(_NA), keep_default_na=False,
+            quoting=csv.QUOTE_NONE, chunksize=batchsize)
+    except EmptyDataError:
+        return  # no records
+    for batch in reader:
+        if types is not None:
+            batch = batch[batch['type'].isin(types).values]
+        if min_pct_id is not None:
+            batch = batch[~(batch['pct_id'] < min_pct_id).values]
+        if len(batch):
+            yield batch.reset_index(drop=True)
+
+
+def records_from_batches(batches):
+    """
+    Generate UClustRecords from DataFrames produced by
+    ``parse_uclust_batches`` (with all columns), for consumers of
+    ``parse_uclust_out`` such as ``hits_by_sequence`` and ``cluster_map``.
+    """
+    for batch in batches:
+        columns = []
+        for header, convert in zip(UCLUST_HEADERS, _CONVERTERS):
+            col = batch[header]
+            isnull = col.isnull().values
+            values = col.values.tolist()
+            if isnull.any():
+                values = [None if n else convert(v)
+                          for v, n in zip(values, isnull)]
+            elif convert is int and col.dtype.kind == 'f':
+                values = [int(v) for v in values]
+            columns.append(values)
+        for row in itertools.izip(*columns):
+            yield UClustRecord._make(row)
 
 
 def parse_uclust_as_df(ucout_fp):
@@ -128,21 +193,71 @@ def hits_by_sequence(uclust_records):
         yield g, [i for i in v if i.type == 'H']
 
 
-def sequences_by_cluster(uclust_records):
+def sequences_by_cluster(ucout_fp, batchsize=UCLUST_BATCHSIZE):
     """
-    Collect sequences by cluster
+    Collect sequences by cluster from UCLUST output
+
+    Generates (seed_sequence_id, records_in_cluster) tuples, ordered by
+    cluster number, with records in input order within each cluster.
+    Seed and hit rows are held as column arrays, as in
+    ``cluster_members``; UClustRecords are only built for the cluster
+    being generated.
 
-    Generates (seed_sequence_id, records_in_cluster) tuples from an iterable
-    of uclust records.
+    ucout_fp can be file name or file handle.
     """
-    # Seeds and hits
-    k = operator.attrgetter('cluster_number')
-    r = (i for i in uclust_records if i.type in ('S', 'H'))
-    s = sorted(r, key=k)
-    grouped = itertools.groupby(s, k)
-    for g, v in grouped:
-        l = list(v)
-        yield l[0].query_label, l
+    grouped = _cluster_columns(ucout_fp, None, batchsize)
+    if grouped is None:
+        return
+    columns, order, bounds = grouped
+    for indices in np.split(order, bounds):
+        batch = pd.DataFrame(collections.OrderedDict(
+            (h, columns[h][indices]) for h in UCLUST_HEADERS))
+        records = list(records_from_batches([batch]))
+        yield records[0].query_label, records
+
+
+def cluster_members(ucout_fp, batchsize=UCLUST_BATCHSIZE):
+    """
+    Collect sequence names by cluster from UCLUST output
+
+    Generates (seed_sequence_id, sequence_ids_in_cluster) tuples, in the
+    same order as ``sequences_by_cluster``, holding only arrays of cluster
+    numbers and sequence names in memory.
+
+    ucout_fp can be file name or file handle.
+    """
+    grouped = _cluster_columns(
+        ucout_fp, ['cluster_number', 'query_label'], batchsize)
+    if grouped is None:
+        return
+    columns, order, bounds = grouped
+    for group in np.split(columns['query_label'][order], bounds):
+        group = group.tolist()
+        yield group[0], group
+
+
+def _cluster_columns(ucout_fp, usecols, batchsize):
+    """
+    Read the seed and hit rows of UCLUST output into arrays, returning
+    (dict of arrays by column, order, bounds), where ``order`` sorts the
+    rows by cluster number (stable, so input order is kept within each
+    cluster) and ``bounds`` are the positions in ``order`` where a new
+    cluster starts; None if there are no rows.
+    """
+    columns = collections.defaultdict(list)
+    for batch in parse_uclust_batches(ucout_fp, types=('S', 'H'),
+                                      usecols=usecols, batchsize=batchsize):
+        for name in batch.columns:
+            columns[name].append(batch[name].values)
+    if not columns:
+        return None
+
+    columns = dict((name, np.concatenate(values))
+                   for name, values in columns.items())
+    numbers = columns['cluster_number']
+    order = np.argsort(numbers, kind='mergesort')
+    bounds = np.flatnonzero(np.diff(numbers[order])) + 1
+    return columns, order, bounds
 
 
 def cluster_map(uclust_records):
@@ -160,15 +275,15 @@ def cluster_map(uclust_records):
             yield (row.cluster_number, row.query_label, row.target_label)
 
 
-def search(database, query, output, pct_id=DEFAULT_PCT_ID,
-           maxaccepts=None, maxrejects=None, quiet=False, search_pct_id=None):
+def search_iter(database, query, pct_id=DEFAULT_PCT_ID, maxaccepts=None,
+                maxrejects=None, quiet=False, search_pct_id=None, types=None):
     """
-    Run UCLUST against a sequence database in FASTA format.
+    Run UCLUST against a sequence database in FASTA format, generating
+    UClustRecords as vsearch reports them.
 
     Parameters:
      database:        Path to FASTA file to search against
      query:           Path to query file
-     output:          Path for uclust output
      pct_id:          Minimum identity for match (provided to ``uclust --id``)
      search_pct_id:   If given, the database is searched at search_pct_id, then
                       the results filtered to only include sequences that match
@@ -176,58 +291,134 @@ def search(database, query, output, pct_id=DEFAULT_PCT_ID,
 
                       Note: If search_pct_id is specified, cluster sizes will
                       be inaccurate.
+     types:           If given, only records with a type in ``types`` (eg,
+                      ``'H'``) are generated.
+
+    vsearch is stopped if the generator is closed before it is exhausted.
 
     Others: see ``vsearch --help``
     """
     require_executable('vsearch')
-    with _maybe_tempfile_name(
-            output if not search_pct_id else None, prefix='vsearch-') as o:
+    cmd = ['vsearch',
+           '--usearch_global', query,
+           '--db', database,
+           '--uc', '/dev/stdout',
+           '--uc_allhits',  # show all, not just top hit with uc output
+           '--id', str(search_pct_id or pct_id)]  # Prefer search_pct_id
+    if maxaccepts:
+        cmd.extend(('--maxaccepts', str(maxaccepts)))
+    if maxrejects:
+        cmd.extend(('--maxrejects', str(maxrejects)))
+    if quiet:
+        cmd.append('--quiet')
+
+    # IDs in the output file are reported as percentages.
+    id_cutoff = pct_id * 100.0 if search_pct_id else None
+
+    cmd = map(str, cmd)
+    logging.debug(' '.join(cmd))
+    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, bufsize=1 << 16)
+    exhausted = False
+    try:
+        for line in iter(p.stdout.readline, ''):
+            if types is not None and line[0] not in types:
+                continue
+            record = _parse_uclust_row(line.rstrip('\r\n').split('\t'))
+            # Filter records which don't meet the pct_id criteria
+            if id_cutoff is not None and record.type == 'H' and \
+                    record.pct_id < id_cutoff:
+                continue
+            yield record
+        exhausted = True
+    finally:
+        p.stdout.close()
+        if not exhausted and p.poll() is None:
+            # stopped early
+            p.terminate()
+        returncode = p.wait()
+
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, cmd)
+
+
+def _format_uclust_row(record):
+    return '\t'.join('*' if v is None else str(v) for v in record) + '\n'
+
+
+def search(database, query, output, pct_id=DEFAULT_PCT_ID,
+           maxaccepts=None, maxrejects=None, quiet=False, search_pct_id=None):
+    """
+    Run UCLUST against a sequence database in FASTA format, writing the
+    results to ``output``. Parameters are as for ``search_iter``.
+    """
+    if not search_pct_id:
+        require_executable('vsearch')
         cmd = ['vsearch',
                '--usearch_global', query,
                '--db', database,
-               '--uc', o,
-               '--uc_allhits',  # show all, not just top hit with uc output
-               '--id', str(search_pct_id or pct_id)]  # Prefer search_pct_id
+               '--uc', output,
+               '--uc_allhits',
+               '--id', str(pct_id)]
         if maxaccepts:
             cmd.extend(('--maxaccepts', str(maxaccepts)))
         if maxrejects:
             cmd.extend(('--maxrejects', str(maxrejects)))
         if quiet:
             cmd.append('--quiet')
-
         _check_call(cmd)
+        return
 
-        if search_pct_id:
-            # Filter results, write to output
-            with open(output, 'w') as uc:
-                w = csv.writer(uc, lineterminator='\n', delimiter='\t')
-                records = parse_uclust_out(o)
-                # Filter records which don't meet the pct_id criteria
-                # IDs in the output file are reported as percentages.
-                id_cutoff = pct_id * 100.0
-                records = (i for i in records if i.type != 'H' or i.pct_id >= id_cutoff)
-                w.writerows(records)
+    # Filter results, write to output
+    with open(output, 'w') as uc:
+        for record in search_iter(database, query, pct_id=pct_id,
+                                  maxaccepts=maxaccepts,
+                                  maxrejects=maxrejects, quiet=quiet,
+                                  search_pct_id=search_pct_id):
+            uc.write(_format_uclust_row(record))
 
 
-def cluster(sequence_file, output, pct_id=DEFAULT_PCT_ID, quiet=False,
-            pre_sorted=False, threads=None):
+def cluster(sequence_file, output=None, pct_id=DEFAULT_PCT_ID, quiet=False,
+            pre_sorted=False, threads=None, centroids=False):
     """Cluster de novo. If ``pre_sorted`` is True, assume that sequences
     are pre-sorted by length (and cluster using --cluster_smallmem
     rather than --cluster_fast). See ``vsearch --help`` for details.
 
+    If ``centroids`` is True, the cluster seeds are read from vsearch
+    through a pipe and returned as a list of SeqRecords; ``output`` (the
+    .uc file) is optional in this case.
+
     """
+    if not (output or centroids):
+        raise ValueError('Specify output and/or centroids')
     require_executable('vsearch')
     cmd = ['vsearch',
            '--cluster_smallmem' if pre_sorted else '--cluster_fast', sequence_file,
-           '--uc', output,
            '--id', str(pct_id)]
+    if output:
+        cmd.extend(['--uc', output])
     if quiet:
         cmd.append('--quiet')
     if not pre_sorted:
         cmd.append('--usersort')
     if threads is not None:
         cmd.extend(['--threads', str(threads)])
-    _check_call(cmd)
+
+    if not centroids:
+        _check_call(cmd)
+        return
+
+    cmd.extend(['--centroids', '/dev/stdout'])
+    cmd = map(str, cmd)
+    logging.debug(' '.join(cmd))
+    p = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    try:
+        seeds = list(SeqIO.parse(p.stdout, 'fasta'))
+    finally:
+        p.stdout.close()
+        returncode = p.wait()
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, cmd)
+    return seeds
 
 
 def cluster_seeds(sequence_file, uclust_out):
@@ -256,53 +447,116 @@ def cluster_seeds(sequence_file, uclust_out):
 # Functions to convert uclust output into format usable by `guppy redup -m`
 
 
-class DeduplicatedSequence(object):
-    __slots__ = ['id', 'count']
-
-    def __init__(self, id, count):
-        self.id = id
-        self.count = count
-
+def guppy_redup_rows(batches, sample_map=None):
+    """
+    Generate (seed_id, sequence_id, count) rows for a guppy-redup
+    compatible mapping file from batches of UCLUST output (see
+    ``parse_uclust_batches``; the ``type``, ``cluster_number`` and
+    ``query_label`` columns are required).
+
+    If ``sample_map`` (a dict mapping sequence ids to samples) is specified,
+    one sequence is kept from every sample present in each cluster - the
+    first seen - along with a count of sequences from the sample within the
+    cluster. Otherwise, each cluster is reduced to its first sequence and a
+    count of sequences within.
+
+    Counts are accumulated in arrays keyed by (cluster, sample) codes, so
+    memory use scales with the number of distinct pairs. Rows are
+    generated in order of cluster number, then first appearance of each
+    sample.
+    """
+    keys = np.empty(0, dtype=np.int64)
+    reps = np.empty(0, dtype=object)
+    counts = np.empty(0, dtype=np.int64)
+    pending = []  # (keys, reps, counts) not yet merged into the above
+    n_pending = 0
+    sample_codes = {}
+    seeds = {}
 
-class ConstantDict(object):
-    def __init__(self, return_value=None):
-        self.return_value = return_value
+    def merge(parts):
+        # np.unique returns the first occurrence of each key, and parts are
+        # in input order, so earlier representatives are kept.
+        all_keys, all_reps, all_counts = (np.concatenate(i)
+                                          for i in zip(*parts))
+        keys, first, inverse = np.unique(
+            all_keys, return_index=True, return_inverse=True)
+        counts = np.bincount(inverse, weights=all_counts).astype(np.int64)
+        return keys, all_reps[first], counts
+
+    for batch in batches:
+        batch = batch[batch['type'].isin(('S', 'H')).values]
+        if not len(batch):
+            continue
+        labels = batch['query_label'].str.split(n=1).str[0].values
+        numbers = batch['cluster_number'].values.astype(np.int64)
+
+        is_seed = (batch['type'] == 'S').values
+        seeds.update(zip(numbers[is_seed].tolist(), labels[is_seed]))
+
+        if sample_map is None:
+            codes = np.zeros(len(labels), dtype=np.int64)
+        else:
+            samples = pd.Series(labels).map(sample_map)
+            if samples.isnull().any():
+                raise KeyError(labels[samples.isnull().values][0])
+            for sample in pd.unique(samples.values):
+                sample_codes.setdefault(sample, len(sample_codes))
+            codes = samples.map(sample_codes).values.astype(np.int64)
+
+        part = merge([((numbers << 32) | codes, labels,
+                       np.ones(len(labels), dtype=np.int64))])
+        pending.append(part)
+        n_pending += len(part[0])
+        # Only fold pending batches into the totals once they outgrow
+        # them, so each key is re-sorted O(log n) times overall.
+        if n_pending > len(keys):
+            keys, reps, counts = merge([(keys, reps, counts)] + pending)
+            pending, n_pending = [], 0
+
+    if pending:
+        keys, reps, counts = merge([(keys, reps, counts)] + pending)
+
+    for number, rep, count in itertools.izip(
+            (keys >> 32).tolist(), reps, counts.tolist()):
+        yield seeds[number], rep, count
+
+
+def write_guppy_redup(ucout_fp, output_fp, sample_map=None,
+                      batchsize=UCLUST_BATCHSIZE):
+    """
+    Write a guppy-redup compatible mapping file (CSV) to ``output_fp`` from
+    UCLUST output (see ``guppy_redup_rows``), one row at a time, returning
+    the number of rows written.
 
-    def __getitem__(self, item):
-        return self.return_value
+    ucout_fp can be file name or file handle.
+    """
+    batches = parse_uclust_batches(
+        ucout_fp, types=('S', 'H'),
+        usecols=['type', 'cluster_number', 'query_label'],
+        batchsize=batchsize)
+    writer = csv.writer(output_fp, lineterminator='\n')
+    count = 0
+    for row in guppy_redup_rows(batches, sample_map):
+        writer.writerow(row)
+        count += 1
+    return count
 
 
 def guppy_redup_from_uclust(uclust_records, sample_map=None):
     """
-    Generate a guppy-redup compatible mapping file from UCLUST output.
-
-    If sample map is specified, at one sequence is kept in the output map from
-    every specimen present in each cluster, along with a count of sequences
-    from the specimen within the cluster.
-
-    Otherwise, each cluster is reduced to the seed id and a count of sequences
-    within.
+    Generate rows of a guppy-redup compatible mapping from UClustRecords
+    (see ``guppy_redup_rows``).
     """
-    sample_map = sample_map or ConstantDict()
-    # Map from cluster number to seed id
-    seeds = {}
-    # Map from cluster number to map of sample->seed,count
-    clusters = collections.defaultdict(dict)
-    # Just seeds and hits
-    uclust_records = (i for i in uclust_records if i.type in ('S', 'H'))
-
-    for record in uclust_records:
-        number = record.cluster_number
-        q = record.query_label.split()[0]
-        sample = sample_map[q]
-        if record.type == 'S':
-            seeds[number] = q
-        if sample not in clusters[number]:
-            clusters[number][sample] = DeduplicatedSequence(q, 1)
-        else:
-            clusters[number][sample].count += 1
-
-    rows = [(seeds[num], dedup_seq.id, dedup_seq.count)
-            for num, samples in clusters.items()
-            for dedup_seq in samples.values()]
-    return rows
+    columns = ['type', 'cluster_number', 'query_label']
+    records = (i for i in uclust_records if i.type in ('S', 'H'))
+
+    def batches():
+        while True:
+            chunk = list(itertools.islice(records, UCLUST_BATCHSIZE))
+            if not chunk:
+                return
+            yield pd.DataFrame.from_records(
+                [(i.type, i.cluster_number, i.query_label) for i in chunk],
+                columns=columns)
+
+    return guppy_redup_rows(batches(), sample_map)
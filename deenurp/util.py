@@ -2,20 +2,28 @@
 Utility functions
 """
 
+import atexit
 import bz2
+import collections
 import contextlib
 import functools
 import gzip
+import io
 import itertools
+import logging
 import os
 import os.path
 import shutil
+import subprocess
 import sys
-import time
+import threading
 import tempfile
+import weakref
 
 from Bio import SeqIO
 
+from . import scratch
+
 
 def apply_df_status(func, df, msg=''):
     """
@@ -34,39 +42,6 @@ def apply_df_status(func, df, msg=''):
     return df.drop(tmp_column, axis=1)
 
 
-class Counter(object):
-
-    """
-    Count objects processed in iterable. By default, progress is written to
-    stderr every 0.3 seconds of work.
-    """
-
-    def __init__(self, iterable, stream=sys.stderr, report_every=0.3,
-                 prefix=''):
-        self._it = iter(iterable)
-        self.count = 0
-        self.stream = stream
-        self.report_every = report_every
-        self.prefix = prefix
-        self.start = time.clock()
-        self.last = 0
-
-    def _report(self):
-        if self.stream:
-            msg = '{0}{1:15d} [{2:10.2f}s]\r'
-            msg = msg.format(self.prefix, self.count, time.clock()-self.start)
-            self.stream.write(msg)
-
-    def __iter__(self):
-        for i in self._it:
-            yield i
-            self.count += 1
-            now = time.clock()
-            if now - self.last > self.report_every:
-                self._report()
-                self.last = now
-
-
 class SingletonDefaultDict(dict):
 
     """
@@ -98,6 +73,109 @@ def memoize(fn):
     return inner
 
 
+"""Default maximum number of entries in caches created by ``lru_memoize``
+(set with the global ``--memo-size`` option or ``$DEENURP_MEMO_SIZE``)"""
+MEMO_MAXSIZE = int(os.environ.get('DEENURP_MEMO_SIZE', 100000))
+
+_MEMO_COUNTERS = ('hits', 'misses', 'evictions')
+
+# counters by memoized function definition: caches created each time an
+# enclosing function runs share an entry, and the counts of caches that
+# have been collected are kept in 'retired'
+_memo_caches = collections.OrderedDict()
+_memo_lock = threading.RLock()
+
+
+def lru_memoize(maxsize=None):
+    """
+    Memoize a function, keeping at most ``maxsize`` results (default
+    ``MEMO_MAXSIZE``, read when results are added), discarding the least
+    recently used. Safe to use from multiple threads; the lock is not held
+    while the function runs, so concurrent calls with the same arguments
+    may each compute the result.
+
+    Hit, miss and eviction counts are available from ``fn.cache_info()``,
+    and are logged (at debug level) at exit, summed over the caches
+    created for each definition of a memoized function.
+    """
+    def decorator(fn):
+        cache = collections.OrderedDict()
+        lock = threading.Lock()
+        info = {'name': fn.__name__, 'hits': 0, 'misses': 0, 'evictions': 0}
+
+        @functools.wraps(fn)
+        def inner(*args):
+            with lock:
+                if args in cache:
+                    # move to the most recently used position
+                    result = cache[args] = cache.pop(args)
+                    info['hits'] += 1
+                    return result
+                info['misses'] += 1
+
+            result = fn(*args)
+
+            with lock:
+                cache[args] = result
+                limit = MEMO_MAXSIZE if maxsize is None else maxsize
+                while len(cache) > limit:
+                    cache.popitem(last=False)
+                    info['evictions'] += 1
+            return result
+
+        def cache_info():
+            with lock:
+                return dict(info, size=len(cache))
+
+        inner.cache = cache
+        inner.cache_info = cache_info
+        _register_memo(fn, inner, info)
+        return inner
+    return decorator
+
+
+def _register_memo(fn, inner, info):
+    # only the counters are registered, so caches can be collected
+    with _memo_lock:
+        if not _memo_caches:
+            atexit.register(log_memo_stats)
+        entry = _memo_caches.get(fn.__code__)
+        if entry is None:
+            entry = _memo_caches[fn.__code__] = {
+                'name': fn.__name__, 'live': {},
+                'retired': dict.fromkeys(_MEMO_COUNTERS, 0)}
+        key = id(info)
+
+        def retire(ref):
+            with _memo_lock:
+                for k in _MEMO_COUNTERS:
+                    entry['retired'][k] += info[k]
+                del entry['live'][key]
+        entry['live'][key] = (weakref.ref(inner, retire), info)
+
+
+def memo_stats():
+    """
+    Return hit, miss and eviction counts for each function memoized with
+    ``lru_memoize``, in order of definition, summed over its caches
+    """
+    with _memo_lock:
+        result = []
+        for entry in _memo_caches.values():
+            stats = dict(entry['retired'], name=entry['name'])
+            for _, info in entry['live'].values():
+                for k in _MEMO_COUNTERS:
+                    stats[k] += info[k]
+            result.append(stats)
+        return result
+
+
+def log_memo_stats():
+    for i in memo_stats():
+        logging.debug('cache %(name)s: %(hits)d hits, %(misses)d misses, '
+                      '%(evictions)d evictions', i)
+
+
 def unique(iterable, key=lambda x: x):
     """
     Choose unique elements from iterable, using the value returned by `key` to
@@ -120,17 +198,25 @@ def nothing(obj=None):
 
 
 @contextlib.contextmanager
-def ntf(**kwargs):
+def ntf(size_hint=None, **kwargs):
     """
     Near-clone of tempfile.NamedTemporaryFile, but the file is deleted when the
     context manager exits, rather than when it's closed.
+
+    Unless ``dir`` is given, the file is placed by the scratch manager
+    (see ``scratch``), using ``size_hint`` (bytes) if known.
     """
+    manager = scratch.default()
     kwargs['delete'] = False
+    if kwargs.get('dir') is None:
+        kwargs['dir'] = manager.acquire(size_hint)
     tf = tempfile.NamedTemporaryFile(**kwargs)
+    manager.track(tf.name, size_hint)
     try:
         with tf:
             yield tf
     finally:
+        manager.release(tf.name)
         os.unlink(tf.name)
 
 
@@ -150,10 +236,10 @@ def tempcopy(path, **kwargs):
 
 
 @contextlib.contextmanager
-def tempdir(**kwargs):
+def tempdir(size_hint=None, **kwargs):
     """
     Create a temporary directory for the duration of the context manager,
-    removing on exit.
+    removing on exit. The directory is placed as for ``ntf``.
 
     :returns: a partially applied os.path.join, with name of the temporary
     directory as the first argument
@@ -165,10 +251,15 @@ def tempdir(**kwargs):
     Directory is: /tmp/rubbish-5AQFpo
     Put some data in: /tmp/rubbish-5AQFpo/file1.txt
     """
+    manager = scratch.default()
+    if kwargs.get('dir') is None:
+        kwargs['dir'] = manager.acquire(size_hint)
     td = tempfile.mkdtemp(**kwargs)
+    manager.track(td, size_hint)
     try:
         yield functools.partial(os.path.join, td)
     finally:
+        manager.release(td)
         shutil.rmtree(td)
 
 
@@ -179,6 +270,10 @@ def as_fasta(sequences, **kwargs):
     """
     if 'suffix' not in kwargs:
         kwargs['suffix'] = '.fasta'
+    if isinstance(sequences, (list, tuple)) and 'size_hint' not in kwargs:
+        # sequence lines are wrapped at 60 characters
+        kwargs['size_hint'] = sum(len(s) * 61 // 60 + len(s.id) +
+                                  len(s.description) + 4 for s in sequences)
     with ntf(**kwargs) as tf:
         SeqIO.write(sequences, tf, 'fasta')
         tf.flush()
@@ -212,12 +307,133 @@ def cd(path):
         os.chdir(curdir)
 
 
-def file_opener(mode='r', buffering=-1):
+"""Buffer size for files opened by ``file_opener``"""
+IO_BUFSIZE = 1 << 20
+
+"""
+External codec commands for compressed file extensions, in order of
+preference. Parallel implementations are preferred; each is run as
+``<command> -d -c FILE`` to read and ``<command> -c > FILE`` to write.
+"""
+CODECS = {
+    '.gz': (['pigz'], ['gzip']),
+    '.bz2': (['pbzip2'], ['lbzip2'], ['bzip2']),
+    '.xz': (['xz', '-T0'],),
+    '.zst': (['zstd', '-q', '-T0'],),
+}
+
+
+def _codec_command(extension):
+    """
+    The first available external codec command for ``extension``, or None
+    """
+    for command in CODECS.get(extension, ()):
+        if which(command[0]):
+            return command
+    return None
+
+
+class CodecPipe(object):
+
+    """
+    File-like object reading from or writing to an external codec process.
+
+    ``close`` waits for the process, raising IOError if it failed. A reader
+    closed before the end of its input stops the process instead.
+    """
+
+    def __init__(self, proc, fp, name, mode):
+        self._proc = proc
+        self._fp = fp
+        self.name = name
+        self.mode = mode
+
+    def __getattr__(self, attr):
+        return getattr(self._fp, attr)
+
+    def __iter__(self):
+        return iter(self._fp)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self._fp.closed:
+            return
+        # whether the process has written all of its output
+        finished = 'r' not in self.mode or \
+            not os.read(self._fp.fileno(), 1)
+        self._fp.close()
+        if not finished:
+            if self._proc.poll() is None:
+                self._proc.terminate()
+            self._proc.wait()
+            return
+        if self._proc.wait() != 0:
+            raise IOError('{} failed for {} (exit status {})'.format(
+                self._proc.args[0], self.name, self._proc.returncode))
+
+
+def _open_codec_pipe(command, f, mode):
+    if 'r' in mode:
+        args = command + ['-d', '-c', f]
+        with open(f, 'rb'):  # raise IOError for a missing file here
+            pass
+        proc = subprocess.Popen(args, stdout=subprocess.PIPE,
+                                bufsize=IO_BUFSIZE)
+        fp = proc.stdout
+    else:
+        args = command + ['-c']
+        with open(f, 'ab' if 'a' in mode else 'wb') as out:
+            proc = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=out,
+                                    bufsize=IO_BUFSIZE)
+        fp = proc.stdin
+    proc.args = args
+    return CodecPipe(proc, fp, f, mode)
+
+
+def _open_in_process(extension, f, mode, buffering):
+    """
+    Open a compressed file with the codecs available in this process
+    """
+    if extension == '.gz':
+        if 'r' in mode:
+            return io.BufferedReader(gzip.open(f, 'rb'), buffering)
+        return gzip.open(f, mode)
+    elif extension == '.bz2':
+        return bz2.BZ2File(f, mode=mode, buffering=buffering)
+    elif extension == '.xz':
+        try:
+            from backports import lzma
+        except ImportError:
+            raise MissingDependencyError(
+                'xz (or the backports.lzma package) is required for ' + f)
+        return lzma.open(f, mode)
+    elif extension == '.zst':
+        try:
+            import zstandard
+        except ImportError:
+            raise MissingDependencyError(
+                'zstd (or the zstandard package) is required for ' + f)
+        return zstandard.open(f, mode)
+    raise ValueError('unknown compression: ' + extension)
+
+
+def file_opener(mode='r', buffering=-1, external=True):
     """
     Returns a function that behaves similarly to ``open(...)``,
-    but opens compressed files for certain matching extensions, currently
-    ``.bz2`` is treated as bzip2-compression, and ``.gz`` is treated as gzip.
+    but opens compressed files for certain matching extensions: ``.gz``
+    (gzip), ``.bz2`` (bzip2), ``.xz`` and ``.zst`` (zstandard).
+
+    Compressed files are decompressed (or compressed) by an external codec
+    process from ``CODECS`` if one is installed and ``external`` is True,
+    otherwise in this process. Reads are buffered with ``IO_BUFSIZE``
+    unless ``buffering`` is given.
     """
+    bufsize = IO_BUFSIZE if buffering < 0 else buffering
 
     def open_file(f):
         out = None
@@ -225,12 +441,16 @@ def file_opener(mode='r', buffering=-1):
             out = f
         elif f == '-':
             out = sys.stdin if 'r' in mode else sys.stdout
-        elif f.endswith('.bz2'):
-            out = bz2.BZ2File(f, mode=mode, buffering=buffering)
-        elif f.endswith('.gz'):
-            out = gzip.open(f, mode=mode)
         else:
-            out = open(f, mode=mode, buffering=buffering)
+            extension = os.path.splitext(f)[1]
+            if extension not in CODECS:
+                out = open(f, mode=mode, buffering=bufsize)
+            else:
+                command = _codec_command(extension) if external else None
+                if command:
+                    out = _open_codec_pipe(command, f, mode)
+                else:
+                    out = _open_in_process(extension, f, mode, bufsize or 1)
         return out
 
     return open_file
@@ -20,6 +20,7 @@ from Bio import SeqIO
 import peasel
 from taxtastic.refpkg import Refpkg
 
+from . import seqindex, treecache
 from .util import (as_fasta, ntf, tempdir, nothing, maybe_tempfile,
                    which, require_executable, MissingDependencyError)
 
@@ -34,6 +35,10 @@ VSEARCH_THREADS = 2
 
 FASTTREE_THREADS = 4
 
+"""Estimated pplacer footprint (sites x references x queries) above which
+pplacer is run with a memory-mapped working file"""
+PPLACER_MMAP_THRESHOLD = 2e9
+
 """Path to item in data directory"""
 data_path = functools.partial(os.path.join, os.path.dirname(__file__), 'data')
 
@@ -42,11 +47,13 @@ CM = data_path('RRNA_16S_BACTERIA.cm')
 
 
 @contextlib.contextmanager
-def as_refpkg(sequences, name='temp.refpkg', threads=FASTTREE_THREADS):
+def as_refpkg(sequences, name='temp.refpkg', threads=FASTTREE_THREADS,
+              cache=None):
     """Context manager yielding a temporary reference package for a
     collection of aligned sequences.
 
-    Builds a tree with FastTree, creates a reference package, yields.
+    Builds a tree with FastTree (see ``fasttree`` for ``cache``), creates a
+    reference package, yields.
 
     """
     sequences = list(sequences)
@@ -57,7 +64,7 @@ def as_refpkg(sequences, name='temp.refpkg', threads=FASTTREE_THREADS):
         log_fp.close()
 
         fasttree(sequences, log_path=log_fp.name, output_fp=tree_fp, gtr=True,
-                 threads=threads)
+                 threads=threads, cache=cache)
         tree_fp.close()
 
         rp = Refpkg(refpkg_dir(name), create=True)
@@ -89,32 +96,46 @@ def redupfile_of_seqs(sequences, **kwargs):
         yield tf.name
 
 
-def fasttree(sequences, output_fp, log_path=None, quiet=True,
-             gtr=False, gamma=False, threads=FASTTREE_THREADS, prefix=None):
+_fasttree_versions = {}
 
-    executable = 'FastTreeMP' if threads and threads > 1 else 'FastTree'
-    if executable == 'FastTreeMP' and not which('FastTreeMP'):
-        executable = 'FastTree'
-        logging.warn("Multithreaded FastTreeMP not found. Using FastTree")
-    require_executable(executable)
 
-    env = os.environ.copy()
-    if threads:
-        env['OMP_NUM_THREADS'] = str(threads)
-    cmd = (prefix or []) + [executable, '-nt']
-    for k, v in (('-gtr', gtr), ('-gamma', gamma), ('-quiet', quiet)):
-        if v:
-            cmd.append(k)
-    if log_path is not None:
-        cmd.extend(['-log', log_path])
+def fasttree_version(executable='FastTree'):
+    """Version and precision reported by FastTree ``executable``, or None
+    if it can't be run.
 
-    logging.debug(' '.join(cmd))
+    """
+    if executable not in _fasttree_versions:
+        version = None
+        try:
+            with open(os.devnull) as devnull:
+                p = subprocess.Popen([executable, '-help'], stdin=devnull,
+                                     stdout=subprocess.PIPE,
+                                     stderr=subprocess.STDOUT)
+                output = p.communicate()[0]
+        except OSError:
+            output = ''
+        match = re.search(r'FastTree\w* version (\S+)', output, re.I)
+        if match:
+            version = match.group(1)
+            if 'double precision' in output.lower():
+                version += ' double'
+        _fasttree_versions[executable] = version
+    return _fasttree_versions[executable]
+
+
+def _run_fasttree(cmd, sequences, output_fp, env):
+    """Run FastTree, writing ``sequences`` (SeqRecords, or FASTA-formatted
+    text) to its stdin
 
+    """
     with ntf() as stderr:
         p = subprocess.Popen(cmd, stdout=output_fp, stdin=subprocess.PIPE,
                              stderr=stderr, env=env)
-        count = SeqIO.write(sequences, p.stdin, 'fasta')
-        assert count
+        if isinstance(sequences, basestring):
+            p.stdin.write(sequences)
+        else:
+            count = SeqIO.write(sequences, p.stdin, 'fasta')
+            assert count
         p.stdin.close()
         p.wait()
         if not p.returncode == 0:
@@ -123,6 +144,87 @@ def fasttree(sequences, output_fp, log_path=None, quiet=True,
             raise subprocess.CalledProcessError(p.returncode, cmd)
 
 
+def fasttree(sequences, output_fp, log_path=None, quiet=True,
+             gtr=False, gamma=False, threads=FASTTREE_THREADS, prefix=None,
+             cache=None):
+    """Build a tree from aligned ``sequences`` with FastTree, writing the
+    newick tree to ``output_fp``.
+
+    Results are looked up in and added to ``cache`` (a
+    ``treecache.TreeCache``; by default, the cache configured by
+    ``treecache.default_cache``) if one is available. The cache key
+    includes the FastTree version. Without a cache, ``sequences`` are
+    streamed to FastTree rather than held in memory.
+
+    """
+
+    executable = 'FastTreeMP' if threads and threads > 1 else 'FastTree'
+    if executable == 'FastTreeMP' and not which('FastTreeMP'):
+        executable = 'FastTree'
+        logging.warn("Multithreaded FastTreeMP not found. Using FastTree")
+
+    env = os.environ.copy()
+    if threads:
+        env['OMP_NUM_THREADS'] = str(threads)
+    flags = ['-nt']
+    for k, v in (('-gtr', gtr), ('-gamma', gamma)):
+        if v:
+            flags.append(k)
+
+    if cache is None:
+        cache = treecache.default_cache()
+    if cache is not None:
+        # the alignment is needed in full to calculate the key
+        buf = StringIO()
+        count = SeqIO.write(sequences, buf, 'fasta')
+        assert count
+        sequences = buf.getvalue()
+        key = cache.key(sequences, flags, fasttree_version(executable))
+        cached = cache.get(key)
+        if cached is not None:
+            newick, log_text = cached
+            logging.debug('FastTree result found in cache: %s', key)
+            if log_path is not None:
+                if log_text is None:
+                    raise ValueError('no log cached for ' + key)
+                with open(log_path, 'w') as fp:
+                    fp.write(log_text)
+            output_fp.write(newick)
+            output_fp.flush()
+            return
+
+    require_executable(executable)
+    cmd = (prefix or []) + [executable] + flags
+    if quiet:
+        cmd.append('-quiet')
+
+    if cache is None:
+        if log_path is not None:
+            cmd.extend(['-log', log_path])
+        logging.debug(' '.join(cmd))
+        _run_fasttree(cmd, sequences, output_fp, env)
+        return
+
+    # Capture the tree and log to store them in the cache
+    with ntf(prefix='fasttree-', suffix='.tre') as tree_fp, \
+            ntf(prefix='fasttree-', suffix='.log') as log_fp:
+        log_fp.close()
+        cmd.extend(['-log', log_fp.name])
+        logging.debug(' '.join(cmd))
+        _run_fasttree(cmd, sequences, tree_fp, env)
+        tree_fp.seek(0)
+        newick = tree_fp.read()
+        with open(log_fp.name) as fp:
+            log_text = fp.read()
+
+    cache.put(key, newick, log_text)
+    if log_path is not None:
+        with open(log_path, 'w') as fp:
+            fp.write(log_text)
+    output_fp.write(newick)
+    output_fp.flush()
+
+
 def guppy_redup(placefile, redup_file, output):
     require_executable('guppy')
     cmd = ['guppy', 'redup', '-m', placefile, '-d', redup_file, '-o', output]
@@ -130,10 +232,36 @@ def guppy_redup(placefile, redup_file, output):
     subprocess.check_call(cmd)
 
 
+def pplacer_footprint(refpkg, alignment):
+    """Estimate the size of the likelihood arrays pplacer will allocate
+    for placing the query sequences in ``alignment`` on ``refpkg``, as
+    the product sites x references x queries.
+
+    """
+    rp = Refpkg(refpkg, create=False)
+    with rp.open_resource('aln_fasta') as fp:
+        ref_ids = frozenset(i.id for i in SeqIO.parse(fp, 'fasta'))
+
+    sites = queries = 0
+    for sequence in SeqIO.parse(alignment, 'fasta'):
+        sites = sites or len(sequence)
+        if sequence.id not in ref_ids:
+            queries += 1
+
+    return sites * len(ref_ids) * queries
+
+
 def pplacer(refpkg, alignment, posterior_prob=False, out_dir=None,
-            threads=2, quiet=True):
+            threads=2, quiet=True, mmap_dir=None,
+            mmap_threshold=PPLACER_MMAP_THRESHOLD, footprint=None):
     """Run pplacer on the provided refpkg
 
+    If the estimated ``footprint`` (sites x references x queries;
+    calculated from ``refpkg`` and ``alignment`` if not provided)
+    exceeds ``mmap_threshold``, pplacer allocates its likelihood arrays
+    in a memory-mapped file created in ``mmap_dir`` rather than in
+    memory.
+
     """
     require_executable('pplacer')
     cmd = ['pplacer', '-j', str(threads), '-c', refpkg, alignment]
@@ -146,9 +274,20 @@ def pplacer(refpkg, alignment, posterior_prob=False, out_dir=None,
     if out_dir:
         jplace = os.path.join(out_dir, jplace)
 
+    use_mmap = mmap_threshold is not None
+    if use_mmap:
+        if footprint is None:
+            footprint = pplacer_footprint(refpkg, alignment)
+        use_mmap = footprint > mmap_threshold
+
     stdout = open(os.devnull, 'w') if quiet else nothing()
+    mmap_tmp = tempdir(prefix='pplacer-', dir=mmap_dir) if use_mmap else nothing()
 
-    with stdout:
+    with stdout, mmap_tmp as mmap_path:
+        if use_mmap:
+            logging.info('pplacer footprint %d > %d: using %s',
+                         footprint, mmap_threshold, mmap_path())
+            cmd.extend(('--mmap-file', mmap_path('pplacer.mmap')))
         logging.debug(' '.join(cmd))
         subprocess.check_call(cmd, stdout=stdout)
 
@@ -255,7 +394,7 @@ def cmalign(sequences, output=None, cm=CM, cpu=CMALIGN_THREADS):
     Run cmalign
     """
     with as_fasta(sequences) as fasta, maybe_tempfile(
-            output, prefix='cmalign', suffix='.sto', dir='.') as tf:
+            output, prefix='cmalign', suffix='.sto') as tf:
 
         cmalign_files(fasta, tf.name, cm=cm, cpu=cpu)
 
@@ -307,6 +446,37 @@ def vsearch_allpairs_files(input_file, output_file, executable=VSEARCH,
         raise subprocess.CalledProcessError(p.returncode, error)
 
 
+def vsearch_pairs_files(query_file, db_file, output_file, executable=VSEARCH,
+                        threads=VSEARCH_THREADS, iddef=VSEARCH_IDDEF):
+    """Use vsearch to calculate distances from each sequence in
+    ``query_file`` to every sequence in ``db_file``.
+
+    """
+
+    require_executable(executable)
+    _require_vsearch_version()
+
+    cmd = [executable,
+           '--usearch_global', query_file,
+           '--db', db_file,
+           '--strand', 'plus',
+           '--qmask', 'none',
+           '--dbmask', 'none',
+           '--id', '0',
+           '--maxaccepts', '0',
+           '--maxrejects', '0',
+           '--threads', str(threads),
+           '--iddef', str(iddef),
+           '--blast6out', output_file]
+
+    logging.info(' '.join(cmd))
+    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    logging.debug(p.stdout.read().strip())
+    error = p.stderr.read().strip()
+    if p.wait() != 0:
+        raise subprocess.CalledProcessError(p.returncode, error)
+
+
 def muscle_files(input_file, output_file, maxiters=MUSCLE_MAXITERS):
     cmd = ['muscle']
     require_executable(cmd[0])
@@ -332,7 +502,9 @@ def esl_sfetch(sequence_file, name_iter, output_fp, use_temp=False):
     Fetch sequences named in name_iter from sequence_file, indexing if
     necessary, writing to output_fp.
 
-    If ``use_temp`` is True, a temporary index is created and used.
+    The index is shared among threads and persists across runs (see
+    ``seqindex``). If ``use_temp`` is True, a temporary index is created and
+    used instead.
     """
 
     if use_temp:
@@ -340,14 +512,8 @@ def esl_sfetch(sequence_file, name_iter, output_fp, use_temp=False):
             sequences = (index[i] for i in name_iter)
             count = peasel.write_fasta(sequences, output_fp)
     else:
-        try:
-            peasel.create_ssi(sequence_file)
-        except IOError:
-            logging.debug("An index already exists for %s", sequence_file)
-
-        index = peasel.open_ssi(sequence_file)
-        sequences = (index[i] for i in name_iter)
-        count = peasel.write_fasta(sequences, output_fp)
+        index = seqindex.open_index(sequence_file)
+        count = index.write_fasta(name_iter, output_fp)
 
     return count
 